@@ -29,7 +29,23 @@ class SamlRequirerCharm(ops.CharmBase):
 ```
 
 As shown above, the library provides a custom event to handle the scenario in
-which new SAML data has been added or updated.
+which new SAML data has been added or updated. The relation data is parsed once per
+event and cached by `SamlRequires.get_relation_data` until the databag content changes.
+The provider publishes a digest of the SAML data under the `saml_digest` key, and the
+event is not emitted again for a digest already handled, unless `SamlRequires` is
+instantiated with `skip_unchanged=False`.
+
+The requirer advertises the highest relation data schema version it can parse under the
+`saml_schema_version` key, and the provider publishes the SAML data in that version. In the
+v1 schema, the SAML data is published as compact JSON under the `saml_data` key, with the
+certificates normalized and deduplicated, and compressed with zlib when large. Requirers not
+advertising any version, such as the ones using older versions of this library, get the v0
+schema, with a key per field and endpoint. `SamlRequires` requests the v1 schema unless
+instantiated with `schema_version=0`.
+
+A requirer can also request a specific IdP of the provider's metadata by instantiating
+`SamlRequires` with an `entity_id`, which is advertised under the `saml_entity_id` key;
+otherwise, the provider serves the IdP it is configured with.
 
 ### Provider Charm
 
@@ -55,7 +71,9 @@ class SamlRequirerCharm(ops.CharmBase):
 ```
 The SamlProvides object wraps the list of relations into a `relations` property
 and provides an `update_relation_data` method to update the relation data by passing
-a `SamlRelationData` data object.
+a `SamlRelationData` data object. Only the keys that were added, changed or removed
+are written to the relation databag; the `get_relation_data_delta` function computes
+these changes and can be used to diff any relation databag.
 Additionally, SamlRelationData can be used to directly parse the relation data with the
 class method `from_relation_data`.
 """
@@ -68,17 +86,40 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 11
+LIBPATCH = 19
 
 # pylint: disable=wrong-import-position
 # ruff: noqa: E402
+import base64
+import hashlib
+import json
 import re
 import typing
+import zlib
 
 import ops
 from pydantic import AnyHttpUrl, BaseModel, Field, TypeAdapter
 
 DEFAULT_RELATION_NAME = "saml"
+# Relation data key holding the digest of the SAML data, published along with it.
+DIGEST_KEY = "saml_digest"
+# Relation data key holding the schema version, advertised by the requirer as the highest one it
+# can parse and published by the provider along with the SAML data.
+SCHEMA_VERSION_KEY = "saml_schema_version"
+# Relation data key holding the entity ID of the IdP requested by the requirer.
+ENTITY_ID_KEY = "saml_entity_id"
+# Highest relation data schema version supported by this library.
+SCHEMA_VERSION = 1
+# Relation data key holding the whole SAML data as JSON in the v1 schema.
+_V1_DATA_KEY = "saml_data"
+# Size above which the v1 SAML data is compressed, provided compressing makes it smaller.
+COMPRESSION_THRESHOLD = 1024
+_COMPRESSED_PREFIX = "zlib:"
+# Validating with a shared adapter avoids rebuilding the validation schema for every URL.
+_HTTP_URL_ADAPTER = TypeAdapter(AnyHttpUrl)
+_ENDPOINT_URL_SUFFIXES = ("_redirect_url", "_post_url")
+# Checked in order, as the response URL keys also end with "_url".
+_ENDPOINT_FIELDS = ("_response_url", "_binding", "_url")
 
 
 class SamlEndpoint(BaseModel):
@@ -128,24 +169,35 @@ class SamlEndpoint(BaseModel):
         url_key = ""
         for key in relation_data:
             # A key per method and entpoint type that is always present
-            if key.endswith("_redirect_url") or key.endswith("_post_url"):
+            if key.endswith(_ENDPOINT_URL_SUFFIXES):
                 url_key = key
-        # Get endpoint name from the relation data key
-        lowercase_name = "_".join(url_key.split("_")[:-2])
+        return cls._from_prefix(url_key[: -len("_url")], relation_data)
+
+    @classmethod
+    def _from_prefix(cls, prefix: str, relation_data: typing.Mapping[str, str]) -> "SamlEndpoint":
+        """Initialize a new instance of the SamlEndpoint class from its relation data keys.
+
+        Args:
+            prefix: the prefix of the endpoint keys, such as `single_sign_on_service_redirect`.
+            relation_data: the relation data holding the endpoint keys.
+
+        Returns:
+            A SamlEndpoint instance.
+        """
+        # Get endpoint name and HTTP method from the prefix
+        lowercase_name, _, http_method = prefix.rpartition("_")
         name = "".join(x.capitalize() for x in lowercase_name.split("_"))
-        # Get HTTP method from the relation data key
-        http_method = url_key.split("_")[-2]
         prefix = f"{lowercase_name}_{http_method}_"
         return cls(
             name=name,
             url=(
-                TypeAdapter(AnyHttpUrl).validate_python(relation_data[f"{prefix}url"])
+                _HTTP_URL_ADAPTER.validate_python(relation_data[f"{prefix}url"])
                 if relation_data[f"{prefix}url"]
                 else None
             ),
             binding=relation_data[f"{prefix}binding"],
             response_url=(
-                TypeAdapter(AnyHttpUrl).validate_python(relation_data[f"{prefix}response_url"])
+                _HTTP_URL_ADAPTER.validate_python(relation_data[f"{prefix}response_url"])
                 if f"{prefix}response_url" in relation_data
                 else None
             ),
@@ -160,6 +212,7 @@ class SamlRelationData(BaseModel):
         metadata_url: URL to the metadata.
         certificates: Tuple of SAML certificates.
         endpoints: Tuple of SAML endpoints.
+        digest: SHA-256 digest of the relation representation.
     """
 
     entity_id: str = Field(..., min_length=1)
@@ -167,12 +220,17 @@ class SamlRelationData(BaseModel):
     certificates: typing.Tuple[str, ...]
     endpoints: typing.Tuple[SamlEndpoint, ...]
 
-    def to_relation_data(self) -> typing.Dict[str, str]:
+    def to_relation_data(self, schema_version: int = 0) -> typing.Dict[str, str]:
         """Convert an instance of SamlDataAvailableEvent to the relation representation.
 
+        Args:
+            schema_version: the schema version of the representation.
+
         Returns:
             Dict containing the representation.
         """
+        if schema_version >= 1:
+            return self._to_v1_relation_data()
         result = {
             "entity_id": self.entity_id,
             "x509certs": ",".join(self.certificates),
@@ -183,6 +241,54 @@ class SamlRelationData(BaseModel):
             result.update(endpoint.to_relation_data())
         return result
 
+    def _to_v1_relation_data(self) -> typing.Dict[str, str]:
+        """Convert an instance of SamlDataAvailableEvent to the v1 relation representation.
+
+        The whole SAML data is serialized as compact JSON under a single key, with the
+        whitespace stripped from the certificates, the duplicate certificates removed and each
+        endpoint as a `[name, binding, url, response_url]` list. Large payloads are compressed
+        with zlib and encoded in base64.
+
+        Returns:
+            Dict containing the representation.
+        """
+        certificates = dict.fromkeys(
+            "".join(certificate.split()) for certificate in self.certificates
+        )
+        payload = json.dumps(
+            {
+                "entity_id": self.entity_id,
+                "metadata_url": str(self.metadata_url) if self.metadata_url else None,
+                "certificates": list(certificates),
+                "endpoints": [
+                    [
+                        endpoint.name,
+                        endpoint.binding,
+                        str(endpoint.url) if endpoint.url else None,
+                        str(endpoint.response_url) if endpoint.response_url else None,
+                    ]
+                    for endpoint in self.endpoints
+                ],
+            },
+            separators=(",", ":"),
+        )
+        if len(payload) > COMPRESSION_THRESHOLD:
+            compressed = (
+                _COMPRESSED_PREFIX + base64.b64encode(zlib.compress(payload.encode(), 9)).decode()
+            )
+            if len(compressed) < len(payload):
+                payload = compressed
+        return {SCHEMA_VERSION_KEY: "1", _V1_DATA_KEY: payload}
+
+    @property
+    def digest(self) -> str:
+        """Compute the digest of the relation representation.
+
+        Returns:
+            The SHA-256 hex digest of the relation data serialized as canonical JSON.
+        """
+        return _digest(self.to_relation_data())
+
     @classmethod
     def from_relation_data(cls, relation_data: ops.RelationDataContent) -> "SamlRelationData":
         """Get a SamlRelationData wrapping the relation data.
@@ -192,23 +298,28 @@ class SamlRelationData(BaseModel):
 
         Returns: a SamlRelationData instance with the relation data.
         """
-        # mypy is not aware of the relation data being present
+        if _V1_DATA_KEY in relation_data:
+            return cls._from_v1_relation_data(relation_data[_V1_DATA_KEY])
+        # A single pass groups the endpoint keys by prefix, such as
+        # `single_sign_on_service_redirect`, keeping the endpoints in the order of their URL keys.
+        endpoint_keys: typing.Dict[str, typing.Dict[str, str]] = {}
+        prefixes = []
+        for key, value in relation_data.items():
+            for field in _ENDPOINT_FIELDS:
+                if key.endswith(field):
+                    prefix = key[: -len(field)]
+                    endpoint_keys.setdefault(prefix, {})[key] = value
+                    if key.endswith(_ENDPOINT_URL_SUFFIXES):
+                        prefixes.append(prefix)
+                    break
         endpoints = [
-            SamlEndpoint.from_relation_data(
-                {
-                    key2: relation_data.get(key2)  # type: ignore
-                    for key2 in relation_data
-                    if key2.startswith("_".join(key.split("_")[:-1]))
-                }
-            )
-            for key in relation_data
-            if key.endswith("_redirect_url") or key.endswith("_post_url")
+            SamlEndpoint._from_prefix(prefix, endpoint_keys[prefix]) for prefix in prefixes
         ]
         endpoints.sort(key=lambda ep: ep.name)
         return cls(
             entity_id=relation_data.get("entity_id"),  # type: ignore
             metadata_url=(
-                TypeAdapter(AnyHttpUrl).validate_python(relation_data.get("metadata_url"))
+                _HTTP_URL_ADAPTER.validate_python(relation_data.get("metadata_url"))
                 if relation_data.get("metadata_url")
                 else None
             ),  # type: ignore
@@ -216,6 +327,101 @@ class SamlRelationData(BaseModel):
             endpoints=tuple(endpoints),
         )
 
+    @classmethod
+    def _from_v1_relation_data(cls, payload: str) -> "SamlRelationData":
+        """Get a SamlRelationData from the SAML data of the v1 relation representation.
+
+        Arguments:
+            payload: the SAML data, possibly compressed.
+
+        Returns: a SamlRelationData instance with the relation data.
+        """
+        if payload.startswith(_COMPRESSED_PREFIX):
+            payload = zlib.decompress(
+                base64.b64decode(payload[len(_COMPRESSED_PREFIX) :])
+            ).decode()
+        data = json.loads(payload)
+        data["endpoints"] = [
+            {"name": name, "binding": binding, "url": url, "response_url": response_url}
+            for name, binding, url, response_url in sorted(
+                data["endpoints"], key=lambda endpoint: endpoint[0]
+            )
+        ]
+        return cls.model_validate(data)
+
+
+def _digest(relation_data: typing.Mapping[str, str]) -> str:
+    """Compute the digest of the v0 relation representation.
+
+    Args:
+        relation_data: the v0 relation representation.
+
+    Returns:
+        The SHA-256 hex digest of the relation data serialized as canonical JSON.
+    """
+    canonical = json.dumps(relation_data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class RelationDataDelta(typing.NamedTuple):
+    """Represent the changes needed to bring a relation databag up to date.
+
+    Attrs:
+        changed: the keys added or changed, with their new values.
+        removed: the keys to remove.
+    """
+
+    changed: typing.Dict[str, str]
+    removed: typing.Tuple[str, ...]
+
+    def __bool__(self) -> bool:
+        """Check if there is any change to apply.
+
+        Returns:
+            True if any key needs to be added, changed or removed.
+        """
+        return bool(self.changed or self.removed)
+
+
+def get_relation_data_delta(
+    current: typing.Mapping[str, str], new: typing.Mapping[str, str]
+) -> RelationDataDelta:
+    """Compute the changes to turn the current relation data into the new one.
+
+    Args:
+        current: the relation data currently in the databag.
+        new: the desired relation data.
+
+    Returns:
+        The keys to add or change and the keys to remove.
+    """
+    return RelationDataDelta(
+        changed={key: value for key, value in new.items() if current.get(key) != value},
+        removed=tuple(sorted(key for key in current if key not in new)),
+    )
+
+
+_RelationDataKey = typing.FrozenSet[typing.Tuple[str, str]]
+_CachedRelationData = typing.Tuple[_RelationDataKey, SamlRelationData]
+
+
+def _parse_relation_data(
+    relation_data: ops.RelationDataContent, cached: typing.Optional[_CachedRelationData]
+) -> _CachedRelationData:
+    """Parse the relation data, unless it was already parsed with the same content.
+
+    Args:
+        relation_data: the relation data.
+        cached: the previously parsed relation data along with the content it was parsed from.
+
+    Returns:
+        The parsed relation data along with the content it was parsed from.
+    """
+    key = frozenset(relation_data.items())
+    if cached is not None and cached[0] == key:
+        return cached
+    return key, SamlRelationData.from_relation_data(relation_data)
+
 
 class SamlDataAvailableEvent(ops.RelationEvent):
     """Saml event emitted when relation data has changed.
@@ -230,9 +436,13 @@ class SamlDataAvailableEvent(ops.RelationEvent):
 
     @property
     def saml_relation_data(self) -> SamlRelationData:
-        """Get a SamlRelationData for the relation data."""
+        """Get a SamlRelationData for the relation data, parsed once per event."""
         assert self.relation.app  # noqa: S101
-        return SamlRelationData.from_relation_data(self.relation.data[self.relation.app])
+        # Restored events are not initialized, so the attribute may be missing.
+        self._saml_relation_data = _parse_relation_data(
+            self.relation.data[self.relation.app], getattr(self, "_saml_relation_data", None)
+        )
+        return self._saml_relation_data[1]
 
     @property
     def entity_id(self) -> str:
@@ -275,19 +485,65 @@ class SamlRequires(ops.Object):
     """
 
     on = SamlRequiresEvents()
-
-    def __init__(self, charm: ops.CharmBase, relation_name: str = DEFAULT_RELATION_NAME) -> None:
+    _stored = ops.StoredState()
+
+    def __init__(
+        self,
+        charm: ops.CharmBase,
+        relation_name: str = DEFAULT_RELATION_NAME,
+        skip_unchanged: bool = True,
+        schema_version: int = SCHEMA_VERSION,
+        entity_id: typing.Optional[str] = None,
+    ) -> None:
         """Construct.
 
         Args:
             charm: the provider charm.
             relation_name: the relation name.
+            skip_unchanged: whether to skip the saml_data_available event when the provider
+                publishes a digest that was already handled.
+            schema_version: the relation data schema version to request from the provider.
+            entity_id: the entity ID of the IdP to request from the provider, if not the one
+                the provider is configured with.
         """
         super().__init__(charm, relation_name)
         self.charm = charm
         self.relation_name = relation_name
+        self.skip_unchanged = skip_unchanged
+        self.schema_version = schema_version
+        self.entity_id = entity_id
+        self._stored.set_default(handled_digests={})
+        self._relation_data_cache: typing.Dict[int, _CachedRelationData] = {}
+        self.framework.observe(charm.on[relation_name].relation_created, self._on_relation_created)
         self.framework.observe(charm.on[relation_name].relation_changed, self._on_relation_changed)
 
+    def _advertise_requirements(self, relation: ops.Relation) -> None:
+        """Advertise the requested schema version and entity ID to the provider.
+
+        Only the keys that changed are written, an empty value removing the key.
+
+        Args:
+            relation: the relation to advertise the requirements in.
+        """
+        if not self.charm.unit.is_leader():
+            return
+        databag = relation.data[self.charm.app]
+        requirements = {
+            SCHEMA_VERSION_KEY: str(self.schema_version),
+            ENTITY_ID_KEY: self.entity_id or "",
+        }
+        for key, value in requirements.items():
+            if databag.get(key, "") != value:
+                databag[key] = value
+
+    def _on_relation_created(self, event: ops.RelationCreatedEvent) -> None:
+        """Event emitted when the relation is created.
+
+        Args:
+            event: event triggering this handler.
+        """
+        self._advertise_requirements(event.relation)
+
     def _on_relation_changed(self, event: ops.RelationChangedEvent) -> None:
         """Event emitted when the relation has changed.
 
@@ -295,19 +551,40 @@ class SamlRequires(ops.Object):
             event: event triggering this handler.
         """
         assert event.relation.app  # noqa: S101
-        if event.relation.data[event.relation.app]:
-            self.on.saml_data_available.emit(event.relation, app=event.app, unit=event.unit)
+        # Relations created before the requirements were advertised get them on their next change.
+        self._advertise_requirements(event.relation)
+        self._relation_data_cache.pop(event.relation.id, None)
+        relation_data = event.relation.data[event.relation.app]
+        if not relation_data:
+            return
+        # Providers older than the digest don't publish it, so their data is always handled.
+        digest = relation_data.get(DIGEST_KEY)
+        relation_key = str(event.relation.id)
+        if (
+            self.skip_unchanged
+            and digest
+            and self._stored.handled_digests.get(relation_key) == digest
+        ):
+            return
+        self._stored.handled_digests[relation_key] = digest or ""
+        self.on.saml_data_available.emit(event.relation, app=event.app, unit=event.unit)
 
     def get_relation_data(self) -> typing.Optional[SamlRelationData]:
         """Retrieve the relation data.
 
+        The relation data is only parsed again when the databag content changes.
+
         Returns:
             SmtpRelationData: the relation data.
         """
         relation = self.model.get_relation(self.relation_name)
         if not relation or not relation.app or not relation.data[relation.app]:
             return None
-        return SamlRelationData.from_relation_data(relation.data[relation.app])
+        cached = _parse_relation_data(
+            relation.data[relation.app], self._relation_data_cache.get(relation.id)
+        )
+        self._relation_data_cache[relation.id] = cached
+        return cached[1]
 
 
 class SamlProvides(ops.Object):
@@ -337,11 +614,126 @@ class SamlProvides(ops.Object):
         """
         return list(self.model.relations[self.relation_name])
 
-    def update_relation_data(self, relation: ops.Relation, saml_data: SamlRelationData) -> None:
+    def schema_version(self, relation: ops.Relation) -> int:
+        """Get the schema version to publish the SAML data in.
+
+        Args:
+            relation: the relation.
+
+        Returns:
+            The highest version supported by both the requirer and this library, the requirers
+            not advertising any version only supporting the v0 schema.
+        """
+        if not relation.app:
+            return 0
+        requested = relation.data[relation.app].get(SCHEMA_VERSION_KEY, "0")
+        return min(int(requested), SCHEMA_VERSION) if requested.isdigit() else 0
+
+    def requested_entity_id(self, relation: ops.Relation) -> typing.Optional[str]:
+        """Get the entity ID of the IdP requested by the requirer.
+
+        Args:
+            relation: the relation.
+
+        Returns:
+            The requested entity ID, or None if the requirer didn't request any.
+        """
+        if not relation.app:
+            return None
+        return relation.data[relation.app].get(ENTITY_ID_KEY) or None
+
+    def is_up_to_date(self, relation: ops.Relation, digest: str) -> bool:
+        """Check if the relation already publishes SAML data in the requested schema version.
+
+        Args:
+            relation: the relation.
+            digest: the digest of the SAML data.
+
+        Returns:
+            True if the SAML data with this digest is published in the requested schema version.
+        """
+        databag = relation.data[self.charm.model.app]
+        return databag.get(DIGEST_KEY) == digest and databag.get(SCHEMA_VERSION_KEY, "0") == str(
+            self.schema_version(relation)
+        )
+
+    def published_relation_data(self, relation: ops.Relation) -> typing.Optional[SamlRelationData]:
+        """Get the SAML data currently published in a relation, in either schema version.
+
+        Args:
+            relation: the relation.
+
+        Returns:
+            The published SAML data, or None if none was published yet.
+        """
+        databag = relation.data[self.charm.model.app]
+        if _V1_DATA_KEY not in databag and "x509certs" not in databag:
+            return None
+        return SamlRelationData.from_relation_data(databag)
+
+    def update_relation_data(self, relation: ops.Relation, saml_data: SamlRelationData) -> bool:
         """Update the relation data.
 
+        Only the keys that differ from the databag contents are written, and the keys that
+        are no longer part of the SAML data, such as the ones of a removed endpoint, are deleted.
+        The digest of the SAML data is published along with it under the saml_digest key, and
+        the SAML data is published in the schema version requested by the requirer.
+
         Args:
             relation: the relation for which to update the data.
             saml_data: a SamlRelationData instance wrapping the data to be updated.
+
+        Returns:
+            True if the relation databag was modified.
+        """
+        relation_data = saml_data.to_relation_data(self.schema_version(relation))
+        return self._write_relation_data(relation, {**relation_data, DIGEST_KEY: saml_data.digest})
+
+    def update_relations_data(
+        self, relations: typing.Iterable[ops.Relation], saml_data: SamlRelationData
+    ) -> int:
+        """Update the relation data of several relations publishing the same SAML data.
+
+        The SAML data is serialized and its digest computed once, then once per other schema
+        version requested, rather than for every relation. The relations already publishing
+        the SAML data in the schema version requested are not written to.
+
+        Args:
+            relations: the relations for which to update the data.
+            saml_data: a SamlRelationData instance wrapping the data to be updated.
+
+        Returns:
+            The number of relation databags modified.
+        """
+        serialized = {0: saml_data.to_relation_data()}
+        digest = _digest(serialized[0])
+        written = 0
+        for relation in relations:
+            if self.is_up_to_date(relation, digest):
+                continue
+            schema_version = self.schema_version(relation)
+            if schema_version not in serialized:
+                serialized[schema_version] = saml_data.to_relation_data(schema_version)
+            written += self._write_relation_data(
+                relation, {**serialized[schema_version], DIGEST_KEY: digest}
+            )
+        return written
+
+    def _write_relation_data(
+        self, relation: ops.Relation, relation_data: typing.Dict[str, str]
+    ) -> bool:
+        """Write the relation data, only changing the keys that differ from the databag.
+
+        Args:
+            relation: the relation.
+            relation_data: the serialized SAML data along with its digest.
+
+        Returns:
+            True if the relation databag was modified.
         """
-        relation.data[self.charm.model.app].update(saml_data.to_relation_data())
+        databag = relation.data[self.charm.model.app]
+        delta = get_relation_data_delta(databag, relation_data)
+        databag.update(delta.changed)
+        for key in delta.removed:
+            del databag[key]
+        return bool(delta)
@@ -5,23 +5,46 @@
 
 """SAML Integrator Charm service."""
 
+import base64
+import json
 import logging
+import os
+import time
+import typing
+from functools import cached_property
+from pathlib import Path
 
 import ops
-from charms.saml_integrator.v0 import saml
 from ops.main import main
 
-from charm_state import CharmConfigInvalidError, CharmState
-from saml import SamlIntegrator
+from performance import PhaseTimer, summarize, update_statistics
+from profiling import (
+    collect_profiles,
+    list_profiles,
+    profile_directory,
+    profile_hook,
+    set_profiling,
+)
+from refresh import Validity, combine_validity, earliest, next_refresh
+
+if typing.TYPE_CHECKING:  # pragma: nocover
+    from charms.saml_integrator.v0.saml import SamlProvides, SamlRelationData
+
+    from charm_state import CharmState
+    from saml import SamlIntegrator
 
 logger = logging.getLogger(__name__)
 
 RELATION_NAME = "saml"
+ENTITY_INDEX_FILE = "entities.db"
+VERIFICATION_CACHE_FILE = "verifications.json"
 
 
-class SamlIntegratorOperatorCharm(ops.CharmBase):
+class SamlIntegratorOperatorCharm(ops.CharmBase):  # pylint: disable=import-outside-toplevel
     """Charm for SAML Integrator."""
 
+    _stored = ops.StoredState()
+
     def __init__(self, *args):
         """Construct.
 
@@ -29,59 +52,487 @@ class SamlIntegratorOperatorCharm(ops.CharmBase):
             args: Arguments passed to the CharmBase parent constructor.
         """
         super().__init__(*args)
-        try:
-            self._charm_state = CharmState.from_charm(charm=self)
-            self._saml_integrator = SamlIntegrator(charm_state=self._charm_state)
-        except CharmConfigInvalidError as exc:
-            self.model.unit.status = ops.BlockedStatus(exc.msg)
-            return
-        self.saml = saml.SamlProvides(self)
+        self._stored.set_default(
+            metadata_digest="",
+            performance={},
+            last_refresh=0.0,
+            refresh_max_age=None,
+            validity={},
+            circuits={},
+        )
+        self._phase_timer = PhaseTimer()
+        # Set by the refresh-metadata action to bypass the caches for the whole hook.
+        self._bypass_cache = False
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+        self.framework.observe(
+            self.on.get_performance_stats_action, self._on_get_performance_stats_action
+        )
         self.framework.observe(self.on[RELATION_NAME].relation_created, self._on_relation_created)
+        self.framework.observe(self.on[RELATION_NAME].relation_changed, self._on_relation_changed)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.list_entities_action, self._on_list_entities_action)
+        self.framework.observe(
+            self.on.get_refresh_schedule_action, self._on_get_refresh_schedule_action
+        )
+        self.framework.observe(self.on.collect_profiles_action, self._on_collect_profiles_action)
+        self.framework.observe(self.on.refresh_metadata_action, self._on_refresh_metadata_action)
+
+    # The modules validating the configuration and processing the metadata pull in pydantic,
+    # lxml, signxml and cryptography, which take longer to import than most hooks take to run.
+    # They are only imported by the hooks using them, non-leader units rarely having to.
+    @cached_property
+    def _charm_state(self) -> "CharmState":
+        """Charm state, built from the configuration.
+
+        Raises:
+            CharmConfigInvalidError: if the configuration is invalid.
+        """
+        from charm_state import CharmState
+        from resilience import CircuitBreaker
+
+        # The circuits are stored so that a failing IdP isn't called by every hook.
+        return CharmState.from_charm(
+            charm=self,
+            circuit_breaker=CircuitBreaker(self._stored.circuits),
+            phase_timer=self._phase_timer,
+            bypass_cache=self._bypass_cache,
+        )
+
+    @cached_property
+    def _saml_integrator(self) -> "SamlIntegrator":
+        """SAML integrator, processing the metadata."""
+        from entity_index import EntityIndex
+        from saml import SamlIntegrator
+        from verification_cache import VerificationCache
+
+        # Without the index nor the verification cache, the metadata is parsed and verified.
+        cache_directory = None if self._bypass_cache else self._charm_state.cache_directory
+        saml_integrator = SamlIntegrator(
+            charm_state=self._charm_state,
+            entity_index=(
+                EntityIndex(cache_directory / ENTITY_INDEX_FILE) if cache_directory else None
+            ),
+            verification_cache=(
+                VerificationCache(cache_directory / VERIFICATION_CACHE_FILE)
+                if cache_directory
+                else None
+            ),
+            phase_timer=self._phase_timer,
+        )
+        # The metadata fetched from the mirrors is only used once validated.
+        self._charm_state.metadata_validator = saml_integrator.validate_metadata
+        return saml_integrator
+
+    @cached_property
+    def saml(self) -> "SamlProvides":
+        """Provider side of the saml relation."""
+        from charms.saml_integrator.v0.saml import SamlProvides
+
+        return SamlProvides(self)
+
+    def _validate_config(self) -> bool:
+        """Validate the configuration, blocking the unit if it is invalid.
+
+        Returns:
+            Whether the configuration is valid.
+        """
+        from charm_state import CharmConfigInvalidError
+
+        try:
+            _ = self._charm_state
+        except CharmConfigInvalidError as exc:
+            self.unit.status = ops.BlockedStatus(exc.msg)
+            return False
+        return True
 
     def _on_relation_created(self, _) -> None:
         """Handle a change to the saml relation."""
+        # Only the leader publishes the SAML data, so there is nothing to do on other units.
+        if not self.unit.is_leader() or not self._validate_config():
+            return
         # A new charm will be instantiated hence, the information will be fetched again.
         # The relation databags are rewritten in case there are changes.
         self.unit.status = ops.MaintenanceStatus("Update integrations")
-        self._update_relations()
-        self.unit.status = ops.ActiveStatus()
+        self._serve_metadata(self._update_relations)
+
+    def _on_relation_changed(self, event: ops.RelationChangedEvent) -> None:
+        """Handle a change to the requirer data of a saml relation.
+
+        Requirers advertise the schema version and entity ID they request in their databag, so
+        only the relation changed is updated.
+
+        Args:
+            event: the relation changed event.
+        """
+        # Only the leader publishes the SAML data, so there is nothing to do on other units.
+        if not self.unit.is_leader() or not self._validate_config():
+            return
+        self._serve_metadata(lambda: self._update_relation(event.relation))
+
+    def _serve_metadata(self, update: typing.Callable[[], None]) -> None:
+        """Update the relations, keeping the published SAML data if no metadata is available.
+
+        Args:
+            update: the function updating the relations.
+        """
+        from charm_state import CharmConfigInvalidError, MetadataUnavailableError
+
+        try:
+            update()
+        except MetadataUnavailableError as exc:
+            # The relations keep the SAML data last published until the IdP recovers.
+            logger.warning("Metadata unavailable: %s", exc.msg)
+            self.unit.status = ops.WaitingStatus(exc.msg)
+            return
+        except CharmConfigInvalidError as exc:
+            # Metadata that can't be verified is never published.
+            logger.error("Invalid metadata: %s", exc.msg)
+            self.unit.status = ops.BlockedStatus(exc.msg)
+            return
+        valid_until = self._validity.valid_until
+        if valid_until is not None and valid_until <= time.time():
+            # The requirers are still served the metadata, but the IdP has to publish new one.
+            self.unit.status = ops.BlockedStatus(
+                f"The metadata expired on {_format_timestamp(valid_until)}"
+            )
+        elif (age := self._charm_state.metadata_age) is not None:
+            self.unit.status = ops.ActiveStatus(
+                f"Serving the metadata cached {_format_age(age)} ago, the IdP being unreachable"
+            )
+        else:
+            self.unit.status = ops.ActiveStatus()
+
+    @property
+    def _validity(self) -> Validity:
+        """Validity of the metadata last published."""
+        return Validity(**self._stored.validity)
+
+    def _refresh_interval(self) -> float:
+        """Compute the interval between metadata refreshes.
+
+        Returns:
+            The shortest of the max-age of the last metadata fetched and of its cacheDuration,
+            or the refresh_interval configuration if it had neither, in seconds.
+        """
+        # The configuration is read as is rather than from the charm state, so that checking
+        # whether a refresh is due doesn't require validating the whole configuration.
+        interval = earliest((self._stored.refresh_max_age, self._validity.cache_duration))
+        return (
+            interval if interval is not None else typing.cast(int, self.config["refresh_interval"])
+        )
+
+    def _next_refresh(self) -> float:
+        """Compute when the metadata is next to be refreshed.
+
+        The refresh interval is delayed by a jitter specific to the unit, and shortened ahead
+        of the next expiry of the metadata or of its certificates. An expiry already past is
+        only reported in the unit status.
+
+        Returns:
+            The UNIX timestamp after which the metadata is to be refreshed.
+        """
+        return next_refresh(
+            self._stored.last_refresh,
+            self._refresh_interval(),
+            f"{self.model.uuid}/{self.unit.name}",
+            expires_at=self._validity.expires_after(self._stored.last_refresh),
+        )
+
+    def _record_refresh(self) -> None:
+        """Record a successful metadata refresh to schedule the next one and keep its metadata."""
+        # While the cached metadata is served, the refresh is retried by the next hook.
+        if self._charm_state.metadata_age is not None:
+            return
+        self._stored.last_refresh = time.time()
+        self._stored.refresh_max_age = self._charm_state.metadata_max_age
+        self._charm_state.keep_verified_metadata()
 
     def _on_update_status(self, _) -> None:
         """Handle the update status event."""
+        # Only the leader publishes the SAML data, so there is nothing to do on other units.
+        if not self.unit.is_leader():
+            return
+        # Within the refresh interval, the metadata is not fetched at all.
+        if time.time() < (refresh_at := self._next_refresh()):
+            logger.info("Metadata refresh not due until %s", time.ctime(refresh_at))
+            return
+        if not self._validate_config():
+            return
         # A new charm will be instantiated hence, the information will be fetched again.
-        # The relation databags are rewritten in case there are changes.
+        # The relation databags are rewritten in case the metadata has changed since it was
+        # last published; the configuration and relations are handled by their own events.
         self.unit.status = ops.MaintenanceStatus("Update integrations")
-        self._update_relations()
-        self.unit.status = ops.ActiveStatus()
+        self._serve_metadata(self._refresh_relations)
+
+    def _refresh_relations(self) -> None:
+        """Update the relations, unless the metadata is the one last published."""
+        if (
+            self.saml.relations
+            and self._saml_integrator.document.digest == self._stored.metadata_digest
+        ):
+            logger.info("Metadata not modified since it was last published")
+            self._record_refresh()
+        else:
+            self._update_relations()
 
     def _on_config_changed(self, _) -> None:
         """Handle changes in configuration."""
+        # Profiling is independent of the SAML configuration, and applies to the next hooks.
+        set_profiling(
+            profile_directory(self.charm_dir), typing.cast(bool, self.config["profile_hooks"])
+        )
+        if not self._validate_config():
+            return
         self.unit.status = ops.MaintenanceStatus("Configuring charm")
-        self._update_relations()
-        self.unit.status = ops.ActiveStatus()
+        self._serve_metadata(self._update_relations)
+
+    def _on_list_entities_action(self, event: ops.ActionEvent) -> None:
+        """Handle the list-entities action.
+
+        Args:
+            event: the action event.
+        """
+        from charm_state import CharmConfigInvalidError
+
+        try:
+            entity_ids = self._saml_integrator.entity_ids
+        except CharmConfigInvalidError as exc:
+            event.fail(exc.msg)
+            return
+        event.set_results({"count": len(entity_ids), "entities": "\n".join(entity_ids)})
+
+    def _on_get_refresh_schedule_action(self, event: ops.ActionEvent) -> None:
+        """Handle the get-refresh-schedule action.
+
+        Args:
+            event: the action event.
+        """
+        last_refresh = self._stored.last_refresh
+        validity = self._validity
+        results: dict[str, typing.Any] = {
+            "last-refresh": _format_timestamp(last_refresh) if last_refresh else "never",
+            "next-refresh": _format_timestamp(max(self._next_refresh(), time.time())),
+            "interval": int(self._refresh_interval()),
+        }
+        if self._stored.refresh_max_age is not None:
+            results["max-age"] = int(self._stored.refresh_max_age)
+        if validity.cache_duration is not None:
+            results["cache-duration"] = int(validity.cache_duration)
+        if validity.valid_until is not None:
+            results["valid-until"] = _format_timestamp(validity.valid_until)
+        if validity.certificates_expire_at is not None:
+            results["certificates-expire-at"] = _format_timestamp(validity.certificates_expire_at)
+        event.set_results(results)
+
+    def _on_collect_profiles_action(self, event: ops.ActionEvent) -> None:
+        """Handle the collect-profiles action.
+
+        Args:
+            event: the action event.
+        """
+        directory = profile_directory(self.charm_dir)
+        if not (profiles := list_profiles(directory)):
+            event.fail("No hook profile stored, set profile_hooks to profile the next hooks")
+            return
+        event.set_results(
+            {
+                "count": len(profiles),
+                "bundle": base64.b64encode(collect_profiles(directory)).decode(),
+            }
+        )
+
+    def _on_refresh_metadata_action(self, event: ops.ActionEvent) -> None:
+        """Handle the refresh-metadata action.
+
+        Args:
+            event: the action event.
+        """
+        from charm_state import CharmConfigInvalidError
+        from saml import describe_changes
+
+        # Only the leader can read and write the SAML data published.
+        if not self.unit.is_leader():
+            event.fail("The metadata can only be refreshed on the leader unit")
+            return
+        dry_run = typing.cast(bool, event.params.get("dry-run", False))
+        self._bypass_cache = True
+        changes: list[str] = []
+        changed_relations = 0
+        try:
+            relations_by_entity = self._relations_by_entity()
+            self._saml_integrator.get_entities([self._charm_state.entity_id, *relations_by_entity])
+            for entity_id, relations in relations_by_entity.items():
+                saml_data = self.get_saml_data(entity_id)
+                for relation in relations:
+                    published = self.saml.published_relation_data(relation)
+                    if relation_changes := describe_changes(published, saml_data):
+                        changed_relations += 1
+                        changes.extend(
+                            f"{relation.name}:{relation.id} {change}"
+                            for change in relation_changes
+                        )
+        except CharmConfigInvalidError as exc:
+            event.fail(exc.msg)
+            return
+        if not dry_run:
+            self.unit.status = ops.MaintenanceStatus("Update integrations")
+            self._serve_metadata(self._update_relations)
+        event.set_results(
+            {
+                "digest": self._saml_integrator.document.digest,
+                "dry-run": dry_run,
+                "changed-relations": changed_relations,
+                "changes": "\n".join(changes) or "No change",
+                "timings": {
+                    phase: round(duration * 1000, 3)
+                    for phase, duration in self._phase_timer.durations.items()
+                },
+            }
+        )
+
+    def _on_get_performance_stats_action(self, event: ops.ActionEvent) -> None:
+        """Handle the get-performance-stats action.
+
+        Args:
+            event: the action event.
+        """
+        event.set_results(summarize(self._stored.performance))
+
+    def _on_pre_commit(self, _) -> None:
+        """Log the time spent in each phase of the hook and update the rolling statistics."""
+        if not self._phase_timer.durations and not self._phase_timer.counters:
+            return
+        logger.info(
+            "Hook performance: %s",
+            json.dumps(
+                {
+                    "hook": os.environ.get("JUJU_DISPATCH_PATH", ""),
+                    "durations": self._phase_timer.durations,
+                    "counters": self._phase_timer.counters,
+                },
+                sort_keys=True,
+            ),
+        )
+        self._stored.performance = update_statistics(self._stored.performance, self._phase_timer)
 
     def _update_relations(self) -> None:
-        """Update all SAML data for the existing relations."""
-        if not self.model.unit.is_leader():
+        """Update all SAML data for the existing relations.
+
+        Each relation is served the IdP entity its requirer requested, or the configured one.
+        The entities are extracted from the metadata together, and the SAML data of each entity
+        is built and its digest computed once. The relations already publishing that digest in
+        the schema version requested are not written to, avoiding both the relation-set calls
+        and the relation-changed events they would trigger on the requirers.
+        """
+        if not self.model.unit.is_leader() or not (
+            relations_by_entity := self._relations_by_entity()
+        ):
+            return
+        # All the entities are extracted at once, sharing a single pass over the metadata.
+        self._saml_integrator.get_entities(relations_by_entity)
+        relations_written = 0
+        for entity_id, entity_relations in relations_by_entity.items():
+            saml_data = self.get_saml_data(entity_id)
+            with self._phase_timer.span("relations"):
+                relations_written += self.saml.update_relations_data(entity_relations, saml_data)
+        self._phase_timer.count("relations-written", relations_written)
+        self._stored.metadata_digest = self._saml_integrator.document.digest
+        # The validity is kept along with the digest, as the metadata isn't parsed again
+        # while unchanged.
+        self._stored.validity = self._saml_integrator.get_validity(relations_by_entity)._asdict()
+        self._record_refresh()
+
+    def _update_relation(self, relation: ops.Relation) -> None:
+        """Update the SAML data of a single relation from the metadata last published.
+
+        The entity requested is looked up in the index of the metadata last published, without
+        fetching it. Without the index, the metadata is fetched, and all the relations are
+        updated if it changed since it was last published.
+
+        Args:
+            relation: the relation to update.
+        """
+        entity_id = self.saml.requested_entity_id(relation) or self._charm_state.entity_id
+        if (
+            not self._saml_integrator.load_indexed_entities(
+                self._stored.metadata_digest, [entity_id]
+            )
+            and self._saml_integrator.document.digest != self._stored.metadata_digest
+        ):
+            self._update_relations()
             return
+        saml_data = self.get_saml_data(entity_id)
+        with self._phase_timer.span("relations"):
+            relations_written = self.saml.update_relations_data([relation], saml_data)
+        self._phase_timer.count("relations-written", relations_written)
+        # The entity requested may not have been served yet, with a validity of its own.
+        self._stored.validity = combine_validity(
+            [self._validity, self._saml_integrator.get_validity([entity_id])]
+        )._asdict()
+
+    def _relations_by_entity(self) -> dict[str, list[ops.Relation]]:
+        """Group the saml relations by the IdP entity to serve them.
+
+        Returns:
+            The relations by the entity ID requested by their requirer, or the configured one.
+        """
+        relations_by_entity: dict[str, list[ops.Relation]] = {}
         for relation in self.saml.relations:
-            self.saml.update_relation_data(relation, self.get_saml_data())
+            entity_id = self.saml.requested_entity_id(relation) or self._charm_state.entity_id
+            relations_by_entity.setdefault(entity_id, []).append(relation)
+        return relations_by_entity
 
-    def get_saml_data(self) -> saml.SamlRelationData:
+    def get_saml_data(self, entity_id: typing.Optional[str] = None) -> "SamlRelationData":
         """Get relation data.
 
+        Args:
+            entity_id: the entity ID of the IdP, the configured one if not set.
+
         Returns:
             SamlRelationData containing the IdP details.
         """
-        return saml.SamlRelationData(
-            entity_id=self._charm_state.entity_id,
+        from charms.saml_integrator.v0.saml import SamlRelationData
+
+        entity_id = entity_id or self._charm_state.entity_id
+        if self._saml_integrator.get_entities([entity_id])[entity_id] is None:
+            logger.warning("Entity %s not found in the metadata", entity_id)
+        return SamlRelationData(
+            entity_id=entity_id,
             metadata_url=self._charm_state.metadata_url,
-            certificates=self._saml_integrator.certificates,
-            endpoints=self._saml_integrator.endpoints,
+            certificates=self._saml_integrator.get_certificates(entity_id),
+            endpoints=self._saml_integrator.get_endpoints(entity_id),
         )
 
 
+def _format_age(seconds: float) -> str:
+    """Format an age for the unit status.
+
+    Args:
+        seconds: the age, in seconds.
+
+    Returns:
+        The age in the largest unit among days, hours and minutes.
+    """
+    for unit, length in (("d", 86400), ("h", 3600)):
+        if seconds >= length:
+            return f"{int(seconds // length)}{unit}"
+    return f"{int(seconds // 60)}m"
+
+
+def _format_timestamp(timestamp: float) -> str:
+    """Format a UNIX timestamp for the unit status and the action results.
+
+    Args:
+        timestamp: the UNIX timestamp.
+
+    Returns:
+        The date and time in UTC, in ISO 8601 format.
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
 if __name__ == "__main__":  # pragma: nocover
-    main(SamlIntegratorOperatorCharm)
+    # When profiling is off, the dispatch is only preceded by an environment lookup and a stat.
+    with profile_hook(profile_directory(Path(os.environ.get("JUJU_CHARM_DIR", ".")))):
+        main(SamlIntegratorOperatorCharm)
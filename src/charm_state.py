@@ -6,11 +6,34 @@
 """Module defining the CharmState class which represents the state of the SAML Integrator charm."""
 
 import itertools
-import urllib
+import logging
+import tempfile
+import threading
+import time
+import typing
+from functools import cached_property
+from pathlib import Path
 from typing import Optional
 
 import ops
-from pydantic import AnyHttpUrl, BaseModel, Field, ValidationError
+from pydantic import AnyHttpUrl, BaseModel, Field, ValidationError, field_validator
+
+from metadata_fetcher import (
+    FETCH_TIMEOUT,
+    MetadataCache,
+    MetadataDecodingError,
+    MetadataFetcher,
+    MetadataTooLargeError,
+    fetch_concurrently,
+    max_age,
+)
+from performance import PhaseTimer
+from resilience import RETRY_BUDGET, CircuitBreaker, CircuitOpenError, retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+CACHE_STORAGE_NAME = "metadata-cache"
+METADATA_RESOURCE_NAME = "metadata"
 
 
 class SamlIntegratorConfig(BaseModel):  # pylint: disable=too-few-public-methods
@@ -20,13 +43,36 @@ class SamlIntegratorConfig(BaseModel):  # pylint: disable=too-few-public-methods
         entity_id: entity ID.
         fingerprint: fingerprint to validate the signing certificate against.
         metadata: metadata.
+        metadata_max_size: maximum size of the metadata once decompressed, in MiB.
+        metadata_mirror_urls: URLs of the mirrors publishing the same metadata as metadata_url.
         metadata_url: metadata URL.
+        refresh_interval: minimum time between two metadata refreshes, in seconds.
+        stream_metadata: whether to spool the metadata to disk and parse it incrementally.
     """
 
     entity_id: str = Field(..., min_length=1)
     fingerprint: Optional[str] = None
     metadata: Optional[str] = None
+    metadata_max_size: int = Field(512, gt=0)
+    metadata_mirror_urls: list[AnyHttpUrl] = []
     metadata_url: Optional[AnyHttpUrl] = None
+    refresh_interval: int = Field(3600, ge=0)
+    stream_metadata: bool = False
+
+    @field_validator("metadata_mirror_urls", mode="before")
+    @classmethod
+    def split_urls(cls, value: typing.Any) -> typing.Any:
+        """Split the comma-separated URLs.
+
+        Args:
+            value: the configuration value.
+
+        Returns:
+            The list of URLs.
+        """
+        if isinstance(value, str):
+            return [url.strip() for url in value.split(",") if url.strip()]
+        return value
 
 
 class CharmConfigInvalidError(Exception):
@@ -42,26 +88,85 @@ class CharmConfigInvalidError(Exception):
         Args:
             msg (str): Explanation of the error.
         """
+        super().__init__(msg)
         self.msg = msg
 
 
+class MetadataUnavailableError(CharmConfigInvalidError):
+    """Exception raised when the metadata can't be retrieved and none was cached."""
+
+
+def _fetch_metadata_resource(charm: "ops.CharmBase") -> Optional[Path]:
+    """Get the file of the metadata resource.
+
+    Args:
+        charm: the charm.
+
+    Returns:
+        The path to the resource, or None if it isn't attached or is empty.
+    """
+    try:
+        path = charm.model.resources.fetch(METADATA_RESOURCE_NAME)
+    except (ops.ModelError, NameError):
+        return None
+    # Resources can't be detached from an application, so an empty file stands for none.
+    return path if path.stat().st_size else None
+
+
 class CharmState:
     """Represents the state of the SAML Integrator charm.
 
     Attrs:
+        bypass_cache: whether the metadata is fetched unconditionally, without falling back
+            to the cached copy nor skipping the URLs with an open circuit.
+        cache_directory: persistent directory for the charm caches, if any.
         entity_id: Entity ID for SAML.
         fingerprint: fingerprint to validate the signing certificate against.
         metadata: metadata.
+        metadata_age: age of the last-known-good metadata served in place of the metadata_url
+            one, in seconds, or None if the metadata was retrieved.
+        metadata_max_age: max-age of the metadata fetched from metadata_url, if any.
+        metadata_resource: the file of the metadata resource, if attached.
         metadata_url: URL for the SAML metadata.
+        metadata_urls: URLs to fetch the SAML metadata from, metadata_url and its mirrors.
+        metadata_validator: function raising CharmConfigInvalidError for invalid metadata,
+            used to pick the metadata among the responses of the mirrors.
+        refresh_interval: minimum time between two metadata refreshes, in seconds.
+        stream_metadata: whether to spool the metadata to disk and parse it incrementally.
     """
 
-    def __init__(self, *, saml_integrator_config: SamlIntegratorConfig):
+    def __init__(
+        self,
+        *,
+        saml_integrator_config: SamlIntegratorConfig,
+        cache_directory: Optional[Path] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        phase_timer: Optional[PhaseTimer] = None,
+        metadata_resource: Optional[Path] = None,
+        bypass_cache: bool = False,
+    ):
         """Initialize a new instance of the CharmState class.
 
         Args:
             saml_integrator_config: SAML Integrator configuration.
+            cache_directory: persistent directory for the charm caches, if any.
+            circuit_breaker: the circuit breaker to stop calling failing URLs with, if any.
+            phase_timer: the timer recording the bytes transferred and the decompression time.
+            metadata_resource: the file of the metadata resource, if attached.
+            bypass_cache: whether to fetch the metadata unconditionally, without falling back
+                to the cached copy nor skipping the URLs with an open circuit.
         """
         self._saml_integrator_config = saml_integrator_config
+        self.cache_directory = cache_directory
+        self.metadata_resource = metadata_resource
+        self.bypass_cache = bypass_cache
+        self._circuit_breaker = None if bypass_cache else circuit_breaker
+        self._phase_timer = phase_timer or PhaseTimer()
+        self._metadata_cache = MetadataCache(cache_directory) if cache_directory else None
+        self._metadata_fetcher = MetadataFetcher(self._metadata_cache, not bypass_cache)
+        self._spool_directory: Optional[tempfile.TemporaryDirectory] = None
+        self.metadata_validator: Optional[typing.Callable[[str | bytes | Path], None]] = None
+        self.metadata_age: Optional[float] = None
 
     @property
     def entity_id(self) -> str:
@@ -81,6 +186,15 @@ class CharmState:
         """
         return self._saml_integrator_config.fingerprint
 
+    @property
+    def stream_metadata(self) -> bool:
+        """Return stream_metadata config.
+
+        Returns:
+            bool: stream_metadata config.
+        """
+        return self._saml_integrator_config.stream_metadata
+
     @property
     def metadata_url(self) -> Optional[str]:
         """Return metadata_url config.
@@ -95,32 +209,253 @@ class CharmState:
         )
 
     @property
-    def metadata(self) -> str:
+    def metadata_urls(self) -> list[str]:
+        """Return the metadata_url config followed by the metadata_mirror_urls one.
+
+        Returns:
+            list: the metadata URLs, empty if metadata_url is not set.
+        """
+        if not self._saml_integrator_config.metadata_url:
+            return []
+        return [
+            str(self._saml_integrator_config.metadata_url),
+            *(str(url) for url in self._saml_integrator_config.metadata_mirror_urls),
+        ]
+
+    @property
+    def refresh_interval(self) -> int:
+        """Return refresh_interval config.
+
+        Returns:
+            int: refresh_interval config.
+        """
+        return self._saml_integrator_config.refresh_interval
+
+    @property
+    def metadata_max_age(self) -> Optional[int]:
+        """Return the Cache-Control max-age of the metadata fetched from metadata_url.
+
+        Returns:
+            int: the max-age in seconds, or None if the metadata wasn't fetched or has none.
+        """
+        return max_age(self._metadata_fetcher.cache_control)
+
+    def _spool_root(self) -> Path:
+        """Get the directory to spool the metadata to when the storage is not attached.
+
+        Returns:
+            The directory, created on first use and removed when the hook exits.
+        """
+        if not self._spool_directory:
+            self._spool_directory = tempfile.TemporaryDirectory(prefix="saml-integrator-")
+        return Path(self._spool_directory.name)
+
+    def _retrieve(
+        self,
+        url: str,
+        fetcher: MetadataFetcher,
+        deadline: float,
+        spool_name: str = "",
+        abandoned: Optional[threading.Event] = None,
+    ) -> bytes | Path:
+        """Fetch the metadata from a URL, spooling it to disk if stream_metadata is enabled.
+
+        The transient failures are retried until the deadline, unless the circuit breaker
+        stopped calling the URL after repeated failures.
+
+        Args:
+            url: the metadata URL.
+            fetcher: the fetcher to use.
+            deadline: the time.monotonic() value after which no attempt is to be made.
+            spool_name: the name of the spool subdirectory, distinct for each mirror.
+            abandoned: event set once the response is no longer wanted, the outcome then
+                being left out of the circuit breaker.
+
+        Returns:
+            The metadata contents, or the file holding them if spooled.
+
+        Raises:
+            MetadataUnavailableError: if the metadata can't be retrieved.
+        """
+
+        def fetch(timeout: float) -> bytes | Path:
+            """Make an attempt at fetching the metadata.
+
+            Args:
+                timeout: the request timeout, in seconds.
+
+            Returns:
+                The metadata contents, or the file holding them if spooled.
+            """
+            max_size = self._saml_integrator_config.metadata_max_size * 1024 * 1024
+            if not self._saml_integrator_config.stream_metadata:
+                return fetcher.fetch(url, timeout=timeout, max_size=max_size)
+            return fetcher.spool(
+                url, self._spool_root() / spool_name, max_size=max_size, timeout=timeout
+            )
+
+        try:
+            if self._circuit_breaker:
+                self._circuit_breaker.check(url)
+            metadata = retry_with_backoff(fetch, deadline, max_timeout=FETCH_TIMEOUT)
+        except CircuitOpenError as ex:
+            raise MetadataUnavailableError(str(ex)) from ex
+        except OSError as ex:
+            if self._circuit_breaker and not (abandoned and abandoned.is_set()):
+                self._circuit_breaker.record_failure(url)
+            raise MetadataUnavailableError(f"Error while retrieving data from {url}") from ex
+        except MetadataDecodingError as ex:
+            # A corrupted response isn't retried, the server being likely to send it again.
+            if self._circuit_breaker and not (abandoned and abandoned.is_set()):
+                self._circuit_breaker.record_failure(url)
+            raise MetadataUnavailableError(f"Invalid response from {url}: {ex}") from ex
+        if self._circuit_breaker and not (abandoned and abandoned.is_set()):
+            self._circuit_breaker.record_success(url)
+        return metadata
+
+    def _retrieve_from_mirrors(self, urls: list[str], deadline: float) -> bytes | Path:
+        """Fetch the metadata from all the mirrors concurrently, keeping the first valid one.
+
+        Args:
+            urls: the metadata URLs.
+            deadline: the time.monotonic() value after which no attempt is to be made.
+
+        Returns:
+            The first metadata fetched that the metadata validator accepts.
+
+        Raises:
+            MetadataUnavailableError: if none of the mirrors returned valid metadata.
+        """
+        if self._saml_integrator_config.stream_metadata:
+            # Created upfront, as the fetches run concurrently.
+            self._spool_root()
+        # Once a response is picked, the fetches still in progress neither update the circuit
+        # breaker, stored in the charm state, nor the cache.
+        abandoned = threading.Event()
+        fetchers = {
+            url: MetadataFetcher(self._metadata_cache, not self.bypass_cache, abandoned)
+            for url in urls
+        }
+        spool_names = {url: str(index) for index, url in enumerate(urls)}
+        for url, metadata in fetch_concurrently(
+            urls,
+            lambda url: self._retrieve(url, fetchers[url], deadline, spool_names[url], abandoned),
+        ):
+            try:
+                if self.metadata_validator:
+                    self.metadata_validator(metadata)
+            except CharmConfigInvalidError as ex:
+                logger.warning("Discarding the metadata from %s: %s", url, ex.msg)
+                continue
+            logger.info("Using the metadata from %s", url)
+            abandoned.set()
+            self._metadata_fetcher = fetchers[url]
+            return metadata
+        raise MetadataUnavailableError(
+            f"No valid metadata could be retrieved from {self.metadata_url} or its mirrors"
+        )
+
+    def keep_verified_metadata(self) -> None:
+        """Keep the metadata retrieved from metadata_url to be served if it becomes unreachable.
+
+        To be called once the metadata is verified, the responses being cached beforehand.
+        """
+        if (
+            self._metadata_cache
+            and self.metadata_age is None
+            and (entry := self._metadata_fetcher.cached_entry)
+        ):
+            self._metadata_cache.promote(entry)
+
+    def _last_known_good(self, urls: list[str]) -> Optional[bytes | Path]:
+        """Get the most recent valid metadata verified for any of the URLs.
+
+        Args:
+            urls: the metadata URLs.
+
+        Returns:
+            The verified metadata contents, or its file if stream_metadata is enabled, or None
+            if no valid metadata was verified.
+        """
+        if not self._metadata_cache or self.bypass_cache:
+            return None
+        entries = [entry for url in urls if (entry := self._metadata_cache.load_verified(url))]
+        for entry in sorted(entries, key=lambda entry: entry.fetched_at, reverse=True):
+            path = self._metadata_cache.verified_body_path(entry.url)
+            metadata = path if self._saml_integrator_config.stream_metadata else path.read_bytes()
+            try:
+                if self.metadata_validator:
+                    self.metadata_validator(metadata)
+            except CharmConfigInvalidError as ex:
+                logger.warning("Discarding the metadata cached for %s: %s", entry.url, ex.msg)
+                continue
+            self.metadata_age = max(time.time() - entry.fetched_at, 0.0)
+            return metadata
+        return None
+
+    @cached_property
+    def metadata(self) -> str | bytes | Path:
         """Return metadata config or metadata_url content.
 
+        The metadata_url is fetched at most once per charm instance. When stream_metadata is
+        enabled, the content is spooled to disk and the path to the file is returned instead.
+        When mirrors are configured, they are all fetched concurrently and the first response
+        accepted by the metadata validator is returned. If no metadata can be retrieved, the
+        last metadata verified and kept in the storage is returned and its age set in
+        metadata_age.
+        Without metadata_url nor metadata config, the path to the metadata resource is returned.
+
         Returns:
             str: metadata.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata is too large once decompressed.
+            MetadataUnavailableError: if the metadata can't be retrieved and none was cached.
         """
-        if self._saml_integrator_config.metadata_url:
-            try:
-                with urllib.request.urlopen(  # noqa: S310
-                    str(self._saml_integrator_config.metadata_url), timeout=10
-                ) as resource:  # nosec
-                    return resource.read()
-            except urllib.error.URLError as ex:
-                raise CharmConfigInvalidError(
-                    f"Error while retrieving data from {self.metadata_url}"
-                ) from ex
-        # Config will be identified as invalid is neither metadata_url nor metadata are defined.
-        assert self._saml_integrator_config.metadata  # nosec  # noqa: S101
-        return self._saml_integrator_config.metadata
+        if not (urls := self.metadata_urls):
+            if self._saml_integrator_config.metadata:
+                return self._saml_integrator_config.metadata
+            # Config will be identified as invalid if neither metadata_url, metadata nor the
+            # metadata resource are defined.
+            assert self.metadata_resource  # nosec  # noqa: S101
+            return self.metadata_resource
+        # All the URLs share the time budget, as the mirrors are fetched concurrently.
+        deadline = time.monotonic() + RETRY_BUDGET
+        try:
+            if len(urls) > 1:
+                metadata = self._retrieve_from_mirrors(urls, deadline)
+            else:
+                metadata = self._retrieve(urls[0], self._metadata_fetcher, deadline)
+        except MetadataTooLargeError as ex:
+            raise CharmConfigInvalidError(
+                f"Metadata from {self.metadata_url} exceeds metadata_max_size"
+            ) from ex
+        except MetadataUnavailableError as ex:
+            if (last_known_good := self._last_known_good(urls)) is None:
+                raise
+            logger.warning("%s, serving the metadata cached %ds ago", ex.msg, self.metadata_age)
+            return last_known_good
+        self._phase_timer.count("bytes-transferred", self._metadata_fetcher.bytes_transferred)
+        if self._metadata_fetcher.decompression_time:
+            self._phase_timer.record("decompress", self._metadata_fetcher.decompression_time)
+        return metadata
 
     @classmethod
-    def from_charm(cls, charm: "ops.CharmBase") -> "CharmState":
+    def from_charm(
+        cls,
+        charm: "ops.CharmBase",
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        phase_timer: Optional[PhaseTimer] = None,
+        bypass_cache: bool = False,
+    ) -> "CharmState":
         """Initialize a new instance of the CharmState class from the associated charm.
 
         Args:
             charm: The charm instance associated with this state.
+            circuit_breaker: the circuit breaker to stop calling failing URLs with, if any.
+            phase_timer: the timer recording the bytes transferred and the decompression time.
+            bypass_cache: whether to fetch the metadata unconditionally, without falling back
+                to the cached copy nor skipping the URLs with an open circuit.
 
         Return:
             The CharmState instance created by the provided charm.
@@ -128,17 +463,31 @@ class CharmState:
         Raises:
             CharmConfigInvalidError: if the charm configuration is invalid.
         """
+        metadata_resource = None
         try:
             # Incompatible with pydantic.AnyHttpUrl
             valid_config = SamlIntegratorConfig(**dict(charm.config.items()))  # type: ignore
+            # Fetching the resource takes a call to Juju, only made when it is to be used.
             if not valid_config.metadata_url and not valid_config.metadata:
-                raise CharmConfigInvalidError(
-                    "Either the metadata_url or the metadata need to be configured."
-                )
+                metadata_resource = _fetch_metadata_resource(charm)
+                if not metadata_resource:
+                    raise CharmConfigInvalidError(
+                        "Either the metadata_url, the metadata or the metadata resource need to "
+                        "be configured."
+                    )
         except ValidationError as exc:
             error_fields = set(
                 itertools.chain.from_iterable(error["loc"] for error in exc.errors())
             )
             error_field_str = " ".join(str(f) for f in error_fields)
             raise CharmConfigInvalidError(f"invalid configuration: {error_field_str}") from exc
-        return cls(saml_integrator_config=valid_config)
+        # The storage keeps the cache across pod restarts; without it, nothing is cached.
+        storage = next(iter(charm.model.storages[CACHE_STORAGE_NAME]), None)
+        return cls(
+            saml_integrator_config=valid_config,
+            cache_directory=storage.location if storage else None,
+            circuit_breaker=circuit_breaker,
+            phase_timer=phase_timer,
+            metadata_resource=metadata_resource,
+            bypass_cache=bypass_cache,
+        )
@@ -0,0 +1,261 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the EntityIndex class to persist the entities extracted from the metadata."""
+
+import contextlib
+import json
+import logging
+import sqlite3
+import time
+import typing
+from pathlib import Path
+from typing import Optional
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Number of metadata documents kept in the index; older ones are pruned.
+MAX_INDEXED_DOCUMENTS = 3
+
+# Version of the schema, stored as the user_version of the database. The index only holds
+# what can be extracted again from the metadata, so it is rebuilt on a version change.
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    digest TEXT PRIMARY KEY,
+    signing_fingerprints TEXT NOT NULL,
+    signed INTEGER,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entities (
+    digest TEXT NOT NULL REFERENCES documents (digest) ON DELETE CASCADE,
+    entity_id TEXT NOT NULL,
+    certificates TEXT NOT NULL,
+    endpoints TEXT NOT NULL,
+    sourceline INTEGER,
+    valid_until REAL,
+    cache_duration REAL,
+    certificates_expire_at REAL,
+    PRIMARY KEY (digest, entity_id)
+);
+"""
+
+
+class IndexedEndpoint(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent an endpoint as found in the metadata, before any validation.
+
+    Attrs:
+        name: Endpoint name.
+        url: Endpoint URL.
+        binding: Endpoint binding.
+        response_url: URL to address the response to.
+    """
+
+    name: str
+    url: Optional[str] = None
+    binding: Optional[str] = None
+    response_url: Optional[str] = None
+
+
+class IndexedEntity(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent the details extracted from an EntityDescriptor.
+
+    Attrs:
+        entity_id: the entityID.
+        certificates: the certificates, sorted.
+        endpoints: the SSO and SLO endpoints, in document order.
+        sourceline: the line of the EntityDescriptor start tag in the metadata.
+        valid_until: UNIX timestamp of the earliest validUntil of the entity and its
+            ancestors, if any.
+        cache_duration: the shortest cacheDuration of the entity and its ancestors in
+            seconds, if any.
+        certificates_expire_at: UNIX timestamp of the earliest expiry of the certificates,
+            if any.
+    """
+
+    entity_id: str
+    certificates: list[str]
+    endpoints: list[IndexedEndpoint]
+    sourceline: Optional[int] = None
+    valid_until: Optional[float] = None
+    cache_duration: Optional[float] = None
+    certificates_expire_at: Optional[float] = None
+
+
+class IndexedDocument(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent a metadata document present in the index.
+
+    Attrs:
+        digest: SHA-256 hex digest of the metadata bytes.
+        signing_fingerprints: the SHA-256 fingerprints of the signing certificates of the
+            metadata, in document order.
+        signed: whether the metadata has a Signature element, None if unknown as the document
+            was indexed without parsing it entirely.
+    """
+
+    digest: str
+    signing_fingerprints: list[str] = []
+    signed: Optional[bool] = None
+
+
+class EntityIndex:
+    """Persistent index of the entities of the metadata documents, keyed by document digest.
+
+    Only documents that passed validation are added, so that later hooks can look up an entity
+    instead of parsing the metadata again.
+    """
+
+    def __init__(self, path: Path):
+        """Initialize a new instance of the EntityIndex class.
+
+        Args:
+            path: path of the SQLite database.
+        """
+        self._path = path
+
+    @contextlib.contextmanager
+    def _connect(self) -> typing.Iterator[sqlite3.Connection]:
+        """Open a connection to the index, committing on success.
+
+        Yields:
+            The connection.
+        """
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.closing(sqlite3.connect(self._path)) as connection:
+            connection.execute("PRAGMA foreign_keys = ON")
+            if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                connection.executescript(
+                    "DROP TABLE IF EXISTS entities; DROP TABLE IF EXISTS documents;"
+                    f"PRAGMA user_version = {SCHEMA_VERSION};"
+                )
+            connection.executescript(SCHEMA)
+            with connection:
+                yield connection
+
+    def get_document(self, digest: str) -> Optional[IndexedDocument]:
+        """Get an indexed metadata document.
+
+        Args:
+            digest: the document digest.
+
+        Returns:
+            The indexed document, or None if the document is not indexed.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT signing_fingerprints, signed FROM documents WHERE digest = ?", (digest,)
+            ).fetchone()
+        if not row:
+            return None
+        return IndexedDocument(
+            digest=digest, signing_fingerprints=json.loads(row[0]), signed=row[1]
+        )
+
+    def add_document(
+        self,
+        document: IndexedDocument,
+        entities: typing.Iterable[IndexedEntity],
+    ) -> int:
+        """Index a metadata document and its entities, pruning the oldest documents.
+
+        Args:
+            document: the document.
+            entities: the entities extracted from the document.
+
+        Returns:
+            The number of entities indexed.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                (
+                    document.digest,
+                    json.dumps(document.signing_fingerprints),
+                    document.signed,
+                    time.time(),
+                ),
+            )
+            entity_count = connection.executemany(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        document.digest,
+                        entity.entity_id,
+                        json.dumps(entity.certificates),
+                        json.dumps([endpoint.model_dump() for endpoint in entity.endpoints]),
+                        entity.sourceline,
+                        entity.valid_until,
+                        entity.cache_duration,
+                        entity.certificates_expire_at,
+                    )
+                    for entity in entities
+                ),
+            ).rowcount
+            connection.execute(
+                "DELETE FROM documents WHERE digest NOT IN "
+                "(SELECT digest FROM documents ORDER BY indexed_at DESC, rowid DESC LIMIT ?)",
+                (MAX_INDEXED_DOCUMENTS,),
+            )
+        logger.info("Indexed %d entities of metadata document %s", entity_count, document.digest)
+        return entity_count
+
+    def get_entity(self, digest: str, entity_id: str) -> Optional[IndexedEntity]:
+        """Look up an entity of an indexed document.
+
+        Args:
+            digest: the document digest.
+            entity_id: the entityID.
+
+        Returns:
+            The indexed entity, or None if the document doesn't contain it.
+        """
+        return self.get_entities(digest, [entity_id]).get(entity_id)
+
+    def get_entities(
+        self, digest: str, entity_ids: typing.Collection[str]
+    ) -> dict[str, IndexedEntity]:
+        """Look up several entities of an indexed document in a single query.
+
+        Args:
+            digest: the document digest.
+            entity_ids: the entityIDs.
+
+        Returns:
+            The indexed entities the document contains, by entityID.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT entity_id, certificates, endpoints, sourceline, valid_until, "
+                "cache_duration, certificates_expire_at FROM entities "
+                "WHERE digest = ? AND entity_id IN (SELECT value FROM json_each(?))",
+                (digest, json.dumps(list(entity_ids))),
+            ).fetchall()
+        return {
+            row[0]: IndexedEntity(
+                entity_id=row[0],
+                certificates=json.loads(row[1]),
+                endpoints=json.loads(row[2]),
+                sourceline=row[3],
+                valid_until=row[4],
+                cache_duration=row[5],
+                certificates_expire_at=row[6],
+            )
+            for row in rows
+        }
+
+    def get_entity_ids(self, digest: str) -> list[str]:
+        """List the entities of an indexed document.
+
+        Args:
+            digest: the document digest.
+
+        Returns:
+            The sorted entityIDs.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT entity_id FROM entities WHERE digest = ? ORDER BY entity_id", (digest,)
+            ).fetchall()
+        return [row[0] for row in rows]
@@ -0,0 +1,485 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the MetadataDocument class wrapping a single SAML metadata document."""
+
+import base64
+import binascii
+import copy
+import datetime
+import hashlib
+import io
+import logging
+import mmap
+import re
+import typing
+from functools import cached_property
+from pathlib import Path
+from typing import Optional
+
+# Bandit classifies this import as vulnerable. For more details, see
+# https://github.com/PyCQA/bandit/issues/767
+from cryptography import x509
+from lxml import etree  # nosec
+
+from charm_state import CharmConfigInvalidError
+from entity_index import IndexedEndpoint, IndexedEntity
+from refresh import Validity, earliest
+
+logger = logging.getLogger(__name__)
+
+NAMESPACES = {
+    "md": "urn:oasis:names:tc:SAML:2.0:metadata",
+    "ds": "http://www.w3.org/2000/09/xmldsig#",
+}
+ENTITY_DESCRIPTOR_TAG = f"{{{NAMESPACES['md']}}}EntityDescriptor"
+ENTITIES_DESCRIPTOR_TAG = f"{{{NAMESPACES['md']}}}EntitiesDescriptor"
+SIGNATURE_TAG = f"{{{NAMESPACES['ds']}}}Signature"
+X509_CERTIFICATE_TAG = f"{{{NAMESPACES['ds']}}}X509Certificate"
+VALID_UNTIL_ATTRIBUTE = "validUntil"
+CACHE_DURATION_ATTRIBUTE = "cacheDuration"
+
+# xs:duration, the years and months being counted as 365 and 30 days.
+DURATION_PATTERN = re.compile(
+    r"P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?(?:(?P<days>\d+)D)?"
+    r"(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?"
+)
+DURATION_UNITS = {
+    "years": 365 * 86400,
+    "months": 30 * 86400,
+    "days": 86400,
+    "hours": 3600,
+    "minutes": 60,
+    "seconds": 1,
+}
+
+# Parser options shared by the tree and incremental parsers: the metadata is untrusted, so
+# entities are never expanded nor fetched, and the IDs are not hashed as nothing looks them up.
+PARSER_OPTIONS = {"resolve_entities": False, "no_network": True, "collect_ids": False}
+PARSER = etree.XMLParser(**PARSER_OPTIONS)  # nosec
+
+# The XPath expressions are compiled once and only walk the paths allowed by the metadata
+# schema instead of scanning all the descendants. Aggregates are looked into up to three
+# levels of nested EntitiesDescriptor elements.
+_ENTITY_DESCRIPTOR_PATHS = (
+    "/md:EntityDescriptor",
+    "/md:EntitiesDescriptor/md:EntityDescriptor",
+    "/md:EntitiesDescriptor/md:EntitiesDescriptor/md:EntityDescriptor",
+    "/md:EntitiesDescriptor/md:EntitiesDescriptor/md:EntitiesDescriptor/md:EntityDescriptor",
+)
+# A Signature can be a child of the root element, of an entity or of a nested aggregate; the
+# first one found is verified, so that a signed element nested in an aggregate isn't missed.
+_SIGNED_ELEMENT_PATHS = (
+    "/*",
+    *_ENTITY_DESCRIPTOR_PATHS[1:],
+    "/md:EntitiesDescriptor/md:EntitiesDescriptor",
+    "/md:EntitiesDescriptor/md:EntitiesDescriptor/md:EntitiesDescriptor",
+)
+ENTITY_XPATH = etree.XPath(
+    " | ".join(f"{path}[@entityID = $entity_id]" for path in _ENTITY_DESCRIPTOR_PATHS),
+    namespaces=NAMESPACES,
+)
+DOCUMENT_DETAILS_XPATH = etree.XPath(
+    " | ".join(
+        [
+            *(f"{path}/ds:Signature" for path in _SIGNED_ELEMENT_PATHS),
+            *(
+                f"{path}/md:*/md:KeyDescriptor[@use = 'signing']"
+                "/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
+                for path in _ENTITY_DESCRIPTOR_PATHS
+            ),
+        ]
+    ),
+    namespaces=NAMESPACES,
+)
+ENTITY_DETAILS_XPATH = etree.XPath(
+    "md:*/md:KeyDescriptor/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
+    " | md:*/md:SingleSignOnService | md:*/md:SingleLogoutService",
+    namespaces=NAMESPACES,
+)
+
+
+class MetadataDocument:
+    """A SAML metadata document, hashed and parsed at most once.
+
+    The document is either held in memory or, when spooled to disk, read from a file.
+
+    Attrs:
+        content: the raw metadata bytes.
+        size: the size of the metadata, in bytes.
+        path: the file holding the metadata, if spooled to disk.
+        digest: SHA-256 hex digest of the metadata bytes.
+        tree: the element tree for the metadata.
+        signature: the Signature element in the metadata.
+        signing_certificate: the first signing certificate.
+        signing_certificates: the signing certificates by SHA-256 fingerprint.
+        signed: whether the metadata has a Signature element.
+    """
+
+    def __init__(self, content: str | bytes | Path):
+        """Initialize a new instance of the MetadataDocument class.
+
+        Args:
+            content: the metadata contents as fetched or configured, or the file holding them.
+        """
+        self.path = content if isinstance(content, Path) else None
+        self._content = content.encode("utf-8") if isinstance(content, str) else content
+
+    @property
+    def content(self) -> bytes:
+        """Return the raw metadata bytes, reading them from disk if spooled.
+
+        Returns:
+            The metadata bytes.
+        """
+        return self.path.read_bytes() if self.path else typing.cast(bytes, self._content)
+
+    @property
+    def size(self) -> int:
+        """Return the size of the metadata, without reading it if spooled.
+
+        Returns:
+            The number of bytes.
+        """
+        return self.path.stat().st_size if self.path else len(typing.cast(bytes, self._content))
+
+    @cached_property
+    def digest(self) -> str:
+        """Return the SHA-256 digest of the metadata bytes.
+
+        Returns:
+            The hex digest.
+        """
+        if not self.path or not self.size:
+            return hashlib.sha256(self.content).hexdigest()
+        # The file is hashed through a memory map, without copying it into the process.
+        with (
+            self.path.open("rb") as metadata_file,
+            mmap.mmap(metadata_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+        ):
+            return hashlib.sha256(mapped).hexdigest()
+
+    @cached_property
+    def tree(self) -> "etree.ElementTree":
+        """Parse the metadata contents.
+
+        Returns:
+            The metadata as an XML tree.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata can't be parsed.
+        """
+        try:
+            if self.path:
+                tree = etree.parse(str(self.path), PARSER).getroot()  # nosec
+            else:
+                tree = etree.fromstring(self.content, PARSER)  # nosec
+        except etree.XMLSyntaxError as ex:
+            raise CharmConfigInvalidError("Metadata can't be parsed") from ex
+        logger.debug("Parsed metadata document %s", self.digest)
+        return tree
+
+    @cached_property
+    def signed(self) -> bool:
+        """Check if the metadata has a Signature element, without parsing it entirely.
+
+        When the document hasn't been parsed yet, it is read incrementally, discarding every
+        element once read, until a Signature child of the root element, of an entity or of an
+        aggregate is found.
+
+        Returns:
+            True if the metadata is signed.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata can't be parsed.
+        """
+        if "tree" in self.__dict__:
+            return self.signature is not None
+        source = str(self.path) if self.path else io.BytesIO(self.content)
+        try:
+            for event, element in etree.iterparse(  # nosec
+                source, events=("start", "end"), **PARSER_OPTIONS
+            ):
+                if (parent := element.getparent()) is None:
+                    continue
+                if event == "start":
+                    if element.tag == SIGNATURE_TAG and (
+                        parent.getparent() is None
+                        or parent.tag in (ENTITY_DESCRIPTOR_TAG, ENTITIES_DESCRIPTOR_TAG)
+                    ):
+                        return True
+                    continue
+                element.clear(keep_tail=False)
+                while element.getprevious() is not None:
+                    del parent[0]
+        except etree.XMLSyntaxError as ex:
+            raise CharmConfigInvalidError("Metadata can't be parsed") from ex
+        return False
+
+    def iter_entities(self) -> typing.Iterator["etree.ElementTree"]:
+        """Iterate over the entities of the metadata without building the whole tree.
+
+        The document is parsed incrementally and every EntityDescriptor is discarded as soon as
+        the caller moves on to the next one, so that memory usage doesn't grow with the number
+        of entities.
+
+        Yields:
+            Each EntityDescriptor element, only valid until the next one is yielded.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata can't be parsed.
+        """
+        source = str(self.path) if self.path else io.BytesIO(self.content)
+        try:
+            for _, element in etree.iterparse(  # nosec
+                source, events=("end",), tag=ENTITY_DESCRIPTOR_TAG, **PARSER_OPTIONS
+            ):
+                yield element
+                element.clear(keep_tail=False)
+                # Drop the already processed siblings still referenced by the parent.
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        except etree.XMLSyntaxError as ex:
+            raise CharmConfigInvalidError("Metadata can't be parsed") from ex
+
+    def extract_entity(self, entity_id: str) -> Optional["etree.ElementTree"]:
+        """Extract a single entity from the metadata without building the whole tree.
+
+        Args:
+            entity_id: the entityID of the EntityDescriptor to extract.
+
+        Returns:
+            A standalone copy of the EntityDescriptor element, or None if not found.
+        """
+        return self.extract_entities([entity_id]).get(entity_id)
+
+    def extract_entities(
+        self, entity_ids: typing.Collection[str]
+    ) -> dict[str, "etree.ElementTree"]:
+        """Extract several entities in a single pass, without building the whole tree.
+
+        The pass stops as soon as all the entities have been found.
+
+        Args:
+            entity_ids: the entityIDs of the EntityDescriptors to extract.
+
+        Returns:
+            A standalone copy of each EntityDescriptor element found, by entityID.
+        """
+        wanted = set(entity_ids)
+        entities: dict[str, etree.ElementTree] = {}
+        for element in self.iter_entities():
+            entity_id = element.get("entityID")
+            if entity_id in wanted and entity_id not in entities:
+                entities[entity_id] = copy.deepcopy(element)
+                # The copy is detached from the EntitiesDescriptor elements bounding its validity.
+                _set_validity(entities[entity_id], element_validity(element))
+                if len(entities) == len(wanted):
+                    break
+        return entities
+
+    @cached_property
+    def _details(self) -> tuple[dict[str, str], Optional["etree.ElementTree"]]:
+        """Find the signing certificates and the Signature element in a single pass.
+
+        Returns:
+            The signing certificates by SHA-256 fingerprint, in document order, and the
+            document Signature element, if any.
+        """
+        signing_certificates: dict[str, str] = {}
+        signature = None
+        for element in DOCUMENT_DETAILS_XPATH(self.tree):
+            if element.tag == SIGNATURE_TAG:
+                if signature is None:
+                    signature = element
+            elif element.text:
+                try:
+                    fingerprint = certificate_fingerprint(element.text)
+                except binascii.Error:
+                    # A certificate that can't be decoded can't verify the signature either.
+                    logger.warning("Ignoring a signing certificate that is not valid base64")
+                    continue
+                signing_certificates.setdefault(fingerprint, element.text)
+        return signing_certificates, signature
+
+    @property
+    def signing_certificates(self) -> dict[str, str]:
+        """Return the signing certificates of the metadata by SHA-256 fingerprint."""
+        return self._details[0]
+
+    @property
+    def signing_certificate(self) -> str | None:
+        """Return the first signing certificate of the metadata, if any."""
+        return next(iter(self.signing_certificates.values()), None)
+
+    @property
+    def signature(self) -> Optional["etree.ElementTree"]:
+        """Return the Signature element of the metadata, if any."""
+        return self._details[1]
+
+
+def certificate_fingerprint(certificate: str) -> str:
+    """Compute the fingerprint of a certificate.
+
+    Args:
+        certificate: the base64 DER certificate, as found in the metadata.
+
+    Returns:
+        The lowercase hex SHA-256 digest of the DER certificate.
+
+    Raises:
+        binascii.Error: if the certificate is not valid base64.
+    """
+    return hashlib.sha256(base64.b64decode(certificate)).hexdigest()
+
+
+def find_entity(tree: "etree.ElementTree", entity_id: str) -> Optional["etree.ElementTree"]:
+    """Find an EntityDescriptor in a metadata tree.
+
+    Args:
+        tree: the metadata tree, or a standalone EntityDescriptor.
+        entity_id: the entityID to look for.
+
+    Returns:
+        The EntityDescriptor element, or None if not found.
+    """
+    elements = ENTITY_XPATH(tree, entity_id=entity_id)
+    return elements[0] if elements else None
+
+
+def extract_entity_details(element: "etree.ElementTree") -> IndexedEntity:
+    """Extract the certificates and endpoints of an EntityDescriptor in a single pass.
+
+    Args:
+        element: the EntityDescriptor element.
+
+    Returns:
+        The certificates and endpoints of the entity.
+    """
+    certificates = []
+    endpoints = []
+    for child in ENTITY_DETAILS_XPATH(element):
+        if child.tag == X509_CERTIFICATE_TAG:
+            if child.text:
+                certificates.append(child.text)
+            continue
+        endpoints.append(
+            IndexedEndpoint(
+                name=etree.QName(child).localname,
+                url=child.get("Location"),
+                binding=child.get("Binding"),
+                response_url=child.get("ResponseLocation"),
+            )
+        )
+    validity = element_validity(element)
+    return IndexedEntity(
+        entity_id=element.get("entityID"),
+        certificates=sorted(certificates),
+        endpoints=endpoints,
+        sourceline=element.sourceline,
+        valid_until=validity.valid_until,
+        cache_duration=validity.cache_duration,
+        certificates_expire_at=certificates_expiry(certificates),
+    )
+
+
+def parse_datetime(value: str) -> Optional[float]:
+    """Parse an xs:dateTime, such as a validUntil attribute.
+
+    Args:
+        value: the date and time, assumed to be in UTC if it has no timezone.
+
+    Returns:
+        The UNIX timestamp, or None if the value can't be parsed.
+    """
+    try:
+        parsed = datetime.datetime.fromisoformat(re.sub(r"Z$", "+00:00", value.strip()))
+    except ValueError:
+        logger.warning("Ignoring the invalid date and time %r", value)
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse an xs:duration, such as a cacheDuration attribute.
+
+    Args:
+        value: the duration.
+
+    Returns:
+        The duration in seconds, or None if the value can't be parsed.
+    """
+    match = DURATION_PATTERN.fullmatch(value.strip())
+    if not match or not any(match.groupdict().values()) or value.strip().endswith("T"):
+        logger.warning("Ignoring the invalid duration %r", value)
+        return None
+    return sum(
+        float(amount) * DURATION_UNITS[unit]
+        for unit, amount in match.groupdict().items()
+        if amount
+    )
+
+
+def element_validity(element: "etree.ElementTree") -> Validity:
+    """Get the validity of an element, bounded by the validity of its ancestors.
+
+    Args:
+        element: the element, such as an EntityDescriptor.
+
+    Returns:
+        The earliest validUntil and the shortest cacheDuration of the element and its
+        ancestors, without certificate expiry.
+    """
+    elements = [element, *element.iterancestors()]
+    return Validity(
+        valid_until=earliest(
+            parse_datetime(value)
+            for value in (item.get(VALID_UNTIL_ATTRIBUTE) for item in elements)
+            if value
+        ),
+        cache_duration=earliest(
+            parse_duration(value)
+            for value in (item.get(CACHE_DURATION_ATTRIBUTE) for item in elements)
+            if value
+        ),
+    )
+
+
+def _set_validity(element: "etree.ElementTree", validity: Validity) -> None:
+    """Set the validity attributes of an element.
+
+    Args:
+        element: the element.
+        validity: the validity, its unset values leaving the attributes untouched.
+    """
+    if validity.valid_until is not None:
+        element.set(
+            VALID_UNTIL_ATTRIBUTE,
+            datetime.datetime.fromtimestamp(
+                validity.valid_until, datetime.timezone.utc
+            ).isoformat(),
+        )
+    if validity.cache_duration is not None:
+        element.set(CACHE_DURATION_ATTRIBUTE, f"PT{validity.cache_duration:g}S")
+
+
+def certificates_expiry(certificates: typing.Iterable[str]) -> Optional[float]:
+    """Find when the first of some certificates expires.
+
+    Args:
+        certificates: the base64 DER certificates, as found in the metadata.
+
+    Returns:
+        The UNIX timestamp of the earliest expiry, None if no certificate can be loaded.
+    """
+    expiries = []
+    for certificate in certificates:
+        try:
+            loaded = x509.load_der_x509_certificate(base64.b64decode(certificate))
+        except (binascii.Error, ValueError):
+            logger.debug("Ignoring the expiry of a certificate that can't be loaded")
+            continue
+        expiries.append(loaded.not_valid_after_utc.timestamp())
+    return min(expiries, default=None)
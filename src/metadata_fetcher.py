@@ -0,0 +1,640 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the MetadataFetcher class to retrieve the metadata from the metadata URL."""
+
+import contextlib
+import hashlib
+import http.client
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+import zlib
+from email.message import Message
+from pathlib import Path
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+FETCH_TIMEOUT = 10
+CHUNK_SIZE = 1024 * 1024
+# Metadata compresses well, being verbose XML with repeated namespaces and certificates.
+ACCEPT_ENCODING = "gzip, deflate"
+CONTENT_ENCODINGS = ("gzip", "x-gzip", "deflate")
+MAX_AGE_PATTERN = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)\"?\s*(?:,|$)", re.IGNORECASE)
+
+T = typing.TypeVar("T")
+
+
+class CacheEntry(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent the HTTP validators stored along with a cached metadata body.
+
+    Attrs:
+        url: URL the body was fetched from.
+        etag: value of the ETag response header.
+        last_modified: value of the Last-Modified response header.
+        cache_control: value of the Cache-Control response header.
+        fetched_at: UNIX timestamp of the last successful fetch or revalidation.
+    """
+
+    url: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    cache_control: Optional[str] = None
+    fetched_at: float = 0.0
+
+
+class MetadataTooLargeError(Exception):
+    """Exception raised when the metadata exceeds the maximum size allowed."""
+
+
+class MetadataDecodingError(Exception):
+    """Exception raised when the compressed metadata can't be decompressed."""
+
+
+class MetadataTruncatedError(ConnectionError):
+    """Exception raised when the connection closes before the whole metadata is received.
+
+    As a ConnectionError, the fetch is retried like any other transient failure.
+    """
+
+
+class MetadataCache:
+    """On-disk cache for the metadata fetched from a URL.
+
+    Each URL is stored as a body file and a JSON file holding its CacheEntry.
+    """
+
+    def __init__(self, directory: Path):
+        """Initialize a new instance of the MetadataCache class.
+
+        Args:
+            directory: directory where the cached files are kept.
+        """
+        self.directory = directory
+
+    def _path(self, url: str, suffix: str) -> Path:
+        """Get the path of a cache file for a URL.
+
+        Args:
+            url: the metadata URL.
+            suffix: the file suffix.
+
+        Returns:
+            The path of the cache file.
+        """
+        return self.directory / f"{hashlib.sha256(url.encode()).hexdigest()}{suffix}"
+
+    def body_path(self, url: str) -> Path:
+        """Get the path of the cached body for a URL.
+
+        Args:
+            url: the metadata URL.
+
+        Returns:
+            The path of the body file.
+        """
+        return self._path(url, ".xml")
+
+    def verified_body_path(self, url: str) -> Path:
+        """Get the path of the last verified body for a URL.
+
+        Args:
+            url: the metadata URL.
+
+        Returns:
+            The path of the verified body file.
+        """
+        return self._path(url, ".verified.xml")
+
+    def _load(self, url: str, entry_path: Path, body_path: Path) -> Optional[CacheEntry]:
+        """Load a cache entry, checking that it belongs to the URL and has a body.
+
+        Args:
+            url: the metadata URL.
+            entry_path: the path of the JSON file holding the entry.
+            body_path: the path of the body file.
+
+        Returns:
+            The cache entry, or None if no usable body is cached.
+        """
+        try:
+            entry = CacheEntry.model_validate_json(entry_path.read_text())
+        except (OSError, ValidationError):
+            return None
+        return entry if entry.url == url and body_path.is_file() else None
+
+    def load(self, url: str) -> Optional[CacheEntry]:
+        """Load the cache entry for a URL.
+
+        Args:
+            url: the metadata URL.
+
+        Returns:
+            The cache entry, or None if no usable body is cached.
+        """
+        return self._load(url, self._path(url, ".json"), self.body_path(url))
+
+    def load_verified(self, url: str) -> Optional[CacheEntry]:
+        """Load the cache entry of the last verified metadata for a URL.
+
+        Args:
+            url: the metadata URL.
+
+        Returns:
+            The cache entry, or None if no metadata from the URL was verified.
+        """
+        return self._load(url, self._path(url, ".verified.json"), self.verified_body_path(url))
+
+    def store(self, entry: CacheEntry, body: Optional[bytes] = None) -> None:
+        """Store the metadata for a URL, replacing any previous entry atomically.
+
+        Args:
+            entry: the cache entry.
+            body: the metadata body; the cached body is kept if None.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if body is not None:
+            _write_atomically(self.body_path(entry.url), body)
+        _write_atomically(self._path(entry.url, ".json"), entry.model_dump_json().encode())
+
+    def promote(self, entry: CacheEntry) -> None:
+        """Keep the cached metadata for a URL as the last verified one.
+
+        The responses are cached before being validated, so only the verified copy is served
+        when the URL is unreachable.
+
+        Args:
+            entry: the cache entry of the metadata verified.
+        """
+        verified_path = self.verified_body_path(entry.url)
+        tmp_path = verified_path.with_name(f".{verified_path.name}.tmp")
+        tmp_path.unlink(missing_ok=True)
+        # The cached bodies are replaced rather than written to, so a link is as good as a copy.
+        os.link(self.body_path(entry.url), tmp_path)
+        os.replace(tmp_path, verified_path)
+        _write_atomically(
+            self._path(entry.url, ".verified.json"), entry.model_dump_json().encode()
+        )
+
+
+class _DecodingReader:
+    """Read a response body, decompressing it in chunks according to its Content-Encoding.
+
+    Attrs:
+        bytes_read: number of bytes read from the response, as transferred.
+        decompression_time: time spent decompressing, in seconds.
+    """
+
+    def __init__(
+        self,
+        resource: typing.BinaryIO,
+        content_encoding: Optional[str],
+        content_length: Optional[int] = None,
+    ):
+        """Initialize a new instance of the _DecodingReader class.
+
+        Args:
+            resource: the response to read from.
+            content_encoding: the Content-Encoding header of the response, if any.
+            content_length: the Content-Length header of the response, if any.
+        """
+        self._resource = resource
+        self._encoding = content_encoding
+        self._content_length = content_length
+        # Both the gzip and the zlib headers are detected, zlib being what deflate stands for.
+        self._decompressor = (
+            zlib.decompressobj(zlib.MAX_WBITS | 32)
+            if content_encoding in CONTENT_ENCODINGS
+            else None
+        )
+        self._decompressed = False
+        self.bytes_read = 0
+        self.decompression_time = 0.0
+
+    def _decompress(self, data: bytes, max_length: int) -> bytes:
+        """Decompress a chunk of the body, falling back to raw deflate.
+
+        Some servers send deflate responses as raw deflate streams, without the zlib header,
+        which is only detected on the first chunk.
+
+        Args:
+            data: the compressed chunk.
+            max_length: maximum number of bytes to return, unbounded if 0.
+
+        Returns:
+            The decompressed bytes.
+
+        Raises:
+            error: if the chunk can't be decompressed, even as raw deflate.
+        """
+        assert self._decompressor  # nosec  # noqa: S101
+        try:
+            chunk = self._decompressor.decompress(data, max_length)
+        except zlib.error:
+            if self._encoding != "deflate" or self._decompressed:
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            chunk = self._decompressor.decompress(data, max_length)
+        self._decompressed = True
+        return chunk
+
+    def _read_raw(self, size: Optional[int]) -> bytes:
+        """Read from the response as is.
+
+        Args:
+            size: maximum number of bytes to read, all of them if None.
+
+        Returns:
+            The bytes read, empty at the end of the response.
+
+        Raises:
+            MetadataTruncatedError: if the connection closed before the end of the response.
+        """
+        try:
+            data = self._resource.read() if size is None else self._resource.read(size)
+        except http.client.IncompleteRead as ex:
+            self.bytes_read += len(ex.partial)
+            raise MetadataTruncatedError(
+                f"Response truncated after {self.bytes_read} bytes"
+            ) from ex
+        self.bytes_read += len(data)
+        # Reading a bounded size returns the bytes received before the connection closed
+        # rather than failing, which only the compressed bodies would otherwise detect.
+        if (
+            not self._decompressor
+            and self._content_length is not None
+            and (size is None or len(data) < size)
+            and self.bytes_read < self._content_length
+        ):
+            raise MetadataTruncatedError(
+                f"Response truncated after {self.bytes_read} of {self._content_length} bytes"
+            )
+        return data
+
+    def read(self, size: Optional[int] = None) -> bytes:
+        """Read the decompressed body.
+
+        The output of the decompressor is bounded by the size requested, so that a small
+        response expanding to a huge body is never fully held in memory.
+
+        Args:
+            size: maximum number of bytes to return, all of them if None.
+
+        Returns:
+            The bytes read, fewer than requested only at the end of the body.
+
+        Raises:
+            MetadataDecodingError: if the compressed body is truncated or corrupted.
+            MetadataTruncatedError: if the connection closed before the end of the body.
+        """
+        if not self._decompressor:
+            return self._read_raw(size)
+        chunks = []
+        remaining = size
+        while remaining != 0 and not self._decompressor.eof:
+            data = self._decompressor.unconsumed_tail or self._read_raw(CHUNK_SIZE)
+            started = time.perf_counter()
+            try:
+                # An empty input still flushes the output held back by the previous bound.
+                chunk = self._decompress(data, remaining or 0)
+            except zlib.error as ex:
+                raise MetadataDecodingError(f"Invalid {self._encoding} response: {ex}") from ex
+            finally:
+                self.decompression_time += time.perf_counter() - started
+            if not data and not chunk and not self._decompressor.eof:
+                raise MetadataDecodingError(f"Truncated {self._encoding} response")
+            chunks.append(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+        return b"".join(chunks)
+
+
+def _read_bounded(reader: _DecodingReader, max_size: Optional[int]) -> bytes:
+    """Read a whole response body.
+
+    Args:
+        reader: the reader to read from.
+        max_size: maximum number of bytes to accept, if any.
+
+    Returns:
+        The body.
+
+    Raises:
+        MetadataTooLargeError: if the body is larger than max_size.
+    """
+    if max_size is None:
+        return reader.read()
+    content = reader.read(max_size + 1)
+    if len(content) > max_size:
+        raise MetadataTooLargeError(f"Metadata larger than {max_size} bytes")
+    return content
+
+
+def _write_atomically(path: Path, content: bytes) -> None:
+    """Write a file so that readers never observe partial contents.
+
+    Args:
+        path: the destination path.
+        content: the file contents.
+    """
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+
+
+def _spool_atomically(resource: _DecodingReader, path: Path, max_size: int) -> None:
+    """Copy a response to a file in chunks, so that it is never fully held in memory.
+
+    Args:
+        resource: the response to read from.
+        path: the destination path.
+        max_size: maximum number of bytes to accept.
+
+    Raises:
+        MetadataTooLargeError: if the response is larger than max_size.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    size = 0
+    try:
+        with tmp_path.open("wb") as spool:
+            while chunk := resource.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise MetadataTooLargeError(f"Metadata larger than {max_size} bytes")
+                spool.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def max_age(cache_control: Optional[str]) -> Optional[int]:
+    """Get the max-age directive of a Cache-Control header.
+
+    Args:
+        cache_control: the header value, if any.
+
+    Returns:
+        The max-age in seconds, or None if the directive is absent.
+    """
+    match = MAX_AGE_PATTERN.search(cache_control or "")
+    return int(match.group(1)) if match else None
+
+
+def fetch_concurrently(
+    urls: typing.Sequence[str], fetch: typing.Callable[[str], T]
+) -> typing.Iterator[tuple[str, T]]:
+    """Fetch from several URLs concurrently, yielding the responses as they arrive.
+
+    Each fetch runs in a daemon thread: once the caller stops iterating, the fetches still in
+    progress are abandoned instead of being waited for, and die with the hook process.
+
+    Args:
+        urls: the URLs.
+        fetch: the function fetching from a URL, called from a separate thread for each URL.
+
+    Yields:
+        Each URL along with its response, fastest first; the failed fetches are logged and
+        skipped.
+    """
+    results: queue.SimpleQueue = queue.SimpleQueue()
+
+    def run(url: str) -> None:
+        """Fetch from a URL, reporting the outcome.
+
+        Args:
+            url: the URL.
+        """
+        # Every outcome is reported, as the caller waits for one per URL.
+        try:
+            results.put((url, fetch(url), None))
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            results.put((url, None, ex))
+
+    for url in urls:
+        threading.Thread(target=run, args=(url,), name=f"fetch {url}", daemon=True).start()
+    for _ in urls:
+        url, response, error = results.get()
+        if error is not None:
+            logger.warning("Error while retrieving the metadata from %s: %s", url, error)
+            continue
+        yield url, response
+
+
+class MetadataFetcher:
+    """Fetch the metadata, revalidating a cached copy with conditional requests.
+
+    The metadata is requested compressed and decompressed as it is read.
+
+    Attrs:
+        cache_control: the Cache-Control header of the last response, if any.
+        cached_entry: the cache entry of the metadata last returned, or None if not cached.
+        bytes_transferred: number of bytes of the responses read, before decompression.
+        decompression_time: time spent decompressing the responses, in seconds.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[MetadataCache] = None,
+        conditional: bool = True,
+        abandoned: Optional[threading.Event] = None,
+    ):
+        """Initialize a new instance of the MetadataFetcher class.
+
+        Args:
+            cache: the cache to revalidate against, if any.
+            conditional: whether to revalidate the cached copy rather than fetch the metadata
+                unconditionally; the cache is updated with the response either way.
+            abandoned: event set once the response is no longer wanted, the cache being left
+                untouched from then on.
+        """
+        self._cache = cache
+        self._conditional = conditional
+        self._abandoned = abandoned
+        self.cache_control: Optional[str] = None
+        self.cached_entry: Optional[CacheEntry] = None
+        self.bytes_transferred = 0
+        self.decompression_time = 0.0
+
+    def _request(self, url: str, entry: Optional[CacheEntry]) -> urllib.request.Request:
+        """Build the request for a URL, conditional if a cached copy exists.
+
+        Args:
+            url: the metadata URL.
+            entry: the cache entry for the URL, if any.
+
+        Returns:
+            The request.
+        """
+        request = urllib.request.Request(url)  # noqa: S310 (the URL is validated as HTTP)
+        request.add_header("Accept-Encoding", ACCEPT_ENCODING)
+        if entry and entry.etag:
+            request.add_header("If-None-Match", entry.etag)
+        if entry and entry.last_modified:
+            request.add_header("If-Modified-Since", entry.last_modified)
+        return request
+
+    def _revalidate(self, entry: CacheEntry, headers: Message) -> None:
+        """Refresh a cache entry after a 304 Not Modified reply.
+
+        Args:
+            entry: the cache entry.
+            headers: the headers of the 304 reply, which supersede the stored ones.
+        """
+        logger.info("Metadata from %s not modified, using the cached copy", entry.url)
+        assert self._cache  # nosec  # noqa: S101
+        self.cache_control = headers.get("Cache-Control", entry.cache_control)
+        if self._abandoned and self._abandoned.is_set():
+            return
+        self.cached_entry = entry.model_copy(
+            update={
+                "etag": headers.get("ETag", entry.etag),
+                "cache_control": headers.get("Cache-Control", entry.cache_control),
+                "fetched_at": time.time(),
+            }
+        )
+        self._cache.store(self.cached_entry)
+
+    def _cache_entry(self, url: str, headers: Message) -> Optional[CacheEntry]:
+        """Build the cache entry for a response.
+
+        Args:
+            url: the metadata URL.
+            headers: the response headers.
+
+        Returns:
+            The cache entry, or None if the response is not to be cached or is abandoned.
+        """
+        if not self._cache or "no-store" in headers.get("Cache-Control", ""):
+            return None
+        if self._abandoned and self._abandoned.is_set():
+            return None
+        return CacheEntry(
+            url=url,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            cache_control=headers.get("Cache-Control"),
+            fetched_at=time.time(),
+        )
+
+    @contextlib.contextmanager
+    def _reader(self, resource: typing.BinaryIO) -> typing.Iterator[_DecodingReader]:
+        """Read a response, accounting the bytes transferred and the decompression time.
+
+        Args:
+            resource: the response.
+
+        Yields:
+            The reader decompressing the response.
+        """
+        content_encoding = resource.headers.get("Content-Encoding")  # type: ignore[attr-defined]
+        content_length = resource.headers.get("Content-Length")  # type: ignore[attr-defined]
+        reader = _DecodingReader(
+            resource,
+            content_encoding.strip().lower() if isinstance(content_encoding, str) else None,
+            (
+                int(content_length)
+                if isinstance(content_length, str) and content_length.strip().isdigit()
+                else None
+            ),
+        )
+        try:
+            yield reader
+        finally:
+            self.bytes_transferred += reader.bytes_read
+            self.decompression_time += reader.decompression_time
+
+    def fetch(
+        self, url: str, timeout: float = FETCH_TIMEOUT, max_size: Optional[int] = None
+    ) -> bytes:
+        """Fetch the metadata from a URL.
+
+        Args:
+            url: the metadata URL.
+            timeout: the request timeout, in seconds.
+            max_size: maximum size of the metadata once decompressed, in bytes, if any.
+
+        Returns:
+            The metadata contents.
+
+        Raises:
+            HTTPError: if the server replies with an error.
+            MetadataTooLargeError: if the metadata is larger than max_size.
+            MetadataDecodingError: if the compressed metadata is truncated or corrupted.
+            MetadataTruncatedError: if the connection closed before the end of the metadata.
+        """
+        self.cached_entry = None
+        entry = self._cache.load(url) if self._cache and self._conditional else None
+        try:
+            with urllib.request.urlopen(  # noqa: S310
+                self._request(url, entry), timeout=timeout
+            ) as resource:  # nosec
+                with self._reader(resource) as reader:
+                    content = _read_bounded(reader, max_size)
+                headers = resource.headers
+                self.cache_control = headers.get("Cache-Control")
+        except urllib.error.HTTPError as ex:
+            if not (self._cache and entry) or ex.code != 304:
+                raise
+            self._revalidate(entry, ex.headers)
+            return self._cache.body_path(url).read_bytes()
+        if self._cache and (new_entry := self._cache_entry(url, headers)):
+            self._cache.store(new_entry, content)
+            self.cached_entry = new_entry
+        return content
+
+    def spool(
+        self, url: str, directory: Path, max_size: int, timeout: float = FETCH_TIMEOUT
+    ) -> Path:
+        """Fetch the metadata from a URL into a file, without holding it in memory.
+
+        Args:
+            url: the metadata URL.
+            directory: directory for the spool file, used if the response is not cached.
+            max_size: maximum size of the metadata once decompressed, in bytes.
+            timeout: the request timeout, in seconds.
+
+        Returns:
+            The path of the file holding the metadata.
+
+        Raises:
+            HTTPError: if the server replies with an error.
+            MetadataTooLargeError: if the metadata is larger than max_size.
+            MetadataDecodingError: if the compressed metadata is truncated or corrupted.
+            MetadataTruncatedError: if the connection closed before the end of the metadata.
+        """
+        self.cached_entry = None
+        entry = self._cache.load(url) if self._cache and self._conditional else None
+        try:
+            with urllib.request.urlopen(  # noqa: S310
+                self._request(url, entry), timeout=timeout
+            ) as resource:  # nosec
+                if int(resource.headers.get("Content-Length") or 0) > max_size:
+                    raise MetadataTooLargeError(f"Metadata larger than {max_size} bytes")
+                self.cache_control = resource.headers.get("Cache-Control")
+                new_entry = self._cache_entry(url, resource.headers)
+                path = (
+                    self._cache.body_path(url)
+                    if self._cache and new_entry
+                    else directory / "metadata.xml"
+                )
+                with self._reader(resource) as reader:
+                    _spool_atomically(reader, path, max_size)
+        except urllib.error.HTTPError as ex:
+            if not (self._cache and entry) or ex.code != 304:
+                raise
+            self._revalidate(entry, ex.headers)
+            return self._cache.body_path(url)
+        if self._cache and new_entry and not (self._abandoned and self._abandoned.is_set()):
+            self._cache.store(new_entry)
+            self.cached_entry = new_entry
+        return path
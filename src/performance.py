@@ -0,0 +1,140 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the PhaseTimer class to measure the time spent in each phase of a hook."""
+
+import contextlib
+import math
+import time
+import typing
+
+# Number of hook measurements kept per phase to compute the rolling statistics.
+MAX_SAMPLES = 50
+
+
+class PhaseTimer:
+    """Measure the time spent in each phase of a hook.
+
+    Spans can be nested, as the metadata is fetched, parsed and verified lazily: the time of a
+    nested span is only accounted to its own phase, never to the enclosing one.
+
+    Attrs:
+        durations: the time spent in each phase, in seconds.
+        counters: the values recorded during the hook, by name.
+    """
+
+    def __init__(self) -> None:
+        """Initialize a new instance of the PhaseTimer class."""
+        self.durations: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self._phases: list[str] = []
+        self._started = 0.0
+
+    def _switch(self) -> None:
+        """Account the time elapsed since the last switch to the current phase, if any."""
+        now = time.perf_counter()
+        if self._phases:
+            phase = self._phases[-1]
+            self.durations[phase] = self.durations.get(phase, 0.0) + now - self._started
+        self._started = now
+
+    @contextlib.contextmanager
+    def span(self, phase: str) -> typing.Iterator[None]:
+        """Measure the time spent in a phase.
+
+        Args:
+            phase: the phase name.
+
+        Yields:
+            Nothing, the block being timed.
+        """
+        self._switch()
+        self._phases.append(phase)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._phases.pop()
+
+    def record(self, phase: str, duration: float) -> None:
+        """Account time measured outside of the spans to a phase, such as time interleaved with
+        another phase, deducting it from the current phase.
+
+        Args:
+            phase: the phase name.
+            duration: the time spent in the phase, in seconds.
+        """
+        self._switch()
+        if self._phases:
+            self.durations[self._phases[-1]] -= duration
+        self.durations[phase] = self.durations.get(phase, 0.0) + duration
+
+    def count(self, name: str, value: int) -> None:
+        """Record a value for the current hook, such as the size of the metadata.
+
+        Args:
+            name: the counter name.
+            value: the value.
+        """
+        self.counters[name] = value
+
+
+def update_statistics(statistics: typing.Mapping, timer: PhaseTimer) -> dict:
+    """Add the measurements of a hook to the rolling statistics.
+
+    Args:
+        statistics: the statistics as previously returned, possibly empty.
+        timer: the timer of the hook.
+
+    Returns:
+        The new statistics, holding the most recent samples of each phase and the last value
+        of each counter.
+    """
+    samples = {
+        phase: list(phase_samples)
+        for phase, phase_samples in statistics.get("samples", {}).items()
+    }
+    for phase, duration in timer.durations.items():
+        samples[phase] = [*samples.get(phase, []), duration][-MAX_SAMPLES:]
+    return {
+        "samples": samples,
+        "counters": {**statistics.get("counters", {}), **timer.counters},
+    }
+
+
+def _percentile(samples: typing.Sequence[float], percentile: int) -> float:
+    """Compute a percentile with the nearest-rank method.
+
+    Args:
+        samples: the samples, not empty.
+        percentile: the percentile, between 1 and 100.
+
+    Returns:
+        The smallest sample greater than or equal to the given percentage of the samples.
+    """
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(percentile / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(statistics: typing.Mapping) -> dict:
+    """Summarize the rolling statistics.
+
+    Args:
+        statistics: the statistics as returned by update_statistics.
+
+    Returns:
+        The last, median and 95th percentile duration of each phase in milliseconds, along
+        with the number of samples, and the last value of each counter.
+    """
+    summary: dict[str, typing.Any] = {
+        phase: {
+            "last": round(samples[-1] * 1000, 3),
+            "p50": round(_percentile(samples, 50) * 1000, 3),
+            "p95": round(_percentile(samples, 95) * 1000, 3),
+            "samples": len(samples),
+        }
+        for phase, samples in statistics.get("samples", {}).items()
+        if samples
+    }
+    summary.update(statistics.get("counters", {}))
+    return summary
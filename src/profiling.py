@@ -0,0 +1,184 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the opt-in profiling of the hook executions.
+
+When profiling is off, which is checked with an environment lookup and a single stat, nothing
+else is done: the profilers are only imported and started when it is on.
+"""
+
+import contextlib
+import logging
+import os
+import time
+import typing
+from pathlib import Path
+
+if typing.TYPE_CHECKING:  # pragma: nocover
+    import cProfile
+    import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIRECTORY_NAME = ".profiles"
+# File whose presence turns profiling on, kept in sync with the profile_hooks configuration.
+ENABLED_MARKER = "enabled"
+# Environment variable turning profiling on regardless of the configuration.
+PROFILE_ENVIRONMENT_VARIABLE = "SAML_INTEGRATOR_PROFILE_HOOKS"
+# Number of hook profiles kept in the directory; older ones are deleted.
+MAX_PROFILES = 10
+# Number of frames stored per allocation, and of allocation sites reported per hook.
+TRACEBACK_FRAMES = 10
+TOP_ALLOCATIONS = 25
+PSTATS_SUFFIX = ".pstats"
+ALLOCATIONS_SUFFIX = ".allocations.txt"
+
+
+def profile_directory(charm_dir: Path) -> Path:
+    """Get the directory holding the hook profiles of the unit.
+
+    Args:
+        charm_dir: the charm directory.
+
+    Returns:
+        The profile directory.
+    """
+    return charm_dir / PROFILE_DIRECTORY_NAME
+
+
+def profiling_enabled(directory: Path) -> bool:
+    """Check whether the hooks are to be profiled.
+
+    Args:
+        directory: the profile directory.
+
+    Returns:
+        Whether the environment variable or the profile_hooks configuration turn profiling on.
+    """
+    if os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, "").lower() in ("1", "true", "yes"):
+        return True
+    return (directory / ENABLED_MARKER).exists()
+
+
+def set_profiling(directory: Path, enabled: bool) -> None:
+    """Turn the profiling of the following hooks on or off.
+
+    Args:
+        directory: the profile directory.
+        enabled: whether to profile the hooks.
+    """
+    marker = directory / ENABLED_MARKER
+    if enabled and not marker.exists():
+        directory.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+        logger.info("Hook profiling enabled, storing the profiles in %s", directory)
+    elif not enabled and marker.exists():
+        marker.unlink()
+        logger.info("Hook profiling disabled")
+
+
+@contextlib.contextmanager
+def profile_hook(directory: Path) -> typing.Iterator[None]:
+    """Profile the CPU time and the memory allocations of a hook, if profiling is on.
+
+    The profile is stored as a pstats file, along with the top allocation sites, named after
+    the time and the hook.
+
+    Args:
+        directory: the profile directory.
+
+    Yields:
+        Nothing, the hook being profiled.
+    """
+    if not profiling_enabled(directory):
+        yield
+        return
+    # pylint: disable=import-outside-toplevel
+    import cProfile
+    import tracemalloc
+
+    hook = Path(os.environ.get("JUJU_DISPATCH_PATH", "unknown")).name
+    profiler = cProfile.Profile()
+    tracemalloc.start(TRACEBACK_FRAMES)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        try:
+            _store_profile(directory, f"{time.time_ns():020d}-{hook}", profiler, snapshot, peak)
+        except OSError as ex:
+            logger.warning("Failed to store the hook profile: %s", ex)
+
+
+def _store_profile(
+    directory: Path,
+    name: str,
+    profiler: "cProfile.Profile",
+    snapshot: "tracemalloc.Snapshot",
+    peak: int,
+) -> None:
+    """Store a hook profile, deleting the oldest ones.
+
+    Args:
+        directory: the profile directory.
+        name: the profile name.
+        profiler: the CPU profiler.
+        snapshot: the memory allocations still alive at the end of the hook.
+        peak: the peak traced memory, in bytes.
+    """
+    import tracemalloc  # pylint: disable=import-outside-toplevel
+
+    directory.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(directory / f"{name}{PSTATS_SUFFIX}")
+    statistics = snapshot.filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    ).statistics("lineno")
+    lines = [
+        f"Peak traced memory: {peak / 1024:.1f} KiB",
+        f"Top {TOP_ALLOCATIONS} allocation sites:",
+    ]
+    lines.extend(str(statistic) for statistic in statistics[:TOP_ALLOCATIONS])
+    (directory / f"{name}{ALLOCATIONS_SUFFIX}").write_text("\n".join(lines) + "\n")
+    for stale in list_profiles(directory)[:-MAX_PROFILES]:
+        for suffix in (PSTATS_SUFFIX, ALLOCATIONS_SUFFIX):
+            (directory / f"{stale}{suffix}").unlink(missing_ok=True)
+
+
+def list_profiles(directory: Path) -> list[str]:
+    """List the hook profiles stored.
+
+    Args:
+        directory: the profile directory.
+
+    Returns:
+        The profile names, oldest first.
+    """
+    if not directory.is_dir():
+        return []
+    return sorted(path.name[: -len(PSTATS_SUFFIX)] for path in directory.glob(f"*{PSTATS_SUFFIX}"))
+
+
+def collect_profiles(directory: Path) -> bytes:
+    """Bundle the hook profiles stored.
+
+    Args:
+        directory: the profile directory.
+
+    Returns:
+        A gzip-compressed tarball of the pstats and allocation files.
+    """
+    # pylint: disable=import-outside-toplevel
+    import io
+    import tarfile
+
+    bundle = io.BytesIO()
+    with tarfile.open(fileobj=bundle, mode="w:gz") as tar:
+        for name in list_profiles(directory):
+            for suffix in (PSTATS_SUFFIX, ALLOCATIONS_SUFFIX):
+                if (path := directory / f"{name}{suffix}").exists():
+                    tar.add(path, arcname=path.name)
+    return bundle.getvalue()
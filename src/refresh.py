@@ -0,0 +1,127 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the functions scheduling the metadata refreshes."""
+
+import hashlib
+import typing
+
+# Maximum delay added to the refresh interval, as a fraction of the interval.
+JITTER_RATIO = 0.1
+# Shortest delay between refreshes brought forward by an upcoming expiry, in seconds.
+MIN_REFRESH_INTERVAL = 300
+
+
+class Validity(typing.NamedTuple):
+    """Represent how long the metadata served can be relied upon.
+
+    Attrs:
+        valid_until: UNIX timestamp of the validUntil of the metadata, if any.
+        cache_duration: the cacheDuration of the metadata in seconds, if any.
+        certificates_expire_at: UNIX timestamp of the earliest certificate expiry, if any.
+        expires_at: UNIX timestamp after which the metadata or a certificate is expired, if any.
+    """
+
+    valid_until: typing.Optional[float] = None
+    cache_duration: typing.Optional[float] = None
+    certificates_expire_at: typing.Optional[float] = None
+
+    @property
+    def expires_at(self) -> typing.Optional[float]:
+        """Return when the metadata or one of its certificates expires, if ever."""
+        return earliest((self.valid_until, self.certificates_expire_at))
+
+    def expires_after(self, timestamp: float) -> typing.Optional[float]:
+        """Get when the metadata or one of its certificates next expires after a time, if ever.
+
+        Args:
+            timestamp: the UNIX timestamp the expiry must follow.
+
+        Returns:
+            The earliest of the validUntil and of the certificate expiry later than the
+            timestamp, None if neither is.
+        """
+        return earliest(
+            deadline
+            for deadline in (self.valid_until, self.certificates_expire_at)
+            if deadline is not None and deadline > timestamp
+        )
+
+
+def earliest(values: typing.Iterable[typing.Optional[float]]) -> typing.Optional[float]:
+    """Get the smallest of the values set.
+
+    Args:
+        values: the values, None when not set.
+
+    Returns:
+        The smallest value, None if none is set.
+    """
+    return min((value for value in values if value is not None), default=None)
+
+
+def combine_validity(validities: typing.Iterable[Validity]) -> Validity:
+    """Combine the validity of several entities served together.
+
+    Args:
+        validities: the validity of each entity.
+
+    Returns:
+        The most restrictive validity.
+    """
+    validities = list(validities)
+    return Validity(
+        valid_until=earliest(validity.valid_until for validity in validities),
+        cache_duration=earliest(validity.cache_duration for validity in validities),
+        certificates_expire_at=earliest(
+            validity.certificates_expire_at for validity in validities
+        ),
+    )
+
+
+def refresh_jitter(seed: str, interval: float) -> float:
+    """Compute the delay added to the refresh interval of a unit.
+
+    The delay is derived from the seed so that it is stable across hooks while spreading the
+    refreshes of units sharing the same interval, avoiding a thundering herd on the IdP.
+
+    Args:
+        seed: a value unique to the unit, such as its model UUID and name.
+        interval: the refresh interval, in seconds.
+
+    Returns:
+        The delay, in seconds, between 0 and JITTER_RATIO times the interval.
+    """
+    fraction = int(hashlib.sha256(seed.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return fraction * JITTER_RATIO * interval
+
+
+def next_refresh(
+    last_refresh: float,
+    interval: float,
+    seed: str,
+    expires_at: typing.Optional[float] = None,
+) -> float:
+    """Compute when the metadata is next to be refreshed.
+
+    Ahead of the expiry of the metadata or of one of its certificates, the refresh is brought
+    forward halfway to the expiry, so that the refreshes get closer together as it nears, and
+    an IdP publishing new metadata late is picked up early. The refreshes are however never
+    brought forward to less than MIN_REFRESH_INTERVAL apart. An expiry already past at the last
+    refresh is ignored, the refreshes going back to the interval rather than polling an IdP
+    that doesn't publish new metadata.
+
+    Args:
+        last_refresh: UNIX timestamp of the last successful refresh, 0 if none.
+        interval: the refresh interval, in seconds.
+        seed: a value unique to the unit, such as its model UUID and name.
+        expires_at: UNIX timestamp at which the metadata or a certificate expires, if ever.
+
+    Returns:
+        The UNIX timestamp after which the metadata is to be refreshed.
+    """
+    refresh_at = last_refresh + interval + refresh_jitter(seed, interval)
+    if expires_at is None or expires_at <= last_refresh:
+        return refresh_at
+    before_expiry = max((expires_at - last_refresh) / 2, MIN_REFRESH_INTERVAL)
+    return min(refresh_at, last_refresh + before_expiry)
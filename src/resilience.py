@@ -0,0 +1,148 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the retries and the circuit breaker shielding the hooks from IdP outages."""
+
+import logging
+import time
+import typing
+import urllib.error
+
+logger = logging.getLogger(__name__)
+
+# Time a hook may spend retrieving the metadata from a URL, retries included, in seconds.
+RETRY_BUDGET = 15
+MAX_ATTEMPTS = 4
+# Delay before the first retry, in seconds, doubled for every subsequent one.
+BACKOFF_BASE = 0.5
+# Shortest timeout worth giving to an attempt, in seconds.
+MIN_ATTEMPT_TIMEOUT = 1
+# Number of consecutive failed retrievals after which a URL stops being called.
+FAILURE_THRESHOLD = 3
+# Time a URL stops being called for once its circuit opens, in seconds, doubled for every
+# failed trial retrieval up to MAX_OPEN_DURATION.
+OPEN_DURATION = 300
+MAX_OPEN_DURATION = 3600
+
+T = typing.TypeVar("T")
+
+
+def is_transient(error: OSError) -> bool:
+    """Check whether a failure to retrieve a URL is worth retrying.
+
+    Args:
+        error: the error raised while retrieving the URL.
+
+    Returns:
+        Whether the error is a timeout, a connection failure or a server-side HTTP error.
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError))
+
+
+def retry_with_backoff(
+    call: typing.Callable[[float], T], deadline: float, max_timeout: float
+) -> T:
+    """Call a function, retrying its transient failures with an exponential backoff.
+
+    Args:
+        call: the function, taking the timeout of the attempt in seconds.
+        deadline: the time.monotonic() value after which no attempt is to be made.
+        max_timeout: the timeout of an attempt, shortened so as not to overrun the deadline.
+
+    Returns:
+        The value returned by the function.
+
+    Raises:
+        OSError: the error of the last attempt, once the attempts or the time are exhausted.
+    """
+    attempt = 1
+    while True:
+        timeout = max(min(max_timeout, deadline - time.monotonic()), MIN_ATTEMPT_TIMEOUT)
+        try:
+            return call(timeout)
+        except OSError as ex:
+            delay = BACKOFF_BASE * 2 ** (attempt - 1)
+            if (
+                not is_transient(ex)
+                or attempt >= MAX_ATTEMPTS
+                or time.monotonic() + delay + MIN_ATTEMPT_TIMEOUT > deadline
+            ):
+                raise
+            logger.warning("Attempt %d failed (%s), retrying in %.1fs", attempt, ex, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+class CircuitOpenError(Exception):
+    """Exception raised when a URL is not called as its circuit is open."""
+
+
+class CircuitBreaker:
+    """Stop calling the URLs that keep failing until they are given another chance.
+
+    After FAILURE_THRESHOLD consecutive failures, the circuit of a URL opens and the URL isn't
+    called for OPEN_DURATION. The next call is then a trial: its success closes the circuit,
+    and its failure opens it again for twice as long, up to MAX_OPEN_DURATION. The state is
+    kept in a mapping persisted across hooks, such as a StoredState attribute.
+    """
+
+    def __init__(self, state: typing.MutableMapping[str, typing.Any]):
+        """Initialize a new instance of the CircuitBreaker class.
+
+        Args:
+            state: the failure count and reopening time of each failing URL.
+        """
+        self._state = state
+
+    def open_until(self, url: str) -> float:
+        """Get when the circuit of a URL closes.
+
+        Args:
+            url: the URL.
+
+        Returns:
+            The UNIX timestamp after which the URL can be called, 0 if it never failed.
+        """
+        circuit = self._state.get(url)
+        return circuit["open_until"] if circuit else 0.0
+
+    def check(self, url: str) -> None:
+        """Check that a URL can be called.
+
+        Args:
+            url: the URL.
+
+        Raises:
+            CircuitOpenError: if the circuit of the URL is open.
+        """
+        if time.time() < (open_until := self.open_until(url)):
+            raise CircuitOpenError(
+                f"Not calling {url} after repeated failures until {time.ctime(open_until)}"
+            )
+
+    def record_success(self, url: str) -> None:
+        """Close the circuit of a URL.
+
+        Args:
+            url: the URL.
+        """
+        if url in self._state:
+            logger.info("Circuit of %s closed", url)
+            del self._state[url]
+
+    def record_failure(self, url: str) -> None:
+        """Count a failure of a URL, opening its circuit past the threshold.
+
+        Args:
+            url: the URL.
+        """
+        circuit = self._state.get(url)
+        failures = (circuit["failures"] if circuit else 0) + 1
+        open_until = 0.0
+        if failures >= FAILURE_THRESHOLD:
+            duration = min(OPEN_DURATION * 2 ** (failures - FAILURE_THRESHOLD), MAX_OPEN_DURATION)
+            open_until = time.time() + duration
+            logger.warning("Circuit of %s opened for %ds", url, duration)
+        self._state[url] = {"failures": failures, "open_until": open_until}
@@ -3,21 +3,32 @@
 
 """Provide the SamlApp class to encapsulate the business logic."""
 
-import base64
-import hashlib
+import binascii
 import logging
-import secrets
 from functools import cached_property
-from typing import Optional
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Optional
 
-import signxml
 from charms.saml_integrator.v0 import saml
 
-# Bandit classifies this import as vulnerable. For more details, see
-# https://github.com/PyCQA/bandit/issues/767
-from lxml import etree  # nosec
-
 from charm_state import CharmConfigInvalidError, CharmState
+from entity_index import EntityIndex, IndexedDocument, IndexedEntity
+from metadata import (
+    ENTITY_DESCRIPTOR_TAG,
+    NAMESPACES,
+    MetadataDocument,
+    certificate_fingerprint,
+    extract_entity_details,
+    find_entity,
+)
+from performance import PhaseTimer
+from refresh import Validity, combine_validity
+from verification_cache import VerificationCache
+
+if TYPE_CHECKING:  # pragma: nocover
+    # Bandit classifies this import as vulnerable. For more details, see
+    # https://github.com/PyCQA/bandit/issues/767
+    from lxml import etree  # nosec
 
 logger = logging.getLogger(__name__)
 
@@ -26,35 +37,185 @@ class SamlIntegrator:  # pylint: disable=import-outside-toplevel
     """A class representing the SAML Integrator application.
 
     Attrs:
-        endpoints: SAML endpoints.
-        certificates: public certificates.
+        document: the metadata document.
+        endpoints: SAML endpoints of the default IdP entity.
+        certificates: public certificates of the default IdP entity.
+        entity: the details of the default IdP entity.
+        entity_ids: the entity IDs found in the metadata.
         signature: the Signature element in the metadata.
         signing_certificate: signing certificate.
         tree: the element tree for the metadata.
         nsmap: namespaces list.
     """
 
-    def __init__(self, charm_state: CharmState):
+    def __init__(
+        self,
+        charm_state: CharmState,
+        entity_index: Optional[EntityIndex] = None,
+        verification_cache: Optional[VerificationCache] = None,
+        phase_timer: Optional[PhaseTimer] = None,
+    ):
         """Initialize a new instance of the SamlApp class.
 
         Args:
             charm_state: The state of the charm that the Saml instance belongs to.
+            entity_index: The index to look the entities up in, if any.
+            verification_cache: The cache of signature verification outcomes, if any.
+            phase_timer: The timer measuring the fetch, parse, verify and extract phases.
         """
         self._charm_state = charm_state
+        self._entity_index = entity_index
+        self._verification_cache = verification_cache
+        self._phase_timer = phase_timer or PhaseTimer()
+        self._entities: dict[str, Optional[IndexedEntity]] = {}
+        self._validated_documents: dict[str, MetadataDocument] = {}
+        self._verified_signatures: set[str] = set()
 
-    def _read_tree(self) -> "etree.ElementTree":
-        """Fetch the metadata contents.
+    @cached_property
+    def document(self) -> MetadataDocument:
+        """Fetch the metadata contents a single time.
 
         Returns:
-            The metadata as an XML tree.
+            The metadata document shared by all the other properties.
+        """
+        with self._phase_timer.span("fetch"):
+            document = MetadataDocument(self._charm_state.metadata)
+            # A document validated while picking among the mirrors has already been parsed.
+            document = self._validated_documents.get(document.digest, document)
+        self._phase_timer.count("metadata-size", document.size)
+        return document
+
+    @cached_property
+    def _pinned_fingerprints(self) -> set[str]:
+        """Return the fingerprints configured, normalized.
+
+        Returns:
+            The lowercase hex fingerprints without separators, empty if none is configured.
+        """
+        return {
+            fingerprint.replace(":", "").replace(" ", "").lower()
+            for fingerprint in (self._charm_state.fingerprint or "").split(",")
+            if fingerprint.strip()
+        }
+
+    def _trusted_fingerprints(self, signing_fingerprints: Iterable[str]) -> list[str]:
+        """Select the signing certificates trusted to have signed the metadata.
+
+        During a key rollover, the IdP publishes both the current and the next signing
+        certificates, and the configuration can pin both of them.
+
+        Args:
+            signing_fingerprints: the fingerprints of the signing certificates of the metadata.
+
+        Returns:
+            The fingerprints of the signing certificates matching the configured ones, or of
+            the first signing certificate if none is configured.
+
+        Raises:
+            CharmConfigInvalidError: if none of the signing certificates match the fingerprints.
+        """
+        if not self._pinned_fingerprints:
+            # Only a pinned rollover is worth verifying the whole metadata more than once.
+            return list(signing_fingerprints)[:1]
+        trusted = [
+            fingerprint
+            for fingerprint in signing_fingerprints
+            if fingerprint in self._pinned_fingerprints
+        ]
+        if not trusted:
+            raise CharmConfigInvalidError(
+                "The metadata's signing certificate does not match the provided fingerprint"
+            )
+        return trusted
+
+    def _verify_signature(self, document: MetadataDocument, fingerprints: list[str]) -> None:
+        """Verify the signature of the whole metadata against its trusted signing certificates.
+
+        The outcomes are cached by metadata digest and certificate fingerprint, so that an
+        unchanged document is neither parsed nor verified again.
+
+        Args:
+            document: the metadata document.
+            fingerprints: the fingerprints of the signing certificates trusted to have signed it.
+
+        Raises:
+            CharmConfigInvalidError: if the signature is invalid for all the certificates.
+        """
+        digest = document.digest
+        unverified = []
+        for fingerprint in fingerprints:
+            if f"{digest}:{fingerprint}" in self._verified_signatures:
+                return
+            valid = (
+                self._verification_cache.get(digest, fingerprint)
+                if self._verification_cache
+                else None
+            )
+            if valid:
+                self._verified_signatures.add(f"{digest}:{fingerprint}")
+                return
+            if valid is None:
+                unverified.append(fingerprint)
+        if unverified:
+            # The metadata can be tampered unless the metadata contents used are signed. To prevent
+            # this, instead of arbitrarily validating the signature for all fragments that can be
+            # shared with the requirer, the whole contents will need to be signed.
+            # signxml pulls in cryptography, so it is only imported when no outcome is cached.
+            import signxml
+
+            with self._phase_timer.span("parse"):
+                tree = document.tree
+                signing_certificates = document.signing_certificates
+            for fingerprint in unverified:
+                with self._phase_timer.span("verify"):
+                    try:
+                        signxml.XMLVerifier().verify(
+                            tree, x509_cert=signing_certificates[fingerprint]
+                        )
+                        valid = True
+                    except (signxml.exceptions.InvalidSignature, ValueError):
+                        # A malformed certificate raises ValueError, and can't have signed it.
+                        valid = False
+                if self._verification_cache:
+                    self._verification_cache.store(digest, fingerprint, valid)
+                if valid:
+                    self._verified_signatures.add(f"{digest}:{fingerprint}")
+                    return
+        raise CharmConfigInvalidError("The metadata has an invalid signature")
+
+    def _validate_document(self, document: MetadataDocument) -> None:
+        """Check the signing certificates and the signature of a parsed metadata document.
+
+        Args:
+            document: the metadata document.
 
         Raises:
-            CharmConfigInvalidError: if the metadata URL can't be parsed.
+            CharmConfigInvalidError: if the metadata is invalid.
         """
-        try:
-            return etree.fromstring(self._charm_state.metadata)  # nosec
-        except etree.XMLSyntaxError as ex:
-            raise CharmConfigInvalidError("Metadata can't be parsed") from ex
+        with self._phase_timer.span("parse"):
+            signing_fingerprints = list(document.signing_certificates)
+        trusted = self._trusted_fingerprints(signing_fingerprints)
+        if trusted and document.signature is not None:
+            self._verify_signature(document, trusted)
+
+    def validate_metadata(self, metadata: str | bytes | Path) -> None:
+        """Check the signing certificate and signature of metadata before it is used.
+
+        Used to pick among the metadata fetched from several mirrors. A validated document is
+        reused by the document property rather than parsed and verified again. Streamed metadata
+        isn't validated, as it is then never parsed entirely.
+
+        Args:
+            metadata: the metadata, or the file holding it.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata is invalid.
+        """
+        document = MetadataDocument(metadata)
+        if self._streamable(document):
+            return
+        self._validate_document(document)
+        self._validated_documents[document.digest] = document
 
     @cached_property
     def tree(self) -> "etree.ElementTree":
@@ -66,26 +227,204 @@ class SamlIntegrator:  # pylint: disable=import-outside-toplevel
         Raises:
             CharmConfigInvalidError: if the metadata URL or the metadata itself is invalid.
         """
-        if self._charm_state.fingerprint and (
-            not self.signing_certificate
-            or not secrets.compare_digest(
-                hashlib.sha256(base64.b64decode(self.signing_certificate)).hexdigest(),
-                self._charm_state.fingerprint.replace(":", "").replace(" ", "").lower(),
-            )
+        with self._phase_timer.span("parse"):
+            tree = self.document.tree
+        self._validate_document(self.document)
+        return tree
+
+    def _streamable(self, document: MetadataDocument) -> bool:
+        """Check if the entities of a document can be read without parsing it entirely.
+
+        Only the metadata spooled to disk because stream_metadata is enabled is parsed
+        incrementally; the metadata resource is otherwise parsed and verified like any other.
+        Verifying the signature against the fingerprint requires the whole document, so it is
+        parsed entirely when a fingerprint is configured. Signed metadata is rejected when no
+        fingerprint is configured rather than served with its signature unverified.
+
+        Args:
+            document: the metadata document.
+
+        Returns:
+            True if the metadata is to be parsed incrementally.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata is signed and no fingerprint is configured.
+        """
+        if not (
+            document.path
+            and self._charm_state.stream_metadata
+            and not self._charm_state.fingerprint
         ):
+            return False
+        if document.signed:
             raise CharmConfigInvalidError(
-                "The metadata's signing certificate does not match the provided fingerprint"
+                "Signed metadata can't be streamed without a fingerprint to verify it against"
             )
-        tree = self._read_tree()
-        if self.signing_certificate and self.signature:
-            # The metadata can be tampered unless the metadata contents used are signed. To prevent
-            # this, instead of arbitrarily validating the signature for all fragments that can be
-            # shared with the requirer, the whole contents will need to be signed.
-            try:
-                signxml.XMLVerifier().verify(tree, x509_cert=self.signing_certificate)
-            except signxml.exceptions.InvalidSignature as ex:
-                raise CharmConfigInvalidError("The metadata has an invalid signature") from ex
-        return tree
+        return True
+
+    @property
+    def _streamed(self) -> bool:
+        """Check if the entities can be read without parsing the whole metadata.
+
+        Returns:
+            True if the metadata is to be parsed incrementally.
+        """
+        return self._streamable(self.document)
+
+    def _indexed_document(self, entity_index: EntityIndex) -> IndexedDocument:
+        """Get the metadata document from the index, validating and indexing it if needed.
+
+        Args:
+            entity_index: the entity index.
+
+        Returns:
+            The indexed document.
+        """
+        digest = self.document.digest
+        indexed = entity_index.get_document(digest)
+        if indexed and indexed.signed is not None:
+            # The fingerprints are indexed, so that no certificate is decoded again.
+            trusted = self._trusted_fingerprints(indexed.signing_fingerprints)
+            if indexed.signed and trusted:
+                self._verify_signature(self.document, trusted)
+            return indexed
+        # A document indexed while streamed, so unsigned, has no signing details to check a
+        # fingerprint against.
+        if indexed and not self._charm_state.fingerprint:
+            return indexed
+        if self._streamed:
+            indexed = IndexedDocument(digest=digest)
+            elements = self.document.iter_entities()
+        else:
+            indexed = IndexedDocument(
+                digest=digest,
+                signing_fingerprints=list(self.document.signing_certificates),
+                signed=self.signature is not None,
+            )
+            elements = self.tree.iter(ENTITY_DESCRIPTOR_TAG)
+        entity_count = entity_index.add_document(
+            indexed, (extract_entity_details(element) for element in elements)
+        )
+        self._phase_timer.count("entity-count", entity_count)
+        return indexed
+
+    def _extract_entities(self, entity_ids: list[str]) -> dict[str, Optional[IndexedEntity]]:
+        """Extract the details of several entities, sharing the work between them.
+
+        The entities are looked up in the index if available, in a single pass over the spooled
+        metadata if streamed, and in the metadata tree otherwise.
+
+        Args:
+            entity_ids: the entity IDs.
+
+        Returns:
+            The details of each entity, None if the entity is not in the metadata.
+        """
+        if self._entity_index:
+            digest = self._indexed_document(self._entity_index).digest
+            indexed = self._entity_index.get_entities(digest, entity_ids)
+            return {entity_id: indexed.get(entity_id) for entity_id in entity_ids}
+        if self._streamed:
+            # When the metadata is streamed, only the EntityDescriptors matching the entity IDs
+            # are kept in memory.
+            logger.info("Extracting %s from the spooled metadata", ", ".join(entity_ids))
+            elements = self.document.extract_entities(entity_ids)
+        else:
+            tree = self.tree
+            self._phase_timer.count(
+                "entity-count", sum(1 for _ in tree.iter(ENTITY_DESCRIPTOR_TAG))
+            )
+            elements = {entity_id: find_entity(tree, entity_id) for entity_id in entity_ids}
+        return {
+            entity_id: (
+                extract_entity_details(elements[entity_id])
+                if elements.get(entity_id) is not None
+                else None
+            )
+            for entity_id in entity_ids
+        }
+
+    def get_entities(self, entity_ids: Iterable[str]) -> dict[str, Optional[IndexedEntity]]:
+        """Return the details of several IdP entities of the metadata.
+
+        The metadata is fetched, validated and searched once for all the entities, and the
+        details of each entity are only extracted once.
+
+        Args:
+            entity_ids: the entity IDs.
+
+        Returns:
+            The details of each entity, None if the entity is not in the metadata.
+        """
+        entity_ids = list(dict.fromkeys(entity_ids))
+        if missing := [entity_id for entity_id in entity_ids if entity_id not in self._entities]:
+            with self._phase_timer.span("extract"):
+                self._entities.update(self._extract_entities(missing))
+        return {entity_id: self._entities[entity_id] for entity_id in entity_ids}
+
+    def load_indexed_entities(self, digest: str, entity_ids: Iterable[str]) -> bool:
+        """Load the details of several IdP entities from an indexed metadata document.
+
+        Used to serve the metadata last published without fetching it again, the document
+        having been validated when it was indexed.
+
+        Args:
+            digest: the digest of the metadata document.
+            entity_ids: the entity IDs.
+
+        Returns:
+            True if the document is indexed, the entities then being served from the index.
+        """
+        if not self._entity_index or not digest or not self._entity_index.get_document(digest):
+            return False
+        entity_ids = list(dict.fromkeys(entity_ids))
+        indexed = self._entity_index.get_entities(digest, entity_ids)
+        self._entities.update({entity_id: indexed.get(entity_id) for entity_id in entity_ids})
+        return True
+
+    def get_validity(self, entity_ids: Iterable[str]) -> Validity:
+        """Return how long the metadata of several IdP entities can be relied upon.
+
+        The validity is extracted along with the other details of the entities, so that it is
+        only parsed once per metadata document.
+
+        Args:
+            entity_ids: the entity IDs.
+
+        Returns:
+            The most restrictive validity of the entities found in the metadata.
+        """
+        return combine_validity(
+            Validity(
+                valid_until=entity.valid_until,
+                cache_duration=entity.cache_duration,
+                certificates_expire_at=entity.certificates_expire_at,
+            )
+            for entity in self.get_entities(entity_ids).values()
+            if entity
+        )
+
+    @property
+    def entity(self) -> Optional[IndexedEntity]:
+        """Return the details of the default IdP entity.
+
+        Returns:
+            The entity details, or None if the entity is not in the metadata.
+        """
+        entity_id = self._charm_state.entity_id
+        return self.get_entities([entity_id])[entity_id]
+
+    @cached_property
+    def entity_ids(self) -> list[str]:
+        """Return the entity IDs found in the metadata.
+
+        Returns:
+            The sorted entity IDs.
+        """
+        if self._entity_index:
+            digest = self._indexed_document(self._entity_index).digest
+            return self._entity_index.get_entity_ids(digest)
+        return sorted(element.get("entityID") for element in self.document.iter_entities())
 
     @cached_property
     def nsmap(self) -> dict:
@@ -94,30 +433,51 @@ class SamlIntegrator:  # pylint: disable=import-outside-toplevel
         Returns:
             The namespaces list without None.
         """
-        return {
-            "md": "urn:oasis:names:tc:SAML:2.0:metadata",
-            "ds": "http://www.w3.org/2000/09/xmldsig#",
-        }
+        return NAMESPACES
 
     @cached_property
     def signing_certificate(self) -> str | None:
         """Return the signing certificate for the metadata, if any."""
-        tree = self._read_tree()
-        signing_certificates = tree.xpath(
-            "//md:KeyDescriptor[@use='signing']//ds:X509Certificate/text()",
-            namespaces=self.nsmap,
-        )
-        return next(iter(signing_certificates), None)
+        return self.document.signing_certificate
 
     @cached_property
     def signature(self) -> Optional["etree.ElementTree"]:
         """Check if the metadata has a Signature element."""
-        tree = self._read_tree()
-        signature = tree.xpath(
-            "//ds:Signature",
-            namespaces=self.nsmap,
-        )
-        return signature[0] if signature else None
+        return self.document.signature
+
+    def get_certificates(self, entity_id: str) -> list[str]:
+        """Return the public certificates of an IdP entity defined in the metadata.
+
+        Args:
+            entity_id: the entity ID.
+
+        Returns:
+            List of certificates.
+        """
+        entity = self.get_entities([entity_id])[entity_id]
+        return entity.certificates if entity else []
+
+    def get_endpoints(self, entity_id: str) -> list[saml.SamlEndpoint]:
+        """Return the endpoints of an IdP entity defined in the metadata.
+
+        Args:
+            entity_id: the entity ID.
+
+        Returns:
+            List of endpoints.
+        """
+        entity = self.get_entities([entity_id])[entity_id]
+        if not entity:
+            return []
+        return [
+            saml.SamlEndpoint(
+                name=endpoint.name,
+                url=endpoint.url,
+                binding=endpoint.binding,
+                response_url=endpoint.response_url,
+            )
+            for endpoint in entity.endpoints
+        ]
 
     @cached_property
     def certificates(self) -> list[str]:
@@ -126,16 +486,7 @@ class SamlIntegrator:  # pylint: disable=import-outside-toplevel
         Returns:
             List of certificates.
         """
-        tree = self.tree
-        return sorted(
-            tree.xpath(
-                (
-                    f"//md:EntityDescriptor[@entityID='{self._charm_state.entity_id}']"
-                    "//md:KeyDescriptor//ds:X509Certificate/text()"
-                ),
-                namespaces=self.nsmap,
-            )
-        )
+        return self.get_certificates(self._charm_state.entity_id)
 
     @cached_property
     def endpoints(self) -> list[saml.SamlEndpoint]:
@@ -144,24 +495,62 @@ class SamlIntegrator:  # pylint: disable=import-outside-toplevel
         Returns:
             List of endpoints.
         """
-        tree = self.tree
-        results = tree.xpath(
-            (
-                f"//md:EntityDescriptor[@entityID='{self._charm_state.entity_id}']"
-                f"//md:SingleSignOnService | "
-                f"//md:EntityDescriptor[@entityID='{self._charm_state.entity_id}']"
-                f"//md:SingleLogoutService"
-            ),
-            namespaces=self.nsmap,
-        )
-        endpoints = []
-        for result in results:
-            endpoints.append(
-                saml.SamlEndpoint(
-                    name=etree.QName(result).localname,
-                    url=result.get("Location"),
-                    binding=result.get("Binding"),
-                    response_url=result.get("ResponseLocation"),
-                )
-            )
-        return endpoints
+        return self.get_endpoints(self._charm_state.entity_id)
+
+
+def _certificate_label(certificate: str) -> str:
+    """Label a certificate in a change description.
+
+    Args:
+        certificate: the base64 DER certificate.
+
+    Returns:
+        The SHA-256 fingerprint of the certificate, or its content if it isn't valid base64.
+    """
+    try:
+        return f"sha256:{certificate_fingerprint(certificate)}"
+    except binascii.Error:
+        return certificate
+
+
+def _endpoint_label(endpoint: saml.SamlEndpoint) -> str:
+    """Label an endpoint in a change description.
+
+    Args:
+        endpoint: the endpoint.
+
+    Returns:
+        The name, binding, URL and response URL of the endpoint.
+    """
+    return " ".join(
+        str(value)
+        for value in (endpoint.name, endpoint.binding, endpoint.url, endpoint.response_url)
+        if value
+    )
+
+
+def describe_changes(
+    published: Optional[saml.SamlRelationData], refreshed: saml.SamlRelationData
+) -> list[str]:
+    """Describe the changes of the SAML data refreshed from the metadata.
+
+    Args:
+        published: the SAML data currently published, if any.
+        refreshed: the SAML data extracted from the refreshed metadata.
+
+    Returns:
+        A line per entity ID, certificate or endpoint removed, prefixed with "-", or added,
+        prefixed with "+".
+    """
+    changes: list[str] = []
+    fields = (
+        ("entity_id", lambda data: {data.entity_id}),
+        ("certificate", lambda data: {_certificate_label(cert) for cert in data.certificates}),
+        ("endpoint", lambda data: {_endpoint_label(endpoint) for endpoint in data.endpoints}),
+    )
+    for field, labels in fields:
+        before = labels(published) if published else set()
+        after = labels(refreshed)
+        changes.extend(f"- {field} {label}" for label in sorted(before - after))
+        changes.extend(f"+ {field} {label}" for label in sorted(after - before))
+    return changes
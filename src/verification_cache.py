@@ -0,0 +1,81 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the VerificationCache class to persist the metadata signature verification outcomes."""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Number of verification outcomes kept in the cache; older ones are pruned.
+MAX_CACHED_VERIFICATIONS = 16
+
+
+class VerificationCache:
+    """Persistent cache of signature verification outcomes.
+
+    The outcomes are keyed by the SHA-256 digest of the metadata bytes and the SHA-256
+    fingerprint of the signing certificate, so any change to either forces a new verification.
+    """
+
+    def __init__(self, path: Path):
+        """Initialize a new instance of the VerificationCache class.
+
+        Args:
+            path: path of the JSON file holding the outcomes.
+        """
+        self._path = path
+
+    def _load(self) -> dict[str, dict]:
+        """Load the cached outcomes.
+
+        Returns:
+            The outcomes, by key.
+        """
+        try:
+            outcomes = json.loads(self._path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return outcomes if isinstance(outcomes, dict) else {}
+
+    def get(self, digest: str, certificate_fingerprint: str) -> Optional[bool]:
+        """Get the outcome of a previous verification.
+
+        Args:
+            digest: the metadata digest.
+            certificate_fingerprint: the signing certificate fingerprint.
+
+        Returns:
+            Whether the signature was valid, or None if it hasn't been verified yet.
+        """
+        outcome = self._load().get(f"{digest}:{certificate_fingerprint}")
+        valid = outcome.get("valid") if isinstance(outcome, dict) else None
+        if valid is None:
+            logger.info("Signature verification cache miss for metadata %s", digest)
+        else:
+            logger.info("Signature verification cache hit for metadata %s", digest)
+        return valid
+
+    def store(self, digest: str, certificate_fingerprint: str, valid: bool) -> None:
+        """Store the outcome of a verification, pruning the oldest ones.
+
+        Args:
+            digest: the metadata digest.
+            certificate_fingerprint: the signing certificate fingerprint.
+            valid: whether the signature was valid.
+        """
+        outcomes = self._load()
+        key = f"{digest}:{certificate_fingerprint}"
+        # Outcomes are kept in insertion order, so the newest one goes last.
+        outcomes.pop(key, None)
+        outcomes[key] = {"valid": valid, "verified_at": time.time()}
+        newest = list(outcomes.items())[-MAX_CACHED_VERIFICATIONS:]
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_name(f".{self._path.name}.tmp")
+        tmp_path.write_text(json.dumps(dict(newest)))
+        os.replace(tmp_path, self._path)
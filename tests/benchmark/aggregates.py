@@ -0,0 +1,110 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Build metadata aggregates of arbitrary size from the unit test fixtures."""
+
+import base64
+import copy
+import datetime
+import hashlib
+from pathlib import Path
+from typing import NamedTuple
+
+import signxml
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from lxml import etree
+
+from metadata import NAMESPACES, find_entity
+
+AGGREGATE = Path("tests/unit/files/metadata_aggregate.xml")
+ENTITY_ID = "https://login.staging.ubuntu.com"
+
+
+class SigningKey(NamedTuple):
+    """Represent a key pair to sign the generated aggregates with.
+
+    Attrs:
+        key: the PEM private key.
+        certificate: the PEM self-signed certificate.
+        fingerprint: the SHA-256 fingerprint of the certificate.
+    """
+
+    key: bytes
+    certificate: str
+    fingerprint: str
+
+    @property
+    def certificate_content(self) -> str:
+        """Return the base64 DER certificate, as found in the metadata."""
+        return base64.b64encode(
+            x509.load_pem_x509_certificate(self.certificate.encode()).public_bytes(
+                serialization.Encoding.DER
+            )
+        ).decode()
+
+
+def generate_signing_key() -> SigningKey:
+    """Generate a throwaway key pair.
+
+    Returns:
+        The key pair.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "idp.canonical.test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    return SigningKey(
+        key=key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ),
+        certificate=certificate.public_bytes(serialization.Encoding.PEM).decode(),
+        fingerprint=hashlib.sha256(
+            certificate.public_bytes(serialization.Encoding.DER)
+        ).hexdigest(),
+    )
+
+
+def build_aggregate(entities: int, signing_key: SigningKey | None = None) -> bytes:
+    """Build an aggregate with the requested number of entities, the IdP being the last one.
+
+    Args:
+        entities: the number of entities.
+        signing_key: the key to sign the aggregate with, if any; its certificate is then
+            published as the signing certificate of the IdP.
+
+    Returns:
+        The aggregate metadata.
+    """
+    root = etree.parse(str(AGGREGATE)).getroot()
+    template = find_entity(root, ENTITY_ID)
+    assert template is not None  # nosec
+    for child in list(root):
+        root.remove(child)
+    for index in range(entities - 1):
+        entity = copy.deepcopy(template)
+        entity.set("entityID", f"https://idp{index}.canonical.test")
+        root.append(entity)
+    root.append(template)
+    if not signing_key:
+        return etree.tostring(root)
+    key_descriptor = template.find("md:IDPSSODescriptor/md:KeyDescriptor", NAMESPACES)
+    key_descriptor.set("use", "signing")
+    key_descriptor.find(".//ds:X509Certificate", NAMESPACES).text = signing_key.certificate_content
+    signed = signxml.XMLSigner(method=signxml.methods.enveloped).sign(
+        root, key=signing_key.key, cert=signing_key.certificate
+    )
+    return etree.tostring(signed)
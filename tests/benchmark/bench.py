@@ -0,0 +1,291 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Microbenchmarks for the metadata and relation data hot paths, and the hook cold start.
+
+Run with `tox -e bench`. The timings are stored as JSON, by default in
+`.benchmarks/<commit>.json`, and can be compared with the ones of another commit:
+
+    tox -e bench -- --compare .benchmarks/<baseline commit>.json
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import statistics
+import subprocess  # nosec
+import sys
+import time
+import timeit
+import typing
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from aggregates import ENTITY_ID, build_aggregate, generate_signing_key
+from charms.saml_integrator.v0.saml import SamlEndpoint, SamlRelationData
+from ops.testing import Harness
+
+from charm import SamlIntegratorOperatorCharm
+from charm_state import CharmState
+from saml import SamlIntegrator
+
+RESULTS_DIRECTORY = Path(".benchmarks")
+ENTITY_COUNTS = (1, 100, 10000)
+ENDPOINT_COUNTS = (1, 10, 100, 1000)
+INTEGRATOR_PROPERTIES = ("tree", "certificates", "endpoints", "signing_certificate")
+
+
+def time_function(function: typing.Callable[[], object], repeat: int) -> dict:
+    """Time a function, calling it as many times as needed for each run to last ~0.2s.
+
+    Args:
+        function: the function to time.
+        repeat: the number of runs.
+
+    Returns:
+        The timings per call, in seconds.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    timings = [timing / number for timing in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def get_integrator_property(charm_state: CharmState, name: str) -> object:
+    """Get a property of a new SamlIntegrator.
+
+    Args:
+        charm_state: the charm state.
+        name: the property name.
+
+    Returns:
+        The property value.
+    """
+    return getattr(SamlIntegrator(charm_state=charm_state), name)
+
+
+def integrator_benchmarks(entities: int, signed: bool) -> dict[str, typing.Callable[[], object]]:
+    """Build the SamlIntegrator benchmarks for an aggregate.
+
+    Each call uses a new SamlIntegrator, so that the timings include the parsing and
+    validation the property depends on.
+
+    Args:
+        entities: the number of entities in the aggregate.
+        signed: whether the aggregate is signed, and checked against its fingerprint.
+
+    Returns:
+        The functions to time, by benchmark name.
+    """
+    signing_key = generate_signing_key() if signed else None
+    charm_state = MagicMock(spec=CharmState)
+    charm_state.metadata = build_aggregate(entities, signing_key)
+    charm_state.entity_id = ENTITY_ID
+    charm_state.fingerprint = signing_key.fingerprint if signing_key else None
+    variant = f"entities={entities},{'signed' if signed else 'unsigned'}"
+    return {
+        f"SamlIntegrator.{name}[{variant}]": functools.partial(
+            get_integrator_property, charm_state, name
+        )
+        for name in INTEGRATOR_PROPERTIES
+    }
+
+
+def relation_data_benchmarks() -> dict[str, typing.Callable[[], object]]:
+    """Build the relation data benchmarks from the IdP of the aggregate fixture.
+
+    Returns:
+        The functions to time, by benchmark name.
+    """
+    charm_state = MagicMock(spec=CharmState)
+    charm_state.metadata = build_aggregate(1)
+    charm_state.entity_id = ENTITY_ID
+    charm_state.fingerprint = None
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+    saml_data = SamlRelationData(
+        entity_id=ENTITY_ID,
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+        certificates=tuple(saml_integrator.certificates),
+        endpoints=tuple(saml_integrator.endpoints),
+    )
+    relation_data = saml_data.to_relation_data()
+    v1_relation_data = saml_data.to_relation_data(schema_version=1)
+    endpoint_data = saml_data.endpoints[0].to_relation_data()
+    return {
+        "SamlRelationData.to_relation_data": saml_data.to_relation_data,
+        "SamlRelationData.to_relation_data[v1]": functools.partial(
+            saml_data.to_relation_data, schema_version=1
+        ),
+        "SamlRelationData.from_relation_data": lambda: SamlRelationData.from_relation_data(
+            relation_data  # type: ignore[arg-type]
+        ),
+        "SamlRelationData.from_relation_data[v1]": lambda: SamlRelationData.from_relation_data(
+            v1_relation_data  # type: ignore[arg-type]
+        ),
+        "SamlEndpoint.from_relation_data": lambda: SamlEndpoint.from_relation_data(endpoint_data),
+    }
+
+
+def endpoint_scaling_benchmarks(endpoints: int) -> dict[str, typing.Callable[[], object]]:
+    """Build the relation data parsing benchmark for a number of endpoints.
+
+    Comparing the timings across endpoint counts shows how the parsing scales.
+
+    Args:
+        endpoints: the number of endpoints in the relation data.
+
+    Returns:
+        The functions to time, by benchmark name.
+    """
+    saml_data = SamlRelationData(
+        entity_id=ENTITY_ID,
+        metadata_url=None,
+        certificates=("cert1_content",),
+        endpoints=tuple(
+            SamlEndpoint(
+                name=f"Service{index}",
+                url=f"https://login.staging.ubuntu.com/saml/{index}",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+                response_url=f"https://login.staging.ubuntu.com/saml/{index}/response",
+            )
+            for index in range(endpoints)
+        ),
+    )
+    return {
+        f"SamlRelationData.from_relation_data[endpoints={endpoints}{variant}]": functools.partial(
+            SamlRelationData.from_relation_data,
+            saml_data.to_relation_data(schema_version),  # type: ignore[arg-type]
+        )
+        for schema_version, variant in ((0, ""), (1, ",v1"))
+    }
+
+
+def import_charm() -> None:
+    """Import the charm in a new interpreter, as Juju does for every hook."""
+    subprocess.run(  # nosec
+        [sys.executable, "-c", "import charm"],
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(("lib", "src"))},
+    )
+
+
+def dispatch_update_status(leader: bool) -> None:
+    """Dispatch an update status to a new charm with the refresh not yet due.
+
+    Args:
+        leader: whether the unit is the leader.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(leader)
+    harness.begin()
+    harness.charm._stored.last_refresh = time.time()  # pylint: disable=protected-access
+    harness.charm.on.update_status.emit()
+    harness.cleanup()
+
+
+def cold_start_benchmarks() -> dict[str, typing.Callable[[], object]]:
+    """Build the benchmarks of the work done by every hook, whether or not there is any to do.
+
+    Python starting up is included in the import timing, so that comparing it with
+    `python -c pass` shows the share of the charm.
+
+    Returns:
+        The functions to time, by benchmark name.
+    """
+    return {
+        "import charm[new interpreter]": import_charm,
+        "update-status[non-leader]": functools.partial(dispatch_update_status, False),
+        "update-status[leader,refresh not due]": functools.partial(dispatch_update_status, True),
+    }
+
+
+def current_commit() -> str:
+    """Get the commit the benchmarks run against.
+
+    Returns:
+        The abbreviated commit hash, suffixed if the tree has uncommitted changes.
+    """
+    try:
+        return subprocess.check_output(  # nosec
+            ["git", "describe", "--always", "--dirty"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Print the ratio of each timing to the baseline one.
+
+    Args:
+        results: the benchmark results.
+        baseline: the baseline results.
+        threshold: the ratio above which a benchmark is reported as a regression.
+
+    Returns:
+        True if any benchmark regressed.
+    """
+    regressed = False
+    print(f"Compared with {baseline['commit']}:")
+    for name, timing in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        ratio = timing["min"] / baseline["benchmarks"][name]["min"]
+        flag = " REGRESSION" if ratio > threshold else ""
+        regressed = regressed or bool(flag)
+        print(f"  {name:<60} {ratio:>6.2f}x{flag}")
+    return regressed
+
+
+def main() -> int:
+    """Run the benchmarks and store the results.
+
+    Returns:
+        The exit code, non-zero if a regression was found.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, nargs="+", default=list(ENTITY_COUNTS))
+    parser.add_argument("--endpoints", type=int, nargs="+", default=list(ENDPOINT_COUNTS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="JSON file to store the results in")
+    parser.add_argument("--compare", type=Path, help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args()
+
+    benchmarks = cold_start_benchmarks()
+    benchmarks.update(relation_data_benchmarks())
+    for endpoints in args.endpoints:
+        benchmarks.update(endpoint_scaling_benchmarks(endpoints))
+    for entities in args.entities:
+        for signed in (False, True):
+            benchmarks.update(integrator_benchmarks(entities, signed))
+    commit = current_commit()
+    results: dict = {
+        "commit": commit,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "benchmarks": {},
+    }
+    for name, function in benchmarks.items():
+        results["benchmarks"][name] = time_function(function, args.repeat)
+        print(f"{name:<62} {results['benchmarks'][name]['min'] * 1000:>12.3f} ms")
+
+    output = args.output or RESULTS_DIRECTORY / f"{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"Results stored in {output}")
+    if args.compare:
+        return int(compare(results, json.loads(args.compare.read_text()), args.threshold))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
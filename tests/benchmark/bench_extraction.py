@@ -0,0 +1,95 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Compare the precompiled metadata extraction engine with ad-hoc XPath queries.
+
+Run with `PYTHONPATH=lib:src python tests/benchmark/bench_extraction.py`.
+"""
+
+import argparse
+import functools
+import timeit
+
+from aggregates import ENTITY_ID, build_aggregate
+from lxml import etree
+
+from metadata import NAMESPACES, MetadataDocument, extract_entity_details, find_entity
+
+
+def extract_with_queries(metadata: bytes) -> tuple:
+    """Extract the details the way the charm did before the extraction engine.
+
+    Args:
+        metadata: the metadata.
+
+    Returns:
+        The signing certificate, signature, certificates and endpoints.
+    """
+    tree = etree.fromstring(metadata)  # nosec
+    signing_certificates = tree.xpath(
+        "//md:KeyDescriptor[@use='signing']//ds:X509Certificate/text()", namespaces=NAMESPACES
+    )
+    signature = tree.xpath("//ds:Signature", namespaces=NAMESPACES)
+    entity = tree.xpath(f"//md:EntityDescriptor[@entityID='{ENTITY_ID}']", namespaces=NAMESPACES)[
+        0
+    ]
+    certificates = entity.xpath(
+        ".//md:KeyDescriptor//ds:X509Certificate/text()", namespaces=NAMESPACES
+    )
+    endpoints = entity.xpath(
+        ".//md:SingleSignOnService | .//md:SingleLogoutService", namespaces=NAMESPACES
+    )
+    return (
+        next(iter(signing_certificates), None),
+        signature[0] if signature else None,
+        sorted(certificates),
+        [(etree.QName(endpoint).localname, endpoint.get("Location")) for endpoint in endpoints],
+    )
+
+
+def extract_with_engine(metadata: bytes) -> tuple:
+    """Extract the details with the precompiled extraction engine.
+
+    Args:
+        metadata: the metadata.
+
+    Returns:
+        The signing certificate, signature, certificates and endpoints.
+    """
+    document = MetadataDocument(metadata)
+    entity = find_entity(document.tree, ENTITY_ID)
+    details = extract_entity_details(entity)
+    return (
+        document.signing_certificate,
+        document.signature,
+        details.certificates,
+        [(endpoint.name, endpoint.url) for endpoint in details.endpoints],
+    )
+
+
+def main() -> None:
+    """Run the benchmark and print the timings."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, nargs="+", default=[1, 100, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'entities':>10} {'queries (ms)':>14} {'engine (ms)':>14} {'speedup':>8}")
+    for entities in args.entities:
+        metadata = build_aggregate(entities)
+        assert extract_with_queries(metadata) == extract_with_engine(metadata)  # nosec
+        number = max(1, 1000 // entities)
+        queries, engine = (
+            min(
+                timeit.repeat(
+                    functools.partial(extract, metadata), number=number, repeat=args.repeat
+                )
+            )
+            / number
+            * 1000
+            for extract in (extract_with_queries, extract_with_engine)
+        )
+        print(f"{entities:>10} {queries:>14.3f} {engine:>14.3f} {queries / engine:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,37 @@ from typing import Dict
 from unittest import mock
 
 import pytest
-from charms.saml_integrator.v0.saml import SamlEndpoint, SamlRelationData
+from charms.saml_integrator.v0.saml import SamlRelationData
 from interface_tester.plugin import InterfaceTester
 from scenario import State
 
-import saml
+import charm_state
 from charm import SamlIntegratorOperatorCharm
 
+METADATA = """<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    xmlns:ds="http://www.w3.org/2000/09/xmldsig#" entityID="https://login.staging.ubuntu.com">
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+        <md:KeyDescriptor use="signing">
+            <ds:KeyInfo>
+                <ds:X509Data>
+                    <ds:X509Certificate>cert_content</ds:X509Certificate>
+                </ds:X509Data>
+            </ds:KeyInfo>
+        </md:KeyDescriptor>
+        <md:SingleLogoutService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+            Location="https://login.staging.ubuntu.com/saml/logout"
+            ResponseLocation="https://login.staging.ubuntu.com/saml/logout/response" />
+        <md:SingleLogoutService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+            Location="https://login.staging.ubuntu.com/saml/logout"
+            ResponseLocation="https://login.staging.ubuntu.com/saml/logout/response" />
+        <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+            Location="https://login.staging.ubuntu.com/saml/" />
+        <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+            Location="https://login.staging.ubuntu.com/saml/" />
+    </md:IDPSSODescriptor>
+</md:EntityDescriptor>
+"""
+
 
 # Interface tests are centrally hosted at https://github.com/canonical/charm-relation-interfaces.
 # this fixture is used by the test runner of charm-relation-interfaces to test saml's compliance
@@ -23,29 +47,6 @@ from charm import SamlIntegratorOperatorCharm
 # to include the new identifier/location.
 @pytest.fixture
 def interface_tester(interface_tester: InterfaceTester, monkeypatch: pytest.MonkeyPatch):
-    sso_redirect_endpoint = SamlEndpoint(
-        name="SingleSignOnService",
-        url="https://login.staging.ubuntu.com/saml/",
-        binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
-    )
-    sso_post_endpoint = SamlEndpoint(
-        name="SingleSignOnService",
-        url="https://login.staging.ubuntu.com/saml/",
-        binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
-    )
-    slo_redirect_endpoint = SamlEndpoint(
-        name="SingleLogoutService",
-        url="https://login.staging.ubuntu.com/saml/logout",
-        binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
-        response_url="https://login.staging.ubuntu.com/saml/logout/response",
-    )
-    slo_post_endpoint = SamlEndpoint(
-        name="SingleLogoutService",
-        url="https://login.staging.ubuntu.com/saml/logout",
-        binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
-        response_url="https://login.staging.ubuntu.com/saml/logout/response",
-    )
-
     # Store the original method
     original_to_relation_data = SamlRelationData.to_relation_data
 
@@ -61,12 +62,9 @@ def interface_tester(interface_tester: InterfaceTester, monkeypatch: pytest.Monk
         return result
 
     with (
-        mock.patch.object(saml.SamlIntegrator, "certificates", ["cert_content"]),
-        mock.patch.object(
-            saml.SamlIntegrator,
-            "endpoints",
-            [sso_redirect_endpoint, sso_post_endpoint, slo_redirect_endpoint, slo_post_endpoint],
-        ),
+        # The metadata is patched rather than the SamlIntegrator, so that the SAML data goes
+        # through the parsing and the extraction of the entities, as it would once fetched.
+        mock.patch.object(charm_state.CharmState, "metadata", METADATA),
         mock.patch.object(SamlRelationData, "to_relation_data", patched_to_relation_data),
     ):
         interface_tester.configure(
@@ -4,13 +4,26 @@
 """SAML Integrator Charm unit tests."""
 
 # pylint: disable=protected-access
+import base64
+import io
+import os
+import shutil
+import subprocess  # nosec
+import sys
+import tarfile
+import time
+import urllib.error
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import ops
-from ops.testing import Harness
+import pytest
+from ops.testing import ActionFailed, Harness
 
 from charm import SamlIntegratorOperatorCharm
+from metadata import certificate_fingerprint, find_entity
+from metadata_fetcher import CacheEntry, MetadataCache
+from profiling import profile_directory, profile_hook
 
 
 def test_misconfigured_charm_reaches_blocked_status():
@@ -21,17 +34,19 @@ def test_misconfigured_charm_reaches_blocked_status():
     """
     harness = Harness(SamlIntegratorOperatorCharm)
     harness.begin()
+    harness.charm.on.config_changed.emit()
     assert harness.model.unit.status.name == ops.BlockedStatus().name
 
 
 def test_update_status():
     """
-    arrange: set up a charm.
+    arrange: set up a leader charm.
     act: trigger an update status with the required configs.
     assert: the charm executes _update_relations.
     """
     metadata = Path("tests/unit/files/metadata_unsigned.xml").read_text(encoding="utf-8")
     harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
     entity_id = "https://login.staging.ubuntu.com"
     harness.update_config(
         {
@@ -45,6 +60,79 @@ def test_update_status():
         update_relations_mock.assert_called_once()
 
 
+def test_update_status_when_not_leader():
+    """
+    arrange: set up a charm with an invalid configuration and unset leadership for the unit.
+    act: trigger an update status.
+    assert: the configuration is not validated and the status is left unchanged.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(False)
+    harness.begin()
+    harness.model.unit.status = ops.ActiveStatus()
+
+    with patch("charm.SamlIntegratorOperatorCharm._update_relations") as update_relations_mock:
+        harness.charm.on.update_status.emit()
+        update_relations_mock.assert_not_called()
+    assert "_charm_state" not in harness.charm.__dict__
+    assert harness.model.unit.status == ops.ActiveStatus()
+
+
+def test_update_status_with_invalid_config():
+    """
+    arrange: set up a leader charm with an invalid configuration, the refresh being due.
+    act: trigger an update status.
+    assert: the charm reaches BlockedStatus without updating the relations.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.begin()
+
+    with patch("charm.SamlIntegratorOperatorCharm._update_relations") as update_relations_mock:
+        harness.charm.on.update_status.emit()
+        update_relations_mock.assert_not_called()
+    assert harness.model.unit.status.name == ops.BlockedStatus().name
+
+
+# Modules taking longer to import than a hook takes to run when there is nothing to do.
+HEAVY_MODULES = ("cryptography", "lxml", "pydantic", "signxml")
+
+COLD_START_SCRIPT = """
+import sys
+from ops.testing import Harness
+from charm import SamlIntegratorOperatorCharm
+
+harness = Harness(SamlIntegratorOperatorCharm)
+harness.set_leader(False)
+harness.begin()
+harness.charm.on.update_status.emit()
+print(" ".join(sorted({name.partition(".")[0] for name in sys.modules})))
+"""
+
+
+def test_cold_start_when_not_leader():
+    """
+    arrange: set up a new interpreter, as Juju does for every hook.
+    act: import the charm with import timing enabled and trigger an update status on a
+        non-leader unit.
+    assert: none of the heavy modules is imported, neither by the charm nor by the hook.
+    """
+    result = subprocess.run(  # nosec
+        [sys.executable, "-X", "importtime", "-c", COLD_START_SCRIPT],
+        capture_output=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(("lib", "src"))},
+        text=True,
+    )
+
+    # Each line of the import timing reads "import time: self [us] | cumulative | module".
+    imported = {line.rpartition("|")[2].strip() for line in result.stderr.splitlines()}
+    loaded = set(result.stdout.split())
+    for module in HEAVY_MODULES:
+        assert module not in imported
+        assert module not in loaded
+
+
 def test_charm_reaches_active_status():
     """
     arrange: set up a charm.
@@ -85,7 +173,7 @@ def test_relation_joined_when_leader():
     harness.begin()
     harness.charm.on.config_changed.emit()
     assert harness.model.unit.status == ops.ActiveStatus()
-    harness.add_relation("saml", "indico")
+    harness.add_relation("saml", "indico", app_data={"saml_entity_id": entity_id})
     data = harness.model.get_relation("saml").data[harness.model.app]
     assert data["entity_id"] == harness.charm._charm_state.entity_id
     assert data["x509certs"] == ",".join(harness.charm._saml_integrator.certificates)
@@ -137,8 +225,8 @@ def test_relation_joined_when_leader():
 def test_relation_joined_when_not_leader():
     """
     arrange: set up a charm and unset leadership for the unit.
-    act: add a relation.
-    assert: the relation get populated with the SAML data.
+    act: add a relation requesting the entity.
+    assert: the relation is left empty, only the leader publishing the SAML data.
     """
     metadata = Path("tests/unit/files/metadata_unsigned.xml").read_text(encoding="utf-8")
 
@@ -154,6 +242,707 @@ def test_relation_joined_when_not_leader():
     harness.begin()
     harness.charm.on.config_changed.emit()
     assert harness.model.unit.status == ops.ActiveStatus()
-    harness.add_relation("saml", "indico")
+    harness.add_relation("saml", "indico", app_data={"saml_entity_id": entity_id})
     data = harness.model.get_relation("saml").data[harness.model.app]
     assert data == {}
+
+
+def test_update_status_skips_published_metadata():
+    """
+    arrange: set up a leader charm that already published the metadata, refreshing it on every
+        update status.
+    act: trigger an update status with the metadata unchanged.
+    assert: the relations are not updated again.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata": metadata,
+            "refresh_interval": 0,
+        }
+    )
+    harness.begin()
+    harness.add_relation("saml", "indico")
+    harness.charm.on.config_changed.emit()
+
+    with patch("charm.SamlIntegratorOperatorCharm._update_relations") as update_relations_mock:
+        harness.charm.on.update_status.emit()
+        update_relations_mock.assert_not_called()
+    assert harness.model.unit.status == ops.ActiveStatus()
+
+
+def test_update_relations_skips_unchanged_relations():
+    """
+    arrange: set up a leader charm with two relations, one of them holding outdated data.
+    act: trigger a configuration change.
+    assert: only the relation with outdated data is written to.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata": metadata,
+        }
+    )
+    harness.begin()
+    harness.add_relation("saml", "indico")
+    outdated_relation_id = harness.add_relation("saml", "wordpress")
+    harness.update_relation_data(
+        outdated_relation_id,
+        harness.model.app.name,
+        {"x509certs": "outdated", "saml_digest": "outdated"},
+    )
+
+    with patch.object(
+        harness.charm.saml,
+        "_write_relation_data",
+        wraps=harness.charm.saml._write_relation_data,  # pylint: disable=protected-access
+    ) as write_relation_data_mock:
+        harness.charm.on.config_changed.emit()
+        harness.charm.on.config_changed.emit()
+
+    write_relation_data_mock.assert_called_once()
+    assert write_relation_data_mock.call_args.args[0].id == outdated_relation_id
+    data = harness.model.get_relation("saml", outdated_relation_id).data[harness.model.app]
+    assert data["x509certs"] == "cert1_content"
+
+
+def test_relation_changed_publishes_requested_schema_version():
+    """
+    arrange: set up a leader charm publishing the SAML data to a relation in the v0 schema.
+    act: advertise the v1 schema version in the requirer databag.
+    assert: the SAML data is published again in the v1 schema.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata": metadata,
+        }
+    )
+    harness.begin()
+    relation_id = harness.add_relation("saml", "indico")
+    data = harness.model.get_relation("saml", relation_id).data[harness.model.app]
+    assert data["x509certs"] == "cert1_content"
+
+    harness.update_relation_data(relation_id, "indico", {"saml_schema_version": "1"})
+
+    assert "x509certs" not in data
+    assert data["saml_schema_version"] == "1"
+    saml_data = harness.charm.get_saml_data()
+    assert data["saml_data"] == saml_data.to_relation_data(schema_version=1)["saml_data"]
+    assert data["saml_digest"] == saml_data.digest
+
+
+def test_relation_changed_updates_only_the_relation():
+    """
+    arrange: set up a leader charm with the cache storage, publishing an aggregate to two
+        relations.
+    act: request another entity of the aggregate in the databag of one of the relations.
+    assert: only that relation is written to, served from the index without the metadata being
+        retrieved again.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.add_storage("metadata-cache", attach=True)
+    harness.update_config({"entity_id": "https://login.staging.ubuntu.com", "metadata": metadata})
+    harness.begin()
+    other_relation_id = harness.add_relation("saml", "indico")
+    relation_id = harness.add_relation("saml", "wordpress")
+    # Every hook runs in a new process, with the metadata yet to be retrieved.
+    harness.charm.__dict__.pop("_charm_state")
+    harness.charm.__dict__.pop("_saml_integrator")
+
+    with patch.object(
+        harness.charm.saml,
+        "_write_relation_data",
+        wraps=harness.charm.saml._write_relation_data,
+    ) as write_relation_data_mock:
+        harness.update_relation_data(
+            relation_id,
+            "wordpress",
+            {"saml_entity_id": "https://idp.canonical.test/idp/shibboleth"},
+        )
+
+    write_relation_data_mock.assert_called_once()
+    assert write_relation_data_mock.call_args.args[0].id == relation_id
+    assert "metadata" not in harness.charm._charm_state.__dict__
+    data = harness.get_relation_data(relation_id, harness.model.app.name)
+    assert data["entity_id"] == "https://idp.canonical.test/idp/shibboleth"
+    other_data = harness.get_relation_data(other_relation_id, harness.model.app.name)
+    assert other_data["entity_id"] == "https://login.staging.ubuntu.com"
+
+
+def test_relation_changed_updates_all_relations_on_new_metadata():
+    """
+    arrange: set up a leader charm without the cache storage, publishing an aggregate to two
+        relations, and then change the metadata without handling the configuration change.
+    act: request another entity of the aggregate in the databag of one of the relations.
+    assert: the new metadata is published to both relations, the index being unavailable.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config({"entity_id": "https://login.staging.ubuntu.com", "metadata": metadata})
+    harness.begin()
+    other_relation_id = harness.add_relation("saml", "indico")
+    relation_id = harness.add_relation("saml", "wordpress")
+    with harness.hooks_disabled():
+        harness.update_config({"metadata": metadata.replace("cert1_content", "cert2_content")})
+    # Every hook runs in a new process, with the metadata yet to be retrieved.
+    harness.charm.__dict__.pop("_charm_state")
+    harness.charm.__dict__.pop("_saml_integrator")
+
+    harness.update_relation_data(
+        relation_id, "wordpress", {"saml_entity_id": "https://idp.canonical.test/idp/shibboleth"}
+    )
+
+    data = harness.get_relation_data(relation_id, harness.model.app.name)
+    assert data["entity_id"] == "https://idp.canonical.test/idp/shibboleth"
+    other_data = harness.get_relation_data(other_relation_id, harness.model.app.name)
+    assert other_data["x509certs"] == "cert2_content"
+
+
+def test_relations_served_requested_entities():
+    """
+    arrange: set up a leader charm configured with an aggregate, with a relation requesting
+        another entity of the aggregate and a relation not requesting any.
+    act: trigger a configuration change.
+    assert: each relation is served the entity it requested, or the configured one.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata": metadata,
+        }
+    )
+    requesting_relation_id = harness.add_relation(
+        "saml", "indico", app_data={"saml_entity_id": "https://idp.canonical.test/idp/shibboleth"}
+    )
+    default_relation_id = harness.add_relation("saml", "wordpress")
+    harness.begin()
+
+    with patch("saml.find_entity", wraps=find_entity) as find_entity_mock:
+        harness.charm.on.config_changed.emit()
+
+    assert find_entity_mock.call_count == 2
+    requesting_data = harness.get_relation_data(requesting_relation_id, harness.model.app.name)
+    assert requesting_data["entity_id"] == "https://idp.canonical.test/idp/shibboleth"
+    assert requesting_data["x509certs"] == "idp_cert_content"
+    default_data = harness.get_relation_data(default_relation_id, harness.model.app.name)
+    assert default_data["entity_id"] == "https://login.staging.ubuntu.com"
+    assert default_data["x509certs"] == "cert1_content"
+
+
+def test_relation_requesting_unknown_entity(caplog: pytest.LogCaptureFixture):
+    """
+    arrange: set up a leader charm configured with an aggregate, with a relation requesting an
+        entity missing from it.
+    act: trigger a configuration change.
+    assert: the relation is served the entity ID without certificates and a warning is logged.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config({"entity_id": "https://login.staging.ubuntu.com", "metadata": metadata})
+    relation_id = harness.add_relation(
+        "saml", "indico", app_data={"saml_entity_id": "https://unknown.canonical.test"}
+    )
+    harness.begin()
+
+    harness.charm.on.config_changed.emit()
+
+    data = harness.get_relation_data(relation_id, harness.model.app.name)
+    assert data["entity_id"] == "https://unknown.canonical.test"
+    assert "x509certs" not in data
+    assert "Entity https://unknown.canonical.test not found in the metadata" in caplog.text
+
+
+def test_list_entities_action():
+    """
+    arrange: set up a charm configured with aggregate metadata and the cache storage attached.
+    act: run the list-entities action.
+    assert: the entity IDs in the metadata are returned.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.add_storage("metadata-cache", attach=True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata": metadata,
+        }
+    )
+    harness.begin()
+
+    output = harness.run_action("list-entities")
+
+    assert output.results == {
+        "count": 3,
+        "entities": (
+            "https://idp.canonical.test/idp/shibboleth\n"
+            "https://login.staging.ubuntu.com\n"
+            "https://sp.canonical.test/shibboleth"
+        ),
+    }
+
+
+def test_list_entities_action_invalid_metadata():
+    """
+    arrange: set up a charm configured with invalid metadata.
+    act: run the list-entities action.
+    assert: the action fails.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.update_config({"entity_id": "https://login.staging.ubuntu.com", "metadata": "invalid"})
+    harness.begin()
+
+    with pytest.raises(ActionFailed):
+        harness.run_action("list-entities")
+
+
+def test_get_performance_stats_action():
+    """
+    arrange: set up a leader charm and publish the metadata to a relation, committing the hook.
+    act: run the get-performance-stats action.
+    assert: the statistics of each phase of the hook and its counters are returned.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_text(encoding="utf-8")
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata": metadata,
+        }
+    )
+    harness.begin()
+    harness.add_relation("saml", "indico")
+    harness.framework.commit()
+
+    output = harness.run_action("get-performance-stats")
+
+    assert set(output.results) == {
+        "fetch",
+        "parse",
+        "extract",
+        "relations",
+        "metadata-size",
+        "entity-count",
+        "relations-written",
+    }
+    assert set(output.results["parse"]) == {"last", "p50", "p95", "samples"}
+    assert output.results["parse"]["samples"] == 1
+    assert output.results["metadata-size"] == len(metadata.encode("utf-8"))
+    assert output.results["entity-count"] == 1
+    assert output.results["relations-written"] == 1
+
+
+@pytest.mark.parametrize(
+    "cache_control, refreshed",
+    [
+        pytest.param(None, False, id="refresh interval"),
+        pytest.param("public, max-age=0", True, id="max-age"),
+    ],
+)
+@patch("urllib.request.urlopen")
+def test_update_status_refresh_interval(urlopen_mock, cache_control, refreshed):
+    """
+    arrange: set up a leader charm that just published the metadata fetched from a URL.
+    act: trigger an update status.
+    assert: the metadata is only fetched again if the max-age of the response has expired.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.return_value = metadata
+    urlopen_result_mock.headers = {"Cache-Control": cache_control} if cache_control else {}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.begin()
+    harness.add_relation("saml", "indico")
+    urlopen_mock.reset_mock()
+    # Every hook runs in a new process, with the metadata yet to be fetched.
+    harness.charm._charm_state.__dict__.pop("metadata")
+    harness.charm._saml_integrator.__dict__.pop("document")
+
+    harness.charm.on.update_status.emit()
+
+    assert urlopen_mock.called == refreshed
+
+
+@patch("urllib.request.urlopen")
+def test_streamed_signed_metadata_without_fingerprint(urlopen_mock):
+    """
+    arrange: set up a leader charm streaming signed metadata without a fingerprint configured.
+    act: trigger a configuration change.
+    assert: the charm reaches BlockedStatus without publishing the unverified metadata.
+    """
+    metadata = Path("tests/unit/files/metadata_signed.xml").read_bytes()
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.side_effect = io.BytesIO(metadata).read
+    urlopen_result_mock.headers = {}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+            "stream_metadata": True,
+        }
+    )
+    harness.begin()
+    relation_id = harness.add_relation("saml", "indico")
+
+    harness.charm.on.config_changed.emit()
+
+    assert harness.model.unit.status == ops.BlockedStatus(
+        "Signed metadata can't be streamed without a fingerprint to verify it against"
+    )
+    assert not harness.get_relation_data(relation_id, harness.model.app.name)
+
+
+@pytest.mark.parametrize("cached", [True, False])
+@patch("time.sleep")
+@patch("urllib.request.urlopen", side_effect=urllib.error.URLError("Error"))
+def test_update_status_when_idp_unreachable(urlopen_mock, _, cached):
+    """
+    arrange: set up a leader charm configured with an unreachable metadata_url, with or without
+        metadata verified two hours ago kept in the storage.
+    act: trigger an update status.
+    assert: the cached metadata is published with its age in an active status, or the relation
+        is left untouched in a waiting status; the refresh is retried by the next hook.
+    """
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.add_storage("metadata-cache", attach=True)
+    harness.update_config(
+        {"entity_id": "https://login.staging.ubuntu.com", "metadata_url": metadata_url}
+    )
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+    if cached:
+        cache = MetadataCache(harness.model.storages["metadata-cache"][0].location)
+        entry = CacheEntry(url=metadata_url, fetched_at=time.time() - 7200)
+        cache.store(entry, Path("tests/unit/files/metadata_unsigned.xml").read_bytes())
+        cache.promote(entry)
+
+    harness.charm.on.update_status.emit()
+
+    assert urlopen_mock.called
+    relation_data = harness.get_relation_data(relation_id, harness.model.app.name)
+    if cached:
+        assert relation_data["entity_id"] == "https://login.staging.ubuntu.com"
+        assert harness.model.unit.status == ops.ActiveStatus(
+            "Serving the metadata cached 2h ago, the IdP being unreachable"
+        )
+    else:
+        assert not relation_data
+        assert harness.model.unit.status == ops.WaitingStatus(
+            f"Error while retrieving data from {metadata_url}"
+        )
+    assert harness.charm._stored.last_refresh == 0
+    assert harness.charm._stored.circuits[metadata_url]["failures"] == 1
+
+
+@patch("time.sleep")
+@patch("urllib.request.urlopen")
+def test_invalid_metadata_not_served_during_outage(urlopen_mock, _):
+    """
+    arrange: set up a leader charm publishing the metadata fetched from a URL to a relation,
+        with the cache storage attached.
+    act: handle a hook with the IdP serving invalid metadata, then another with it unreachable.
+    assert: the invalid metadata blocks the unit, then the metadata last published is served
+        again from the storage rather than the invalid response cached in between.
+    """
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    responses = []
+    for content in (Path("tests/unit/files/metadata_unsigned.xml").read_bytes(), b"invalid"):
+        urlopen_result_mock = MagicMock()
+        urlopen_result_mock.read.side_effect = io.BytesIO(content).read
+        urlopen_result_mock.headers = {}
+        urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+        responses.append(urlopen_result_mock)
+    urlopen_mock.side_effect = [*responses, *[urllib.error.URLError("Error")] * 4]
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.add_storage("metadata-cache", attach=True)
+    harness.update_config(
+        {"entity_id": "https://login.staging.ubuntu.com", "metadata_url": metadata_url}
+    )
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+    harness.charm.on.config_changed.emit()
+    assert harness.model.unit.status == ops.ActiveStatus()
+
+    statuses = []
+    for _ in responses:
+        # Every hook runs in a new process, with the metadata yet to be fetched.
+        harness.charm.__dict__.pop("_charm_state")
+        harness.charm.__dict__.pop("_saml_integrator")
+        harness.charm.on.config_changed.emit()
+        statuses.append(harness.model.unit.status)
+
+    assert statuses[0].name == ops.BlockedStatus().name
+    assert statuses[1] == ops.ActiveStatus(
+        "Serving the metadata cached 0m ago, the IdP being unreachable"
+    )
+    relation_data = harness.get_relation_data(relation_id, harness.model.app.name)
+    assert relation_data["entity_id"] == "https://login.staging.ubuntu.com"
+    assert relation_data["x509certs"] == "cert1_content"
+
+
+def test_metadata_resource_parsed_once():
+    """
+    arrange: set up a leader charm with the metadata resource attached and the cache storage,
+        publishing the metadata to a relation.
+    act: handle another hook with the resource unchanged.
+    assert: the SAML data is published from the resource, which isn't parsed again.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.add_storage("metadata-cache", attach=True)
+    harness.add_resource("metadata", Path("tests/unit/files/metadata_aggregate.xml").read_bytes())
+    harness.update_config({"entity_id": "https://login.staging.ubuntu.com"})
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+    harness.charm.on.config_changed.emit()
+    # Every hook runs in a new process, with the resource yet to be read.
+    harness.charm.__dict__.pop("_charm_state")
+    harness.charm.__dict__.pop("_saml_integrator")
+
+    with (
+        patch("metadata.etree.iterparse") as iterparse_mock,
+        patch("metadata.etree.parse") as parse_mock,
+    ):
+        harness.charm.on.config_changed.emit()
+
+    iterparse_mock.assert_not_called()
+    parse_mock.assert_not_called()
+    assert harness.charm._saml_integrator.entity
+    relation_data = harness.get_relation_data(relation_id, harness.model.app.name)
+    assert relation_data["entity_id"] == "https://login.staging.ubuntu.com"
+    assert harness.model.unit.status == ops.ActiveStatus()
+
+
+def test_metadata_expiry():
+    """
+    arrange: set up a leader charm with metadata having expired, with a cacheDuration.
+    act: publish the metadata to a relation, then run the get-refresh-schedule action.
+    assert: the SAML data is published, the expiry is reported in the status and the refresh
+        is scheduled from the cacheDuration, the expiry being already past.
+    """
+    metadata = (
+        Path("tests/unit/files/metadata_unsigned.xml")
+        .read_text(encoding="utf-8")
+        .replace(
+            'entityID="https://login.staging.ubuntu.com"',
+            'entityID="https://login.staging.ubuntu.com" validUntil="2020-01-01T00:00:00Z"'
+            ' cacheDuration="PT6H"',
+        )
+    )
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config({"entity_id": "https://login.staging.ubuntu.com", "metadata": metadata})
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+
+    harness.charm.on.config_changed.emit()
+
+    relation_data = harness.get_relation_data(relation_id, harness.model.app.name)
+    assert relation_data["entity_id"] == "https://login.staging.ubuntu.com"
+    assert harness.model.unit.status == ops.BlockedStatus(
+        "The metadata expired on 2020-01-01T00:00:00Z"
+    )
+    output = harness.run_action("get-refresh-schedule")
+    assert output.results["interval"] == 21600
+    assert output.results["cache-duration"] == 21600
+    assert output.results["valid-until"] == "2020-01-01T00:00:00Z"
+    assert "certificates-expire-at" not in output.results
+    assert harness.charm._next_refresh() >= harness.charm._stored.last_refresh + 21600
+
+
+@patch("urllib.request.urlopen")
+def test_get_refresh_schedule_action(urlopen_mock):
+    """
+    arrange: set up a leader charm publishing signed metadata fetched from a URL with a max-age.
+    act: run the get-refresh-schedule action.
+    assert: the max-age and the expiry of the signing certificate are reported.
+    """
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.side_effect = io.BytesIO(
+        Path("tests/unit/files/metadata_signed.xml").read_bytes()
+    ).read
+    urlopen_result_mock.headers = {"Cache-Control": "max-age=600"}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.add_relation("saml", "indico")
+    harness.begin()
+    harness.charm.on.config_changed.emit()
+
+    output = harness.run_action("get-refresh-schedule")
+
+    assert output.results["interval"] == 600
+    assert output.results["max-age"] == 600
+    assert output.results["certificates-expire-at"].endswith("Z")
+
+
+def test_get_refresh_schedule_action_before_refresh():
+    """
+    arrange: set up a charm that never refreshed the metadata.
+    act: run the get-refresh-schedule action.
+    assert: the refresh is due now, on the configured interval.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.begin()
+
+    output = harness.run_action("get-refresh-schedule")
+
+    assert output.results["last-refresh"] == "never"
+    assert output.results["interval"] == harness.charm.config["refresh_interval"]
+    assert "valid-until" not in output.results
+
+
+def test_profile_hooks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    arrange: set up a charm with profile_hooks set.
+    act: profile a hook, then run the collect-profiles action.
+    assert: the profiles of the hooks following the configuration change are bundled, and
+        the action fails once profiling is off and the profiles removed.
+    """
+    monkeypatch.delenv("SAML_INTEGRATOR_PROFILE_HOOKS", raising=False)
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.begin()
+    harness.framework.charm_dir = tmp_path
+    harness.update_config({"profile_hooks": True})
+
+    with profile_hook(profile_directory(tmp_path)):
+        harness.charm.on.update_status.emit()
+    output = harness.run_action("collect-profiles")
+
+    assert output.results["count"] == 1
+    with tarfile.open(
+        fileobj=io.BytesIO(base64.b64decode(output.results["bundle"])), mode="r:gz"
+    ) as tar:
+        assert len(tar.getnames()) == 2
+    harness.update_config({"profile_hooks": False})
+    with profile_hook(profile_directory(tmp_path)):
+        harness.charm.on.update_status.emit()
+    shutil.rmtree(profile_directory(tmp_path))
+    with pytest.raises(ActionFailed):
+        harness.run_action("collect-profiles")
+
+
+@pytest.mark.parametrize("dry_run", [True, False])
+@patch("urllib.request.urlopen")
+def test_refresh_metadata_action(urlopen_mock, dry_run):
+    """
+    arrange: set up a leader charm publishing the metadata fetched from a URL, with a cached
+        copy of it, the IdP having since rotated its certificate.
+    act: run the refresh-metadata action.
+    assert: the metadata is fetched unconditionally, the certificate change is reported with
+        the phase timings, and the relation only updated without dry-run, leaving nothing to
+        change on the next run.
+    """
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.return_value = metadata.replace(b"cert1_content", b"cert2_content")
+    urlopen_result_mock.headers = {}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.add_storage("metadata-cache", attach=True)
+    harness.update_config(
+        {"entity_id": "https://login.staging.ubuntu.com", "metadata_url": metadata_url}
+    )
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+    MetadataCache(harness.model.storages["metadata-cache"][0].location).store(
+        CacheEntry(url=metadata_url, etag='"v1"'), metadata
+    )
+    harness.update_relation_data(
+        relation_id,
+        harness.model.app.name,
+        {"entity_id": "https://login.staging.ubuntu.com", "x509certs": "cert1_content"},
+    )
+
+    output = harness.run_action("refresh-metadata", {"dry-run": dry_run})
+
+    assert urlopen_mock.call_args.args[0].get_header("If-none-match") is None
+    assert output.results["changed-relations"] == 1
+    assert output.results["changes"].splitlines() == [
+        f"saml:{relation_id} - certificate sha256:{certificate_fingerprint('cert1_content')}",
+        f"saml:{relation_id} + certificate sha256:{certificate_fingerprint('cert2_content')}",
+        f"saml:{relation_id} + endpoint SingleLogoutService"
+        " urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Post https://login.staging.ubuntu.com/+logout"
+        " https://login.staging.ubuntu.com/example/",
+        f"saml:{relation_id} + endpoint SingleSignOnService"
+        " urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Post https://login.staging.ubuntu.com/saml/",
+    ]
+    assert {"fetch", "parse", "extract"} <= set(output.results["timings"])
+    relation_data = harness.get_relation_data(relation_id, harness.model.app.name)
+    assert relation_data["x509certs"] == ("cert1_content" if dry_run else "cert2_content")
+    if not dry_run:
+        # Once the refreshed SAML data is published, there is nothing left to change.
+        assert harness.run_action("refresh-metadata").results["changed-relations"] == 0
+
+
+@patch("time.sleep")
+@patch("urllib.request.urlopen", side_effect=urllib.error.URLError("Error"))
+def test_refresh_metadata_action_when_idp_unreachable(_, __):
+    """
+    arrange: set up a leader charm configured with an unreachable metadata_url, with a verified
+        copy of the metadata kept.
+    act: run the refresh-metadata action.
+    assert: the action fails rather than falling back to the cached copy.
+    """
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.add_storage("metadata-cache", attach=True)
+    harness.update_config(
+        {"entity_id": "https://login.staging.ubuntu.com", "metadata_url": metadata_url}
+    )
+    harness.begin()
+    cache = MetadataCache(harness.model.storages["metadata-cache"][0].location)
+    cache.store(
+        CacheEntry(url=metadata_url), Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    )
+    cache.promote(CacheEntry(url=metadata_url))
+
+    with pytest.raises(ActionFailed):
+        harness.run_action("refresh-metadata")
+    harness.set_leader(False)
+    with pytest.raises(ActionFailed):
+        harness.run_action("refresh-metadata")
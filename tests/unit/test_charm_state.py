@@ -3,13 +3,28 @@
 
 """CharmState unit tests."""
 
+import gzip
+import io
+import threading
+import time
 import urllib
 from pathlib import Path
+from typing import Optional
 from unittest.mock import MagicMock, patch
 
+import ops
 import pytest
 
-from charm_state import CharmConfigInvalidError, CharmState
+from charm_state import (
+    CharmConfigInvalidError,
+    CharmState,
+    MetadataUnavailableError,
+    SamlIntegratorConfig,
+)
+from metadata_fetcher import CacheEntry, MetadataCache
+from performance import PhaseTimer
+from resilience import FAILURE_THRESHOLD, CircuitBreaker
+from saml import SamlIntegrator
 
 
 @patch("urllib.request.urlopen")
@@ -61,6 +76,20 @@ def test_charm_state_from_charm_with_metadata():
     assert state.metadata == metadata
 
 
+def test_saml_integrator_config_with_mirror_url_list():
+    """
+    arrange: do nothing.
+    act: build the configuration with the mirror URLs as a list rather than comma-separated.
+    assert: the list is kept as is.
+    """
+    config = SamlIntegratorConfig(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_mirror_urls=list(MIRROR_URLS[1:]),  # type: ignore[arg-type]
+    )
+
+    assert [str(url) for url in config.metadata_mirror_urls] == list(MIRROR_URLS[1:])
+
+
 def test_charm_state_from_charm_with_invalid_config():
     """
     arrange: set up an unconfigured charm
@@ -69,16 +98,53 @@ def test_charm_state_from_charm_with_invalid_config():
     """
     entity_id = "https://login.staging.ubuntu.com"
     charm = MagicMock(config={"entity_id": entity_id})
+    charm.model.resources.fetch.side_effect = ops.ModelError
     with pytest.raises(CharmConfigInvalidError):
         CharmState.from_charm(charm)
 
 
+def test_charm_state_from_charm_with_metadata_resource(tmp_path):
+    """
+    arrange: set up a charm configured without metadata_url nor metadata, with the metadata
+        resource attached.
+    act: access the metadata property.
+    assert: the path to the resource is returned.
+    """
+    resource = tmp_path / "metadata.xml"
+    resource.write_bytes(Path("tests/unit/files/metadata_aggregate.xml").read_bytes())
+    charm = MagicMock(config={"entity_id": "https://login.staging.ubuntu.com"})
+    charm.model.resources.fetch.return_value = resource
+
+    state = CharmState.from_charm(charm)
+
+    charm.model.resources.fetch.assert_called_once_with("metadata")
+    assert state.metadata_resource == resource
+    assert state.metadata == resource
+
+
+def test_charm_state_from_charm_with_empty_metadata_resource(tmp_path):
+    """
+    arrange: set up a charm configured without metadata_url nor metadata, with an empty
+        metadata resource attached.
+    act: build the charm state.
+    assert: a CharmConfigInvalidError is raised.
+    """
+    resource = tmp_path / "metadata.xml"
+    resource.touch()
+    charm = MagicMock(config={"entity_id": "https://login.staging.ubuntu.com"})
+    charm.model.resources.fetch.return_value = resource
+
+    with pytest.raises(CharmConfigInvalidError):
+        CharmState.from_charm(charm)
+
+
+@patch("time.sleep")
 @patch.object(urllib.request, "urlopen", side_effect=urllib.error.URLError("Error"))
-def test_charm_state_from_charm_with_metadata_url_invalid(_):
+def test_charm_state_from_charm_with_metadata_url_invalid(urlopen_mock, _):
     """
     arrange: set up a configured charm with a metadata_url returning a 404
     act: access the status properties
-    assert: a CharmConfigInvalidError is raised.
+    assert: a MetadataUnavailableError is raised, once the retries are exhausted.
     """
     entity_id = "https://login.staging.ubuntu.com"
     metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
@@ -89,5 +155,426 @@ def test_charm_state_from_charm_with_metadata_url_invalid(_):
         }
     )
     state = CharmState.from_charm(charm)
+    with pytest.raises(MetadataUnavailableError):
+        state.metadata  # noqa: B018
+    assert urlopen_mock.call_count > 1
+
+
+@patch("urllib.request.urlopen")
+def test_charm_state_fetches_metadata_url_once(urlopen_mock):
+    """
+    arrange: set up a charm configured with a metadata_url.
+    act: access the metadata property several times.
+    assert: the metadata_url is fetched a single time.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.return_value = metadata
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    state = CharmState.from_charm(charm)
+
+    assert state.metadata == metadata
+    assert state.metadata == metadata
+    urlopen_mock.assert_called_once()
+
+
+@patch("urllib.request.urlopen")
+def test_charm_state_caches_metadata_in_storage(urlopen_mock, tmp_path):
+    """
+    arrange: set up a charm configured with a metadata_url and with the cache storage attached.
+    act: access the metadata property.
+    assert: the metadata is cached in the storage.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.return_value = metadata
+    urlopen_result_mock.headers = {"ETag": '"v1"'}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": metadata_url,
+        }
+    )
+    charm.model.storages = {"metadata-cache": [MagicMock(location=tmp_path)]}
+    state = CharmState.from_charm(charm)
+
+    assert state.metadata == metadata
+    assert MetadataCache(tmp_path).load(metadata_url)
+
+
+@patch("urllib.request.urlopen")
+def test_charm_state_streams_metadata(urlopen_mock):
+    """
+    arrange: set up a charm configured to stream the metadata.
+    act: access the metadata property.
+    assert: the metadata is spooled to a file.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.side_effect = io.BytesIO(metadata).read
+    urlopen_result_mock.headers = {}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+            "stream_metadata": True,
+        }
+    )
+    state = CharmState.from_charm(charm)
+
+    assert isinstance(state.metadata, Path)
+    assert state.metadata.read_bytes() == metadata
+
+
+@patch("urllib.request.urlopen")
+def test_charm_state_streamed_metadata_too_large(urlopen_mock):
+    """
+    arrange: set up a charm configured to stream the metadata, which exceeds the maximum size.
+    act: access the metadata property.
+    assert: a CharmConfigInvalidError is raised.
+    """
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.headers = {"Content-Length": str(2 * 1024 * 1024)}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+            "metadata_max_size": 1,
+            "stream_metadata": True,
+        }
+    )
+    state = CharmState.from_charm(charm)
+
     with pytest.raises(CharmConfigInvalidError):
         state.metadata  # noqa: B018
+
+
+MIRROR_URLS = (
+    "https://login.staging.ubuntu.com/saml/metadata",
+    "https://mirror1.canonical.test/metadata",
+    "https://mirror2.canonical.test/metadata",
+    "https://mirror3.canonical.test/metadata",
+)
+
+
+def get_mirrors_urlopen(responses: dict[str, tuple[float, Optional[bytes]]]):
+    """Get a urlopen replacement replying from each mirror after a delay.
+
+    Args:
+        responses: the delay and content of the response of each URL, the URLs without content
+            or without response failing.
+
+    Returns:
+        The urlopen replacement.
+    """
+
+    def urlopen(request: urllib.request.Request, timeout: int) -> MagicMock:
+        """Reply to a request.
+
+        Args:
+            request: the request.
+            timeout: the request timeout.
+
+        Returns:
+            The response.
+
+        Raises:
+            HTTPError: if the URL has no response.
+        """
+        delay, content = responses.get(request.full_url, (0, None))
+        time.sleep(delay)
+        # Not found rather than unreachable, as the errors retried would outlive the test.
+        if content is None:
+            raise urllib.error.HTTPError(
+                request.full_url,
+                404,
+                "Not Found",
+                {},  # type: ignore[arg-type]
+                None,
+            )
+        urlopen_result_mock = MagicMock()
+        urlopen_result_mock.read.side_effect = io.BytesIO(content).read
+        urlopen_result_mock.headers = {}
+        urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+        return urlopen_result_mock
+
+    return urlopen
+
+
+def test_charm_state_fetches_first_valid_mirror():
+    """
+    arrange: set up a charm configured with mirrors: a slow one, a fast one serving invalid
+        metadata, a failing one and a valid one.
+    act: access the metadata property.
+    assert: the metadata of the fastest mirror serving valid metadata is returned, without
+        waiting for the slow one.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": MIRROR_URLS[0],
+            "metadata_mirror_urls": ", ".join(MIRROR_URLS[1:]),
+        }
+    )
+    state = CharmState.from_charm(charm)
+
+    def validate(content: str | bytes | Path) -> None:
+        """Validate the metadata.
+
+        Args:
+            content: the metadata.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata is invalid.
+        """
+        if content != metadata:
+            raise CharmConfigInvalidError("Metadata can't be parsed")
+
+    state.metadata_validator = validate
+    urlopen = get_mirrors_urlopen(
+        {
+            MIRROR_URLS[0]: (5, metadata),
+            MIRROR_URLS[1]: (0, b"invalid"),
+            MIRROR_URLS[3]: (0.1, metadata),
+        }
+    )
+
+    started = time.monotonic()
+    with patch("urllib.request.urlopen", side_effect=urlopen):
+        assert state.metadata == metadata
+    assert time.monotonic() - started < 5
+    assert state.metadata_urls == list(MIRROR_URLS)
+    assert state.metadata_url == MIRROR_URLS[0]
+
+
+def test_charm_state_abandons_slower_mirrors(tmp_path: Path):
+    """
+    arrange: set up a charm configured with mirrors and the cache storage: a fast one, a slower
+        one and a slower failing one.
+    act: access the metadata property, then wait for the slower mirrors to reply.
+    assert: only the metadata of the fastest mirror is cached, and the slower mirrors don't
+        update the circuit breaker.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": MIRROR_URLS[0],
+            "metadata_mirror_urls": ", ".join(MIRROR_URLS[1:3]),
+        }
+    )
+    charm.model.storages = {"metadata-cache": [MagicMock(location=tmp_path)]}
+    circuits: dict = {}
+    state = CharmState.from_charm(charm, circuit_breaker=CircuitBreaker(circuits))
+    state.metadata_validator = MagicMock()
+    urlopen = get_mirrors_urlopen(
+        {
+            MIRROR_URLS[0]: (0, metadata),
+            MIRROR_URLS[1]: (0.2, metadata),
+            MIRROR_URLS[2]: (0.2, None),
+        }
+    )
+
+    running = set(threading.enumerate())
+    with patch("urllib.request.urlopen", side_effect=urlopen):
+        assert state.metadata == metadata
+        for thread in set(threading.enumerate()) - running:
+            thread.join()
+
+    cache = MetadataCache(tmp_path)
+    assert cache.load(MIRROR_URLS[0])
+    assert not cache.load(MIRROR_URLS[1])
+    assert not circuits
+
+
+@pytest.mark.parametrize("validated", [True, False])
+def test_charm_state_streams_mirrors(validated: bool):
+    """
+    arrange: set up a charm configured to stream the metadata from mirrors, a failing one and
+        a valid one, with or without a metadata validator.
+    act: access the metadata property.
+    assert: the metadata of the valid mirror is spooled to a file of its own.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": MIRROR_URLS[0],
+            "metadata_mirror_urls": MIRROR_URLS[1],
+            "stream_metadata": True,
+        }
+    )
+    state = CharmState.from_charm(charm)
+    if validated:
+        state.metadata_validator = SamlIntegrator(charm_state=state).validate_metadata
+
+    with patch(
+        "urllib.request.urlopen", side_effect=get_mirrors_urlopen({MIRROR_URLS[1]: (0, metadata)})
+    ):
+        assert isinstance(state.metadata, Path)
+    assert state.metadata.read_bytes() == metadata
+    assert state.metadata.parent.name == "1"
+
+
+def test_charm_state_no_valid_mirror():
+    """
+    arrange: set up a charm configured with mirrors, all failing or serving invalid metadata.
+    act: access the metadata property.
+    assert: a CharmConfigInvalidError is raised.
+    """
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": MIRROR_URLS[0],
+            "metadata_mirror_urls": MIRROR_URLS[1],
+        }
+    )
+    state = CharmState.from_charm(charm)
+    state.metadata_validator = MagicMock(side_effect=CharmConfigInvalidError("Invalid"))
+
+    with (
+        patch(
+            "urllib.request.urlopen", side_effect=get_mirrors_urlopen({MIRROR_URLS[1]: (0, b"")})
+        ),
+        pytest.raises(CharmConfigInvalidError),
+    ):
+        state.metadata  # noqa: B018
+
+
+@pytest.mark.parametrize("circuit_open", [False, True])
+@patch("time.sleep")
+@patch.object(urllib.request, "urlopen", side_effect=urllib.error.URLError("Error"))
+def test_charm_state_serves_last_known_good_metadata(urlopen_mock, _, circuit_open, tmp_path):
+    """
+    arrange: set up a charm configured with a metadata_url that is unreachable, or whose
+        circuit is open, with valid metadata verified and kept in the storage.
+    act: access the metadata property.
+    assert: the cached metadata is returned along with its age, and the failure is recorded.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    cache = MetadataCache(tmp_path)
+    entry = CacheEntry(url=metadata_url, fetched_at=time.time() - 3600)
+    cache.store(entry, metadata)
+    cache.promote(entry)
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": metadata_url,
+        }
+    )
+    charm.model.storages = {"metadata-cache": [MagicMock(location=tmp_path)]}
+    circuits: dict = {}
+    circuit_breaker = CircuitBreaker(circuits)
+    for _ in range(FAILURE_THRESHOLD if circuit_open else 0):
+        circuit_breaker.record_failure(metadata_url)
+    state = CharmState.from_charm(charm, circuit_breaker=circuit_breaker)
+
+    assert state.metadata == metadata
+    assert state.metadata_age is not None and 3600 <= state.metadata_age < 3700
+    assert urlopen_mock.called != circuit_open
+    assert circuits[metadata_url]["failures"] == (FAILURE_THRESHOLD if circuit_open else 1)
+
+
+@patch("time.sleep")
+@patch.object(urllib.request, "urlopen", side_effect=urllib.error.URLError("Error"))
+def test_charm_state_no_last_known_good_metadata(_, __, tmp_path):
+    """
+    arrange: set up a charm configured with a metadata_url that is unreachable, with only
+        invalid metadata kept in the storage.
+    act: access the metadata property.
+    assert: a MetadataUnavailableError is raised.
+    """
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    cache = MetadataCache(tmp_path)
+    entry = CacheEntry(url=metadata_url, fetched_at=time.time())
+    cache.store(entry, b"")
+    cache.promote(entry)
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": metadata_url,
+        }
+    )
+    charm.model.storages = {"metadata-cache": [MagicMock(location=tmp_path)]}
+    state = CharmState.from_charm(charm)
+    state.metadata_validator = MagicMock(side_effect=CharmConfigInvalidError("Invalid"))
+
+    with pytest.raises(MetadataUnavailableError):
+        state.metadata  # noqa: B018
+    assert state.metadata_age is None
+
+
+@patch("urllib.request.urlopen")
+def test_charm_state_reports_metadata_transfer(urlopen_mock):
+    """
+    arrange: set up a charm configured with a metadata_url replying with gzip metadata.
+    act: access the metadata property.
+    assert: the metadata is decompressed, and the bytes transferred and the decompression time
+        are recorded by the phase timer.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    body = gzip.compress(metadata)
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.side_effect = io.BytesIO(body).read
+    urlopen_result_mock.headers = {"Content-Encoding": "gzip"}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    phase_timer = PhaseTimer()
+    state = CharmState.from_charm(charm, phase_timer=phase_timer)
+
+    assert state.metadata == metadata
+    assert phase_timer.counters == {"bytes-transferred": len(body)}
+    assert phase_timer.durations["decompress"] > 0
+
+
+@pytest.mark.parametrize("circuit_breaker", [True, False])
+@patch("urllib.request.urlopen")
+def test_charm_state_undecodable_metadata(urlopen_mock, circuit_breaker):
+    """
+    arrange: set up a charm configured with a metadata_url replying with corrupted gzip, with
+        or without a circuit breaker.
+    act: access the metadata property.
+    assert: a MetadataUnavailableError is raised without retrying, and the failure is recorded
+        by the circuit breaker, if any.
+    """
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.side_effect = io.BytesIO(b"\x1f\x8b" + b"corrupted" * 10).read
+    urlopen_result_mock.headers = {"Content-Encoding": "gzip"}
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    charm = MagicMock(
+        config={"entity_id": "https://login.staging.ubuntu.com", "metadata_url": metadata_url}
+    )
+    circuits: dict = {}
+    state = CharmState.from_charm(
+        charm, circuit_breaker=CircuitBreaker(circuits) if circuit_breaker else None
+    )
+
+    with pytest.raises(MetadataUnavailableError, match="Invalid gzip response"):
+        state.metadata  # noqa: B018
+    assert urlopen_mock.call_count == 1
+    if circuit_breaker:
+        assert circuits[metadata_url]["failures"] == 1
@@ -0,0 +1,103 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""EntityIndex unit tests."""
+
+import sqlite3
+from pathlib import Path
+from unittest.mock import patch
+
+from entity_index import EntityIndex, IndexedDocument, IndexedEndpoint, IndexedEntity
+
+
+def test_entity_index_lookup(tmp_path: Path):
+    """
+    arrange: index a document with two entities.
+    act: look the document and its entities up.
+    assert: the indexed details are returned.
+    """
+    index = EntityIndex(tmp_path / "entities.db")
+    entity = IndexedEntity(
+        entity_id="https://idp.canonical.test",
+        certificates=["cert1", "cert2"],
+        endpoints=[
+            IndexedEndpoint(
+                name="SingleSignOnService",
+                url="https://idp.canonical.test/sso",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+            )
+        ],
+        sourceline=3,
+        valid_until=1893456000.0,
+        cache_duration=21600.0,
+        certificates_expire_at=1861920000.0,
+    )
+    other_entity = IndexedEntity(
+        entity_id="https://sp.canonical.test", certificates=[], endpoints=[]
+    )
+
+    index.add_document(
+        IndexedDocument(digest="digest", signing_fingerprints=["fp1", "fp2"], signed=True),
+        [other_entity, entity],
+    )
+
+    assert index.get_document("digest") == IndexedDocument(
+        digest="digest", signing_fingerprints=["fp1", "fp2"], signed=True
+    )
+    assert index.get_entity("digest", "https://idp.canonical.test") == entity
+    assert index.get_entity("digest", "https://unknown.canonical.test") is None
+    assert index.get_entities(
+        "digest",
+        [
+            "https://idp.canonical.test",
+            "https://sp.canonical.test",
+            "https://unknown.canonical.test",
+        ],
+    ) == {"https://idp.canonical.test": entity, "https://sp.canonical.test": other_entity}
+    assert index.get_entity_ids("digest") == [
+        "https://idp.canonical.test",
+        "https://sp.canonical.test",
+    ]
+    assert index.get_document("other_digest") is None
+
+
+def test_entity_index_prunes_old_documents(tmp_path: Path):
+    """
+    arrange: index more documents than the index keeps.
+    act: look the documents up.
+    assert: only the most recent documents and their entities are kept.
+    """
+    index = EntityIndex(tmp_path / "entities.db")
+    entity = IndexedEntity(entity_id="https://idp.canonical.test", certificates=[], endpoints=[])
+
+    with patch("entity_index.MAX_INDEXED_DOCUMENTS", 2):
+        for digest in ("first", "second", "third"):
+            index.add_document(IndexedDocument(digest=digest), [entity])
+
+    assert index.get_document("first") is None
+    assert index.get_entity_ids("first") == []
+    assert index.get_document("second")
+    assert index.get_document("third")
+
+
+def test_entity_index_rebuilt_on_schema_change(tmp_path: Path):
+    """
+    arrange: create an index with the schema of a previous version.
+    act: index a document.
+    assert: the index is rebuilt with the current schema.
+    """
+    path = tmp_path / "entities.db"
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE documents (digest TEXT PRIMARY KEY, signing_certificate TEXT, "
+            "signed INTEGER, indexed_at REAL NOT NULL)"
+        )
+        connection.execute("INSERT INTO documents VALUES ('digest', 'cert1', 1, 0)")
+    connection.close()
+    index = EntityIndex(path)
+
+    assert index.get_document("digest") is None
+    index.add_document(IndexedDocument(digest="digest", signing_fingerprints=["fp1"]), [])
+    assert index.get_document("digest") == IndexedDocument(
+        digest="digest", signing_fingerprints=["fp1"]
+    )
@@ -3,6 +3,11 @@
 
 """SAML library unit tests"""
 
+import base64
+import json
+import random
+from unittest.mock import MagicMock, patch
+
 import ops
 import pytest
 from charms.saml_integrator.v0 import saml
@@ -26,6 +31,10 @@ provides:
 class SamlRequirerCharm(ops.CharmBase):
     """Class for requirer charm testing."""
 
+    skip_unchanged = True
+    schema_version = saml.SCHEMA_VERSION
+    entity_id = None
+
     def __init__(self, *args):
         """Init method for the class.
 
@@ -33,7 +42,12 @@ class SamlRequirerCharm(ops.CharmBase):
             args: Variable list of positional arguments passed to the parent constructor.
         """
         super().__init__(*args)
-        self.saml = saml.SamlRequires(self)
+        self.saml = saml.SamlRequires(
+            self,
+            skip_unchanged=self.skip_unchanged,
+            schema_version=self.schema_version,
+            entity_id=self.entity_id,
+        )
         self.events = []
         self.framework.observe(self.saml.on.saml_data_available, self._record_event)
 
@@ -110,6 +124,201 @@ def test_saml_relation_data_to_relation_data():
     assert relation_data == expected_relation_data
 
 
+@pytest.mark.parametrize(
+    "endpoint",
+    [
+        pytest.param(
+            saml.SamlEndpoint(
+                name="SingleSignOnService",
+                url="https://login.staging.ubuntu.com/saml/",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+            ),
+            id="redirect",
+        ),
+        pytest.param(
+            saml.SamlEndpoint(
+                name="SingleLogoutService",
+                url="https://login.staging.ubuntu.com/+logout",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+                response_url="https://login.staging.ubuntu.com/+logout2",
+            ),
+            id="post with response URL",
+        ),
+    ],
+)
+def test_saml_endpoint_from_relation_data(endpoint: saml.SamlEndpoint):
+    """
+    arrange: convert an endpoint to its relation representation.
+    act: parse the relation representation.
+    assert: the same endpoint is returned.
+    """
+    relation_data = endpoint.to_relation_data()
+
+    assert saml.SamlEndpoint.from_relation_data(relation_data) == endpoint
+
+
+def test_saml_endpoint_to_relation_data_without_url():
+    """
+    arrange: instantiate a SamlEndpoint object without URL.
+    act: convert it to its relation representation.
+    assert: only the binding is published.
+    """
+    endpoint = saml.SamlEndpoint(
+        name="SingleSignOnService", binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+    )
+
+    assert endpoint.to_relation_data() == {
+        "single_sign_on_service_redirect_binding": (
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+        )
+    }
+
+
+def test_saml_relation_data_from_relation_data():
+    """
+    arrange: build the relation data for endpoints sharing a name, with the keys unordered.
+    act: parse the relation data.
+    assert: the endpoints are sorted by name, in the order of their URL keys within a name.
+    """
+    relation_data = {
+        "single_sign_on_service_post_binding": "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+        "x509certs": "cert1,cert2",
+        "single_sign_on_service_redirect_url": "https://login.staging.ubuntu.com/saml/",
+        "single_logout_service_redirect_response_url": "https://login.staging.ubuntu.com/+logout2",
+        "single_sign_on_service_redirect_binding": (
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+        ),
+        "entity_id": "https://login.staging.ubuntu.com",
+        "single_sign_on_service_post_url": "https://login.staging.ubuntu.com/saml/post",
+        "single_logout_service_redirect_url": "https://login.staging.ubuntu.com/+logout",
+        "single_logout_service_redirect_binding": (
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+        ),
+    }
+
+    saml_data = saml.SamlRelationData.from_relation_data(relation_data)  # type: ignore[arg-type]
+
+    assert saml_data.entity_id == "https://login.staging.ubuntu.com"
+    assert saml_data.metadata_url is None
+    assert saml_data.certificates == ("cert1", "cert2")
+    assert [
+        (endpoint.name, endpoint.binding, str(endpoint.url), endpoint.response_url)
+        for endpoint in saml_data.endpoints
+    ] == [
+        (
+            "SingleLogoutService",
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+            "https://login.staging.ubuntu.com/+logout",
+            saml_data.endpoints[0].response_url,
+        ),
+        (
+            "SingleSignOnService",
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+            "https://login.staging.ubuntu.com/saml/",
+            None,
+        ),
+        (
+            "SingleSignOnService",
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+            "https://login.staging.ubuntu.com/saml/post",
+            None,
+        ),
+    ]
+    assert str(saml_data.endpoints[0].response_url) == "https://login.staging.ubuntu.com/+logout2"
+
+
+def test_saml_relation_data_v1_relation_data():
+    """
+    arrange: instantiate a SamlRelationData object with certificates holding whitespace and a
+        certificate used for both signing and encryption.
+    act: obtain the v0 and v1 relation representations and parse them.
+    assert: the v1 representation is smaller, and parses to the same data with the certificates
+        normalized and deduplicated.
+    """
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+        certificates=("cert1\n  content", "cert1\n  content", "cert2"),
+        endpoints=(
+            saml.SamlEndpoint(
+                name="SingleSignOnService",
+                url="https://login.staging.ubuntu.com/saml/",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+            ),
+            saml.SamlEndpoint(
+                name="SingleLogoutService",
+                url="https://login.staging.ubuntu.com/+logout",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+                response_url="https://login.staging.ubuntu.com/+logout2",
+            ),
+        ),
+    )
+
+    v0_relation_data = saml_data.to_relation_data()
+    v1_relation_data = saml_data.to_relation_data(schema_version=1)
+
+    assert set(v1_relation_data) == {"saml_schema_version", "saml_data"}
+    assert v1_relation_data["saml_schema_version"] == "1"
+    assert len(json.dumps(v1_relation_data)) < len(json.dumps(v0_relation_data))
+    v0_saml_data = saml.SamlRelationData.from_relation_data(v0_relation_data)  # type: ignore
+    v1_saml_data = saml.SamlRelationData.from_relation_data(v1_relation_data)  # type: ignore
+    assert v1_saml_data.certificates == ("cert1content", "cert2")
+    assert v1_saml_data == v0_saml_data.model_copy(
+        update={"certificates": ("cert1content", "cert2")}
+    )
+
+
+def test_saml_relation_data_v1_relation_data_compressed():
+    """
+    arrange: instantiate a SamlRelationData object with enough endpoints to exceed the
+        compression threshold.
+    act: obtain the v1 relation representation and parse it.
+    assert: the SAML data is compressed and parses to the same data.
+    """
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=("cert1",),
+        endpoints=tuple(
+            saml.SamlEndpoint(
+                name=f"Service{index}",
+                url=f"https://login.staging.ubuntu.com/saml/{index}",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+            )
+            for index in range(50)
+        ),
+    )
+
+    relation_data = saml_data.to_relation_data(schema_version=1)
+
+    assert relation_data["saml_data"].startswith("zlib:")
+    assert len(relation_data["saml_data"]) < saml.COMPRESSION_THRESHOLD
+    parsed = saml.SamlRelationData.from_relation_data(relation_data)  # type: ignore[arg-type]
+    assert parsed.endpoints == tuple(sorted(saml_data.endpoints, key=lambda ep: ep.name))
+
+
+def test_saml_relation_data_v1_relation_data_incompressible():
+    """
+    arrange: instantiate a SamlRelationData object with a certificate of random data exceeding
+        the compression threshold.
+    act: obtain the v1 relation representation and parse it.
+    assert: the SAML data is left uncompressed, compression not making it any smaller.
+    """
+    certificate = base64.b64encode(random.Random(0).randbytes(2048)).decode()
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=(certificate,),
+        endpoints=(),
+    )
+
+    relation_data = saml_data.to_relation_data(schema_version=1)
+
+    assert json.loads(relation_data["saml_data"])["certificates"] == [certificate]
+    parsed = saml.SamlRelationData.from_relation_data(relation_data)  # type: ignore[arg-type]
+    assert parsed.certificates == (certificate,)
+
+
 def test_requirer_charm_does_not_emit_event_id_no_data():
     """
     arrange: set up a charm with no relation data to be populated.
@@ -179,3 +388,385 @@ def test_requirer_charm_emits_event(is_leader):
     assert str(retrieved_relation_data.metadata_url) == relation_data["metadata_url"]
     assert retrieved_relation_data.certificates == tuple(relation_data["x509certs"].split(","))
     assert retrieved_relation_data.endpoints == (slo_endpoint, sso_endpoint)
+
+
+@pytest.mark.parametrize(
+    "is_leader, schema_version, expected_relation_data",
+    [
+        pytest.param(True, 1, {"saml_schema_version": "1"}, id="leader"),
+        pytest.param(True, 0, {"saml_schema_version": "0"}, id="leader requesting v0"),
+        pytest.param(False, 1, {}, id="not leader"),
+    ],
+)
+def test_requirer_charm_advertises_schema_version(
+    is_leader, schema_version, expected_relation_data
+):
+    """
+    arrange: set up a requirer charm requesting a schema version.
+    act: add a relation.
+    assert: the schema version is advertised in the application databag by the leader.
+    """
+
+    class VersionedRequirerCharm(SamlRequirerCharm):
+        """Requirer charm configuring the schema version to request."""
+
+    VersionedRequirerCharm.schema_version = schema_version
+
+    harness = Harness(VersionedRequirerCharm, meta=REQUIRER_METADATA)
+    harness.begin()
+    harness.set_leader(is_leader)
+    relation_id = harness.add_relation("saml", "saml-provider")
+
+    assert harness.get_relation_data(relation_id, "saml-consumer") == expected_relation_data
+
+
+def test_requirer_charm_requests_entity_id():
+    """
+    arrange: set up a leader requirer charm requesting an entity ID, related to a provider.
+    act: stop requesting the entity ID and trigger a relation changed event.
+    assert: the entity ID is advertised to the provider, and then removed.
+    """
+
+    class EntityRequirerCharm(SamlRequirerCharm):
+        """Requirer charm requesting an entity ID."""
+
+    EntityRequirerCharm.entity_id = "https://idp.canonical.test/idp/shibboleth"
+
+    harness = Harness(EntityRequirerCharm, meta=REQUIRER_METADATA)
+    harness.begin()
+    harness.set_leader(True)
+    relation_id = harness.add_relation("saml", "saml-provider")
+    assert harness.get_relation_data(relation_id, "saml-consumer") == {
+        "saml_schema_version": "1",
+        "saml_entity_id": "https://idp.canonical.test/idp/shibboleth",
+    }
+
+    harness.charm.saml.entity_id = None
+    harness.add_relation_unit(relation_id, "saml-provider/0")
+    harness.update_relation_data(relation_id, "saml-provider", {"entity_id": "unused"})
+
+    assert harness.get_relation_data(relation_id, "saml-consumer") == {"saml_schema_version": "1"}
+
+
+def test_requirer_charm_parses_relation_data_once():
+    """
+    arrange: set up a requirer charm and publish relation data.
+    act: read the event properties and retrieve the relation data repeatedly, then change it.
+    assert: the relation data is only parsed again when the databag content changes.
+    """
+    relation_data = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "x509certs": "cert1",
+        "single_sign_on_service_redirect_url": "https://login.staging.ubuntu.com/saml/",
+        "single_sign_on_service_redirect_binding": (
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+        ),
+    }
+    harness = Harness(SamlRequirerCharm, meta=REQUIRER_METADATA)
+    harness.begin()
+    relation_id = harness.add_relation("saml", "saml-provider")
+    harness.add_relation_unit(relation_id, "saml-provider/0")
+    harness.update_relation_data(relation_id, "saml-provider", relation_data)
+    event = harness.charm.events[0]
+
+    with patch.object(
+        saml.SamlRelationData,
+        "from_relation_data",
+        wraps=saml.SamlRelationData.from_relation_data,
+    ) as from_relation_data_mock:
+        assert event.entity_id == relation_data["entity_id"]
+        assert event.certificates == ("cert1",)
+        assert len(event.endpoints) == 1
+        assert harness.charm.saml.get_relation_data() == event.saml_relation_data
+        assert harness.charm.saml.get_relation_data() == event.saml_relation_data
+        assert from_relation_data_mock.call_count == 2
+
+        harness.update_relation_data(relation_id, "saml-provider", {"x509certs": "cert2"})
+
+        assert harness.charm.saml.get_relation_data().certificates == ("cert2",)
+        assert event.certificates == ("cert2",)
+        assert from_relation_data_mock.call_count == 4
+
+
+@pytest.mark.parametrize(
+    "skip_unchanged, digests, expected_events",
+    [
+        pytest.param(True, ["digest1", "digest1", "digest2"], 2, id="unchanged digest"),
+        pytest.param(True, [None, None], 2, id="no digest"),
+        pytest.param(False, ["digest1", "digest1"], 2, id="opted out"),
+    ],
+)
+def test_requirer_charm_skips_unchanged_digest(skip_unchanged, digests, expected_events):
+    """
+    arrange: set up a requirer charm, opting out of skipping unchanged data or not.
+    act: publish relation data with the given digests.
+    assert: the event is only emitted for digests not handled yet, unless opted out.
+    """
+
+    class SkippingRequirerCharm(SamlRequirerCharm):
+        """Requirer charm configuring whether to skip unchanged data."""
+
+    SkippingRequirerCharm.skip_unchanged = skip_unchanged
+
+    harness = Harness(SkippingRequirerCharm, meta=REQUIRER_METADATA)
+    harness.begin()
+    relation_id = harness.add_relation("saml", "saml-provider")
+    harness.add_relation_unit(relation_id, "saml-provider/0")
+
+    for index, digest in enumerate(digests):
+        relation_data = {"entity_id": "https://login.staging.ubuntu.com", "x509certs": "cert1"}
+        relation_data[saml.DIGEST_KEY] = digest or ""
+        # Change an unrelated key so that every update triggers a relation-changed event.
+        relation_data["revision"] = str(index)
+        harness.update_relation_data(relation_id, "saml-provider", relation_data)
+
+    assert len(harness.charm.events) == expected_events
+
+
+def test_get_relation_data_delta():
+    """
+    arrange: define the current and the new relation data.
+    act: compute the delta.
+    assert: the delta contains the added and changed keys and the removed ones.
+    """
+    current = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "x509certs": "cert1",
+        "single_logout_service_post_url": "https://login.staging.ubuntu.com/+logout",
+        "single_logout_service_post_binding": "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+    }
+    new = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "x509certs": "cert1,cert2",
+        "single_sign_on_service_post_url": "https://login.staging.ubuntu.com/saml/",
+    }
+
+    delta = saml.get_relation_data_delta(current, new)
+
+    assert delta.changed == {
+        "x509certs": "cert1,cert2",
+        "single_sign_on_service_post_url": "https://login.staging.ubuntu.com/saml/",
+    }
+    assert delta.removed == (
+        "single_logout_service_post_binding",
+        "single_logout_service_post_url",
+    )
+    assert delta
+    assert not saml.get_relation_data_delta(new, new)
+
+
+def test_provider_update_relation_data_removes_stale_keys():
+    """
+    arrange: set up a provider charm with a relation holding data for a removed endpoint.
+    act: update the relation data.
+    assert: the stale keys are removed and only the changes are written.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+    harness.set_leader(True)
+    relation_id = harness.add_relation("saml", "saml-consumer")
+    harness.update_relation_data(
+        relation_id,
+        "saml-producer",
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "x509certs": "cert1",
+            "single_logout_service_post_url": "https://login.staging.ubuntu.com/+logout",
+            "single_logout_service_post_binding": "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+        },
+    )
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=("cert1",),
+        endpoints=(
+            saml.SamlEndpoint(
+                name="SingleSignOnService",
+                url="https://login.staging.ubuntu.com/saml/",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+            ),
+        ),
+    )
+    relation = harness.model.get_relation("saml", relation_id)
+
+    assert harness.charm.saml.update_relation_data(relation, saml_data)
+    assert not harness.charm.saml.update_relation_data(relation, saml_data)
+
+    assert harness.get_relation_data(relation_id, "saml-producer") == {
+        **saml_data.to_relation_data(),
+        "saml_digest": saml_data.digest,
+    }
+
+
+@pytest.mark.parametrize(
+    "requested_version, expected_version",
+    [
+        pytest.param(None, 0, id="not advertised"),
+        pytest.param("1", 1, id="v1"),
+        pytest.param("2", 1, id="newer than supported"),
+        pytest.param("invalid", 0, id="invalid"),
+    ],
+)
+def test_provider_update_relation_data_schema_version(requested_version, expected_version):
+    """
+    arrange: set up a provider charm with a relation publishing v0 data, the requirer
+        advertising a schema version.
+    act: update the relation data.
+    assert: the SAML data is published in the highest schema version supported by both sides,
+        without any key of the other schema version.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+    harness.set_leader(True)
+    relation_id = harness.add_relation(
+        "saml",
+        "saml-consumer",
+        app_data={"saml_schema_version": requested_version} if requested_version else {},
+    )
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=("cert1",),
+        endpoints=(),
+    )
+    harness.update_relation_data(relation_id, "saml-producer", saml_data.to_relation_data())
+    relation = harness.model.get_relation("saml", relation_id)
+
+    assert harness.charm.saml.schema_version(relation) == expected_version
+    harness.charm.saml.update_relation_data(relation, saml_data)
+
+    assert harness.get_relation_data(relation_id, "saml-producer") == {
+        **saml_data.to_relation_data(schema_version=expected_version),
+        "saml_digest": saml_data.digest,
+    }
+    assert harness.charm.saml.is_up_to_date(relation, saml_data.digest)
+
+
+def test_provider_update_relations_data_serializes_once():
+    """
+    arrange: set up a provider charm with relations requesting either schema version, one of
+        them already publishing the SAML data.
+    act: update the relation data of all the relations at once.
+    assert: the SAML data is serialized once per schema version, and only the relations not
+        publishing it are written to.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+    harness.set_leader(True)
+    relation_ids = [
+        harness.add_relation("saml", "saml-consumer", app_data=app_data)
+        for app_data in ({}, {}, {"saml_schema_version": "1"}, {"saml_schema_version": "1"})
+    ]
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=("cert1",),
+        endpoints=(),
+    )
+    harness.update_relation_data(
+        relation_ids[0],
+        "saml-producer",
+        {**saml_data.to_relation_data(), "saml_digest": saml_data.digest},
+    )
+    relations = [harness.model.get_relation("saml", relation_id) for relation_id in relation_ids]
+
+    with patch.object(
+        saml.SamlRelationData,
+        "to_relation_data",
+        autospec=True,
+        side_effect=saml.SamlRelationData.to_relation_data,
+    ) as to_relation_data_mock:
+        written = harness.charm.saml.update_relations_data(relations, saml_data)
+
+    assert written == 3
+    assert to_relation_data_mock.call_count == 2
+    for relation_id, schema_version in zip(relation_ids, (0, 0, 1, 1), strict=True):
+        assert harness.get_relation_data(relation_id, "saml-producer") == {
+            **saml_data.to_relation_data(schema_version),
+            "saml_digest": saml_data.digest,
+        }
+
+
+def test_provider_schema_version_without_app():
+    """
+    arrange: set up a provider charm and a relation whose remote application is unknown.
+    act: get the schema version to publish the SAML data in.
+    assert: the v0 schema is used, supported by every requirer.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+
+    assert harness.charm.saml.schema_version(MagicMock(app=None)) == 0
+
+
+@pytest.mark.parametrize(
+    "requirer_data, expected_entity_id",
+    [
+        pytest.param({}, None, id="not requested"),
+        pytest.param({"saml_entity_id": ""}, None, id="empty"),
+        pytest.param(
+            {"saml_entity_id": "https://idp.canonical.test"},
+            "https://idp.canonical.test",
+            id="requested",
+        ),
+    ],
+)
+def test_provider_requested_entity_id(requirer_data, expected_entity_id):
+    """
+    arrange: set up a provider charm with a relation, the requirer possibly requesting an entity.
+    act: get the requested entity ID.
+    assert: the entity ID requested by the requirer is returned, if any.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+    relation_id = harness.add_relation("saml", "saml-consumer", app_data=requirer_data)
+    relation = harness.model.get_relation("saml", relation_id)
+
+    assert harness.charm.saml.requested_entity_id(relation) == expected_entity_id
+
+
+def test_provider_requested_entity_id_without_app():
+    """
+    arrange: set up a provider charm and a relation whose remote application is unknown.
+    act: get the requested entity ID.
+    assert: no entity ID is returned.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+
+    assert harness.charm.saml.requested_entity_id(MagicMock(app=None)) is None
+
+
+@pytest.mark.parametrize("schema_version", [None, 0, 1])
+def test_provider_published_relation_data(schema_version):
+    """
+    arrange: set up a provider charm with a relation, publishing SAML data in a schema version
+        or not publishing any.
+    act: get the published SAML data.
+    assert: the SAML data is parsed back from the databag, and None returned if not published.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+    harness.set_leader(True)
+    relation_id = harness.add_relation("saml", "saml-consumer")
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=("cert1",),
+        endpoints=(
+            saml.SamlEndpoint(
+                name="SingleSignOnService",
+                url="https://login.staging.ubuntu.com/saml/",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+            ),
+        ),
+    )
+    if schema_version is not None:
+        harness.update_relation_data(
+            relation_id, "saml-producer", saml_data.to_relation_data(schema_version)
+        )
+    relation = harness.model.get_relation("saml", relation_id)
+
+    published = harness.charm.saml.published_relation_data(relation)
+
+    assert published == (saml_data if schema_version is not None else None)
@@ -0,0 +1,351 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""MetadataDocument unit tests."""
+
+import base64
+import datetime
+import hashlib
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from lxml import etree
+
+from charm_state import CharmConfigInvalidError
+from metadata import (
+    NAMESPACES,
+    MetadataDocument,
+    certificates_expiry,
+    extract_entity_details,
+    find_entity,
+    parse_datetime,
+    parse_duration,
+)
+from refresh import Validity
+
+VALID_UNTIL = 1893456000.0
+
+
+def test_metadata_document_digest():
+    """
+    arrange: build a metadata document from text and from bytes.
+    act: access the digest.
+    assert: the digest is the SHA-256 of the UTF-8 bytes regardless of the input type.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+
+    text_document = MetadataDocument(metadata.decode("utf-8"))
+    bytes_document = MetadataDocument(metadata)
+
+    assert text_document.digest == hashlib.sha256(metadata).hexdigest()
+    assert bytes_document.digest == text_document.digest
+
+
+def test_metadata_document_signature():
+    """
+    arrange: build a metadata document from signed metadata.
+    act: access the signature properties.
+    assert: the signature and signing certificate are found.
+    """
+    metadata = Path("tests/unit/files/metadata_signed.xml").read_bytes()
+
+    document = MetadataDocument(metadata)
+
+    assert document.signature is not None
+    assert document.signing_certificate
+    assert document.signing_certificate.startswith("MIIFazCCA1OgAwIBAgIUWPY90f")
+
+
+@pytest.mark.parametrize(
+    "filename, signed",
+    [
+        pytest.param("metadata_signed.xml", True, id="signed"),
+        pytest.param("metadata_signed_tampered_nested.xml", True, id="signed entity"),
+        pytest.param("metadata_unsigned.xml", False, id="unsigned"),
+        pytest.param("metadata_aggregate.xml", False, id="aggregate"),
+    ],
+)
+def test_metadata_document_signed(filename: str, signed: bool):
+    """
+    arrange: build a metadata document spooled to disk.
+    act: check whether the document is signed.
+    assert: the Signature element is detected without parsing the whole document.
+    """
+    document = MetadataDocument(Path("tests/unit/files") / filename)
+
+    with patch("metadata.etree.parse") as parse_mock:
+        assert document.signed == signed
+    parse_mock.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "filename, signed", [("metadata_signed.xml", True), ("metadata_unsigned.xml", False)]
+)
+def test_metadata_document_signed_parsed(filename: str, signed: bool):
+    """
+    arrange: build a metadata document and parse it.
+    act: check whether the document is signed.
+    assert: the Signature element is looked up in the tree rather than read again.
+    """
+    document = MetadataDocument(Path("tests/unit/files") / filename)
+    _ = document.tree
+
+    with patch("metadata.etree.iterparse") as iterparse_mock:
+        assert document.signed == signed
+    iterparse_mock.assert_not_called()
+
+
+@pytest.mark.parametrize("attribute", ["tree", "signed"])
+def test_metadata_document_invalid(attribute: str):
+    """
+    arrange: build a metadata document from invalid contents.
+    act: access the tree, or check whether the document is signed.
+    assert: a CharmConfigInvalidError is raised.
+    """
+    document = MetadataDocument("<invalid")
+
+    with pytest.raises(CharmConfigInvalidError):
+        getattr(document, attribute)
+
+
+@pytest.mark.parametrize("spooled", [True, False])
+def test_metadata_document_extract_entity(spooled: bool):
+    """
+    arrange: build a metadata document from an aggregate, in memory or spooled to disk.
+    act: extract one of the entities.
+    assert: only the requested entity is returned.
+    """
+    path = Path("tests/unit/files/metadata_aggregate.xml")
+    document = MetadataDocument(path if spooled else path.read_bytes())
+
+    entity = document.extract_entity("https://idp.canonical.test/idp/shibboleth")
+
+    assert entity is not None
+    assert entity.get("entityID") == "https://idp.canonical.test/idp/shibboleth"
+    assert entity.xpath("//ds:X509Certificate/text()", namespaces=NAMESPACES) == [
+        "idp_cert_content"
+    ]
+    assert document.extract_entity("https://unknown.canonical.test") is None
+
+
+@pytest.mark.parametrize("spooled", [True, False])
+def test_metadata_document_extract_entities(spooled: bool):
+    """
+    arrange: build a metadata document from an aggregate, in memory or spooled to disk.
+    act: extract several entities, one of them missing.
+    assert: the entities found are returned in a single pass over the document.
+    """
+    path = Path("tests/unit/files/metadata_aggregate.xml")
+    document = MetadataDocument(path if spooled else path.read_bytes())
+
+    with patch.object(document, "iter_entities", wraps=document.iter_entities) as iter_mock:
+        entities = document.extract_entities(
+            [
+                "https://idp.canonical.test/idp/shibboleth",
+                "https://login.staging.ubuntu.com",
+                "https://unknown.canonical.test",
+            ]
+        )
+
+    iter_mock.assert_called_once()
+    assert {entity_id: entity.get("entityID") for entity_id, entity in entities.items()} == {
+        "https://idp.canonical.test/idp/shibboleth": "https://idp.canonical.test/idp/shibboleth",
+        "https://login.staging.ubuntu.com": "https://login.staging.ubuntu.com",
+    }
+
+
+def test_metadata_document_spooled():
+    """
+    arrange: build a metadata document from a file.
+    act: access the digest and the tree.
+    assert: they match the ones of the in-memory document.
+    """
+    path = Path("tests/unit/files/metadata_aggregate.xml")
+
+    spooled_document = MetadataDocument(path)
+    document = MetadataDocument(path.read_bytes())
+
+    assert spooled_document.path == path
+    assert spooled_document.content == document.content
+    assert spooled_document.digest == document.digest
+    assert etree.tostring(spooled_document.tree) == etree.tostring(document.tree)
+
+
+def test_metadata_document_empty_file(tmp_path: Path):
+    """
+    arrange: build a metadata document from an empty file, which can't be memory-mapped.
+    act: access the digest.
+    assert: the digest is the SHA-256 of no bytes.
+    """
+    path = tmp_path / "metadata.xml"
+    path.touch()
+
+    assert MetadataDocument(path).digest == hashlib.sha256(b"").hexdigest()
+
+
+def test_metadata_document_does_not_expand_entities():
+    """
+    arrange: build a metadata document declaring an external entity.
+    act: access the tree.
+    assert: the entity reference is kept as is rather than resolved.
+    """
+    document = MetadataDocument(
+        '<!DOCTYPE md:EntityDescriptor [<!ENTITY secret SYSTEM "file:///etc/hostname">]>'
+        '<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+        'entityID="https://idp.canonical.test">&secret;</md:EntityDescriptor>'
+    )
+
+    assert b"&secret;" in etree.tostring(document.tree)
+
+
+def test_find_entity():
+    """
+    arrange: build a metadata document from an aggregate.
+    act: find entities by entityID, including one with quotes.
+    assert: only the matching entity is found, the entityID never being evaluated as XPath.
+    """
+    tree = MetadataDocument(Path("tests/unit/files/metadata_aggregate.xml")).tree
+
+    entity = find_entity(tree, "https://login.staging.ubuntu.com")
+
+    assert entity is not None
+    assert entity.get("entityID") == "https://login.staging.ubuntu.com"
+    assert find_entity(tree, "https://unknown.canonical.test") is None
+    assert find_entity(tree, "' or '1'='1") is None
+
+
+def test_extract_entity_details():
+    """
+    arrange: find an entity in an aggregate.
+    act: extract its details.
+    assert: the certificates are sorted and the endpoints kept in document order.
+    """
+    tree = MetadataDocument(Path("tests/unit/files/metadata_aggregate.xml")).tree
+    entity = find_entity(tree, "https://login.staging.ubuntu.com")
+    assert entity is not None
+
+    details = extract_entity_details(entity)
+
+    assert details.entity_id == "https://login.staging.ubuntu.com"
+    assert details.certificates == ["cert1_content"]
+    assert [endpoint.name for endpoint in details.endpoints] == [
+        "SingleLogoutService",
+        "SingleSignOnService",
+    ]
+    assert details.sourceline == entity.sourceline
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        pytest.param("2030-01-01T00:00:00Z", VALID_UNTIL, id="UTC"),
+        pytest.param("2030-01-01T01:00:00+01:00", VALID_UNTIL, id="offset"),
+        pytest.param("2030-01-01T00:00:00", VALID_UNTIL, id="no timezone"),
+        pytest.param("next year", None, id="invalid"),
+    ],
+)
+def test_parse_datetime(value: str, expected: float | None):
+    """
+    arrange: pick a validUntil value.
+    act: parse it.
+    assert: the UNIX timestamp is returned, assuming UTC, and None if invalid.
+    """
+    assert parse_datetime(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        pytest.param("PT6H", 21600, id="hours"),
+        pytest.param("P1DT30M", 88200, id="days and minutes"),
+        pytest.param("P1Y", 365 * 86400, id="years"),
+        pytest.param("PT1.5S", 1.5, id="fractional seconds"),
+        pytest.param("P", None, id="empty"),
+        pytest.param("P1DT", None, id="empty time"),
+        pytest.param("6h", None, id="invalid"),
+    ],
+)
+def test_parse_duration(value: str, expected: float | None):
+    """
+    arrange: pick a cacheDuration value.
+    act: parse it.
+    assert: the duration in seconds is returned, and None if invalid.
+    """
+    assert parse_duration(value) == expected
+
+
+@pytest.mark.parametrize("spooled", [True, False])
+def test_metadata_document_validity(spooled: bool, tmp_path: Path):
+    """
+    arrange: build an aggregate with a validUntil and a cacheDuration, one of its entities
+        having a shorter cacheDuration, in memory or spooled to disk.
+    act: extract the entities and their details.
+    assert: the validity of each entity is bounded by the one of the aggregate.
+    """
+    metadata = (
+        Path("tests/unit/files/metadata_aggregate.xml")
+        .read_text(encoding="utf-8")
+        .replace(
+            'Name="https://federation.canonical.test"',
+            'Name="https://federation.canonical.test" validUntil="2030-01-01T00:00:00Z"'
+            ' cacheDuration="P1D"',
+        )
+        .replace(
+            'entityID="https://login.staging.ubuntu.com"',
+            'entityID="https://login.staging.ubuntu.com" validUntil="2031-01-01T00:00:00Z"'
+            ' cacheDuration="PT6H"',
+        )
+    )
+    path = tmp_path / "metadata.xml"
+    path.write_text(metadata, encoding="utf-8")
+    document = MetadataDocument(path if spooled else metadata)
+
+    entities = document.extract_entities(
+        ["https://login.staging.ubuntu.com", "https://idp.canonical.test/idp/shibboleth"]
+    )
+
+    idp = extract_entity_details(entities["https://login.staging.ubuntu.com"])
+    assert (idp.valid_until, idp.cache_duration) == (VALID_UNTIL, 21600)
+    other = extract_entity_details(entities["https://idp.canonical.test/idp/shibboleth"])
+    assert (other.valid_until, other.cache_duration) == (VALID_UNTIL, 86400)
+    assert other.certificates_expire_at is None
+    assert Validity(valid_until=VALID_UNTIL).expires_at == VALID_UNTIL
+
+
+def test_certificates_expiry():
+    """
+    arrange: generate certificates expiring at different times, and pick invalid ones.
+    act: find when the first of them expires.
+    assert: the earliest expiry of the certificates that can be loaded is returned.
+    """
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "idp.canonical.test")])
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    certificates = [
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=days))
+        .sign(key, hashes.SHA256())
+        .public_bytes(serialization.Encoding.DER)
+        for days in (30, 7)
+    ]
+
+    expiry = certificates_expiry(
+        [
+            "cert1_content",
+            "aW52YWxpZA==",
+            *(base64.b64encode(der).decode() for der in certificates),
+        ]
+    )
+
+    assert expiry == (now + datetime.timedelta(days=7)).timestamp()
+    assert certificates_expiry(["cert1_content"]) is None
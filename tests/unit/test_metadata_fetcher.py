@@ -0,0 +1,577 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""MetadataFetcher unit tests."""
+
+import gzip
+import http.server
+import io
+import threading
+import typing
+import urllib.error
+import urllib.request
+import zlib
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from metadata_fetcher import (
+    CacheEntry,
+    MetadataCache,
+    MetadataDecodingError,
+    MetadataFetcher,
+    MetadataTooLargeError,
+    MetadataTruncatedError,
+    fetch_concurrently,
+    max_age,
+)
+from resilience import is_transient
+
+METADATA_URL = "https://login.staging.ubuntu.com/saml/metadata"
+
+
+def get_urlopen_result_mock(result: bytes, headers: dict[str, str]) -> MagicMock:
+    """Get a MagicMock for the urlopen response.
+
+    Args:
+        result: response content.
+        headers: response headers.
+
+    Returns:
+        Mock for the response.
+    """
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.read.side_effect = io.BytesIO(result).read
+    urlopen_result_mock.headers = headers
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    return urlopen_result_mock
+
+
+def get_not_modified_error(headers: dict[str, str]) -> urllib.error.HTTPError:
+    """Get the error raised by urlopen on a 304 response.
+
+    Args:
+        headers: response headers.
+
+    Returns:
+        The HTTP error.
+    """
+    return urllib.error.HTTPError(METADATA_URL, 304, "Not Modified", headers, None)  # type: ignore
+
+
+@patch("urllib.request.urlopen")
+def test_fetch_stores_metadata_and_validators(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher with an empty cache.
+    act: fetch the metadata.
+    assert: the body and the validators are stored in the cache.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_mock.return_value = get_urlopen_result_mock(
+        metadata,
+        {
+            "ETag": '"v1"',
+            "Last-Modified": "Wed, 21 Oct 2026 07:28:00 GMT",
+            "Cache-Control": "max-age=3600",
+        },
+    )
+    cache = MetadataCache(tmp_path)
+
+    assert MetadataFetcher(cache).fetch(METADATA_URL) == metadata
+
+    entry = cache.load(METADATA_URL)
+    assert entry
+    assert cache.body_path(METADATA_URL).read_bytes() == metadata
+    assert entry.etag == '"v1"'
+    assert entry.last_modified == "Wed, 21 Oct 2026 07:28:00 GMT"
+    assert entry.cache_control == "max-age=3600"
+
+
+@patch("urllib.request.urlopen")
+def test_fetch_revalidates_cached_metadata(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher with a cached copy of the metadata.
+    act: fetch the metadata while the server replies 304 Not Modified.
+    assert: a conditional request is sent and the cached body is returned.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    cache = MetadataCache(tmp_path)
+    cache.store(
+        CacheEntry(url=METADATA_URL, etag='"v1"', last_modified="Wed, 21 Oct 2026 07:28:00 GMT"),
+        metadata,
+    )
+    urlopen_mock.side_effect = get_not_modified_error(
+        {"ETag": '"v1"', "Cache-Control": "no-cache"}
+    )
+
+    assert MetadataFetcher(cache).fetch(METADATA_URL) == metadata
+
+    request = urlopen_mock.call_args.args[0]
+    assert request.get_header("If-none-match") == '"v1"'
+    assert request.get_header("If-modified-since") == "Wed, 21 Oct 2026 07:28:00 GMT"
+    entry = cache.load(METADATA_URL)
+    assert entry
+    assert entry.cache_control == "no-cache"
+    assert entry.fetched_at > 0
+
+
+@pytest.mark.parametrize("not_modified", [True, False])
+@patch("urllib.request.urlopen")
+def test_fetch_abandoned_leaves_cache(urlopen_mock, not_modified, tmp_path: Path):
+    """
+    arrange: set up a fetcher with a cached copy of the metadata, whose response is abandoned.
+    act: fetch the metadata while the server replies 304 Not Modified, or with new metadata.
+    assert: the metadata is returned but the cache is left untouched.
+    """
+    cache = MetadataCache(tmp_path)
+    entry = CacheEntry(url=METADATA_URL, etag='"v1"')
+    cache.store(entry, b"<v1/>")
+    urlopen_mock.side_effect = [
+        (
+            get_not_modified_error({"ETag": '"v1"', "Cache-Control": "no-cache"})
+            if not_modified
+            else get_urlopen_result_mock(b"<v2/>", {"ETag": '"v2"'})
+        )
+    ]
+    abandoned = threading.Event()
+    abandoned.set()
+    fetcher = MetadataFetcher(cache, abandoned=abandoned)
+
+    assert fetcher.fetch(METADATA_URL) == (b"<v1/>" if not_modified else b"<v2/>")
+
+    assert fetcher.cached_entry is None
+    assert cache.load(METADATA_URL) == entry
+    assert cache.body_path(METADATA_URL).read_bytes() == b"<v1/>"
+
+
+@patch("urllib.request.urlopen")
+def test_fetch_unconditionally(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher bypassing a cached copy of the metadata.
+    act: fetch the metadata.
+    assert: an unconditional request is sent and the response replaces the cached copy.
+    """
+    cache = MetadataCache(tmp_path)
+    cache.store(CacheEntry(url=METADATA_URL, etag='"v1"'), b"<stale/>")
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_mock.return_value = get_urlopen_result_mock(metadata, {"ETag": '"v2"'})
+
+    assert MetadataFetcher(cache, conditional=False).fetch(METADATA_URL) == metadata
+
+    request = urlopen_mock.call_args.args[0]
+    assert request.get_header("If-none-match") is None
+    entry = cache.load(METADATA_URL)
+    assert entry
+    assert entry.etag == '"v2"'
+    assert cache.body_path(METADATA_URL).read_bytes() == metadata
+
+
+@patch("urllib.request.urlopen")
+def test_fetch_without_cache_raises_not_modified(urlopen_mock):
+    """
+    arrange: set up a fetcher without a cache.
+    act: fetch the metadata while the server replies 304 Not Modified.
+    assert: the error is raised as there is no copy to fall back to.
+    """
+    urlopen_mock.side_effect = get_not_modified_error({})
+
+    with pytest.raises(urllib.error.HTTPError):
+        MetadataFetcher().fetch(METADATA_URL)
+
+
+@patch("urllib.request.urlopen")
+def test_fetch_honours_no_store(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher with an empty cache.
+    act: fetch the metadata while the server forbids storing it.
+    assert: nothing is cached.
+    """
+    urlopen_mock.return_value = get_urlopen_result_mock(b"<xml/>", {"Cache-Control": "no-store"})
+    cache = MetadataCache(tmp_path)
+
+    assert MetadataFetcher(cache).fetch(METADATA_URL) == b"<xml/>"
+
+    assert cache.load(METADATA_URL) is None
+
+
+@patch("urllib.request.urlopen")
+def test_cache_keeps_promoted_metadata(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher with a cache, fetch the metadata and promote its cache entry.
+    act: fetch other metadata, then fetch metadata the server forbids storing.
+    assert: the other metadata replaces the cached copy but not the promoted one, and no
+        cache entry is reported for the metadata not stored.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_mock.side_effect = [
+        get_urlopen_result_mock(metadata, {"ETag": '"v1"'}),
+        get_urlopen_result_mock(b"invalid", {"ETag": '"v2"'}),
+        get_urlopen_result_mock(b"<xml/>", {"Cache-Control": "no-store"}),
+    ]
+    cache = MetadataCache(tmp_path)
+    fetcher = MetadataFetcher(cache)
+    fetcher.fetch(METADATA_URL)
+    assert fetcher.cached_entry
+    cache.promote(fetcher.cached_entry)
+
+    fetcher.fetch(METADATA_URL)
+    fetcher.fetch(METADATA_URL)
+
+    assert fetcher.cached_entry is None
+    assert cache.body_path(METADATA_URL).read_bytes() == b"invalid"
+    entry = cache.load_verified(METADATA_URL)
+    assert entry
+    assert entry.etag == '"v1"'
+    assert cache.verified_body_path(METADATA_URL).read_bytes() == metadata
+
+
+def test_cache_ignores_corrupted_entries(tmp_path: Path):
+    """
+    arrange: store an entry and then corrupt its validators file.
+    act: load the entry.
+    assert: nothing is returned.
+    """
+    cache = MetadataCache(tmp_path)
+    cache.store(CacheEntry(url=METADATA_URL), b"<xml/>")
+    for path in tmp_path.glob("*.json"):
+        path.write_text("{")
+
+    assert cache.load(METADATA_URL) is None
+
+
+@patch("urllib.request.urlopen")
+def test_spool_writes_metadata_to_cache(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher with an empty cache.
+    act: spool the metadata.
+    assert: the metadata is written to the cache body file, which is returned.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_mock.return_value = get_urlopen_result_mock(metadata, {"ETag": '"v1"'})
+    cache = MetadataCache(tmp_path / "cache")
+
+    path = MetadataFetcher(cache).spool(METADATA_URL, tmp_path / "spool", max_size=len(metadata))
+
+    assert path == cache.body_path(METADATA_URL)
+    assert path.read_bytes() == metadata
+    entry = cache.load(METADATA_URL)
+    assert entry
+    assert entry.etag == '"v1"'
+
+
+@patch("urllib.request.urlopen")
+def test_spool_revalidates_cached_metadata(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher with a cached copy of the metadata.
+    act: spool the metadata while the server replies 304 Not Modified.
+    assert: the cached body file is returned, with its cache entry revalidated.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    cache = MetadataCache(tmp_path / "cache")
+    cache.store(CacheEntry(url=METADATA_URL, etag='"v1"'), metadata)
+    urlopen_mock.side_effect = get_not_modified_error({"Cache-Control": "max-age=60"})
+    fetcher = MetadataFetcher(cache)
+
+    path = fetcher.spool(METADATA_URL, tmp_path / "spool", max_size=len(metadata))
+
+    assert urlopen_mock.call_args.args[0].get_header("If-none-match") == '"v1"'
+    assert path == cache.body_path(METADATA_URL)
+    assert path.read_bytes() == metadata
+    assert fetcher.cached_entry == cache.load(METADATA_URL)
+    assert fetcher.cached_entry and fetcher.cached_entry.cache_control == "max-age=60"
+
+
+@patch("urllib.request.urlopen")
+def test_spool_raises_server_errors(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher with a cached copy of the metadata.
+    act: spool the metadata while the server replies with an error.
+    assert: the error is raised rather than falling back to the cached copy.
+    """
+    cache = MetadataCache(tmp_path / "cache")
+    cache.store(CacheEntry(url=METADATA_URL, etag='"v1"'), b"<xml/>")
+    urlopen_mock.side_effect = urllib.error.HTTPError(METADATA_URL, 500, "Error", {}, None)  # type: ignore
+
+    with pytest.raises(urllib.error.HTTPError):
+        MetadataFetcher(cache).spool(METADATA_URL, tmp_path / "spool", max_size=1024)
+
+
+@patch("urllib.request.urlopen")
+def test_spool_without_cache(urlopen_mock, tmp_path: Path):
+    """
+    arrange: set up a fetcher without a cache.
+    act: spool the metadata.
+    assert: the metadata is written to the spool directory.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_mock.return_value = get_urlopen_result_mock(metadata, {})
+
+    path = MetadataFetcher().spool(METADATA_URL, tmp_path, max_size=len(metadata))
+
+    assert path.parent == tmp_path
+    assert path.read_bytes() == metadata
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        pytest.param({}, id="streamed"),
+        pytest.param({"Content-Length": "1073"}, id="announced"),
+    ],
+)
+@patch("urllib.request.urlopen")
+def test_spool_rejects_metadata_over_max_size(urlopen_mock, headers, tmp_path: Path):
+    """
+    arrange: set up a fetcher with an empty cache.
+    act: spool metadata larger than the maximum size.
+    assert: a MetadataTooLargeError is raised and nothing is left on disk.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_mock.return_value = get_urlopen_result_mock(metadata, headers)
+    cache = MetadataCache(tmp_path)
+
+    with pytest.raises(MetadataTooLargeError):
+        MetadataFetcher(cache).spool(METADATA_URL, tmp_path, max_size=len(metadata) - 1)
+
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize(
+    "cache_control, expected",
+    [
+        pytest.param(None, None, id="no header"),
+        pytest.param("no-cache", None, id="no max-age"),
+        pytest.param("public, max-age=300", 300, id="max-age"),
+        pytest.param('Max-Age="60", must-revalidate', 60, id="quoted"),
+        pytest.param("s-maxage=10, max-age=20", 20, id="s-maxage"),
+        pytest.param("max-age=invalid", None, id="invalid"),
+    ],
+)
+def test_max_age(cache_control, expected):
+    """
+    arrange: pick a Cache-Control header.
+    act: get its max-age.
+    assert: the max-age directive is parsed, other directives ignored.
+    """
+    assert max_age(cache_control) == expected
+
+
+def test_fetch_concurrently():
+    """
+    arrange: set up a fetch function that fails for a URL and blocks for another.
+    act: fetch from the URLs concurrently.
+    assert: the responses are yielded as they arrive, skipping the failures, without waiting for
+        the blocked fetch once the caller stops iterating.
+    """
+    release = threading.Event()
+    fast_done = threading.Event()
+
+    def fetch(url: str) -> str:
+        """Fetch from a URL.
+
+        Args:
+            url: the URL.
+
+        Returns:
+            The response.
+
+        Raises:
+            URLError: for the failing URL.
+        """
+        if url == "https://failing.canonical.test":
+            raise urllib.error.URLError("Error")
+        if url == "https://blocked.canonical.test":
+            release.wait()
+            return "blocked"
+        fast_done.wait()
+        return "fast"
+
+    responses = fetch_concurrently(
+        [
+            "https://blocked.canonical.test",
+            "https://failing.canonical.test",
+            "https://fast.canonical.test",
+        ],
+        fetch,
+    )
+    fast_done.set()
+
+    assert next(responses) == ("https://fast.canonical.test", "fast")
+    responses.close()
+    release.set()
+
+
+class MetadataHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the responses of the stand-in IdP.
+
+    Attrs:
+        canned_responses: the body and headers served for each path.
+    """
+
+    canned_responses: typing.ClassVar[dict[str, tuple[bytes, dict[str, str]]]] = {}
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Serve the response for the path."""
+        body, headers = self.canned_responses[self.path]
+        self.send_response(200)
+        # A Content-Length larger than the body stands for a connection closed too early.
+        for name, value in {"Content-Length": str(len(body)), **headers}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: typing.Any) -> None:
+        """Keep the test output quiet.
+
+        Args:
+            args: the message arguments.
+        """
+
+
+@pytest.fixture(name="metadata_server", scope="module")
+def metadata_server_fixture() -> typing.Iterator[str]:
+    """Run a local HTTP server standing in for the IdP.
+
+    Yields:
+        The base URL of the server.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MetadataHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def compress(content: bytes, encoding: str) -> bytes:
+    """Compress a body according to a Content-Encoding.
+
+    Args:
+        content: the body.
+        encoding: the content encoding.
+
+    Returns:
+        The compressed body.
+    """
+    if encoding == "gzip":
+        return gzip.compress(content)
+    if encoding == "deflate":
+        return zlib.compress(content)
+    if encoding == "raw deflate":
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        return compressor.compress(content) + compressor.flush()
+    return content
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate", "raw deflate", "identity"])
+@pytest.mark.parametrize("spooled", [False, True])
+def test_fetch_decompresses_metadata(metadata_server, encoding, spooled, tmp_path: Path):
+    """
+    arrange: run a server replying with the metadata compressed, deflate being either zlib or
+        raw deflate, or not.
+    act: fetch the metadata, or spool it to disk.
+    assert: compression is requested, the metadata is decompressed and the bytes transferred
+        and the decompression time are reported.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    body = compress(metadata, encoding)
+    headers = {"Content-Encoding": encoding.split()[-1]} if encoding != "identity" else {}
+    MetadataHandler.canned_responses = {"/metadata": (body, headers)}
+    fetcher = MetadataFetcher()
+
+    with patch("urllib.request.urlopen", wraps=urllib.request.urlopen) as urlopen_mock:
+        if spooled:
+            assert (
+                fetcher.spool(
+                    f"{metadata_server}/metadata", tmp_path, max_size=len(metadata)
+                ).read_bytes()
+                == metadata
+            )
+        else:
+            assert fetcher.fetch(f"{metadata_server}/metadata") == metadata
+
+    assert urlopen_mock.call_args.args[0].get_header("Accept-encoding") == "gzip, deflate"
+    assert fetcher.bytes_transferred == len(body)
+    if encoding == "identity":
+        assert fetcher.decompression_time == 0
+    else:
+        assert fetcher.bytes_transferred < len(metadata)
+        assert fetcher.decompression_time > 0
+
+
+@pytest.mark.parametrize("spooled", [False, True])
+def test_fetch_rejects_decompression_bomb(metadata_server, spooled, tmp_path: Path):
+    """
+    arrange: run a server replying with a small gzip body expanding past the maximum size.
+    act: fetch the metadata, or spool it to disk.
+    assert: a MetadataTooLargeError is raised and nothing is left on disk.
+    """
+    body = gzip.compress(b" " * 64 * 1024 * 1024)
+    MetadataHandler.canned_responses = {"/metadata": (body, {"Content-Encoding": "gzip"})}
+    fetcher = MetadataFetcher()
+
+    with pytest.raises(MetadataTooLargeError):
+        if spooled:
+            fetcher.spool(f"{metadata_server}/metadata", tmp_path, max_size=1024 * 1024)
+        else:
+            fetcher.fetch(f"{metadata_server}/metadata", max_size=1024 * 1024)
+
+    assert len(body) < 1024 * 1024
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize(
+    "body, encoding",
+    [
+        pytest.param(
+            gzip.compress(Path("tests/unit/files/metadata_aggregate.xml").read_bytes())[:-100],
+            "gzip",
+            id="truncated gzip",
+        ),
+        pytest.param(b"\x1f\x8b" + b"corrupted" * 10, "gzip", id="corrupted gzip"),
+        pytest.param(b"\xff" * 100, "deflate", id="corrupted deflate"),
+    ],
+)
+def test_fetch_rejects_undecodable_metadata(metadata_server, body: bytes, encoding: str):
+    """
+    arrange: run a server replying with a truncated or corrupted compressed body.
+    act: fetch the metadata.
+    assert: a MetadataDecodingError is raised, which isn't retried as transient.
+    """
+    MetadataHandler.canned_responses = {"/metadata": (body, {"Content-Encoding": encoding})}
+
+    with pytest.raises(MetadataDecodingError):
+        MetadataFetcher().fetch(f"{metadata_server}/metadata")
+
+
+@pytest.mark.parametrize(
+    "spooled, bounded",
+    [(False, False), (False, True), (True, True)],
+    ids=["all", "bounded", "spooled"],
+)
+def test_fetch_rejects_truncated_metadata(metadata_server, spooled, bounded, tmp_path: Path):
+    """
+    arrange: run a server announcing the whole metadata but closing the connection after
+        100 bytes of it.
+    act: fetch the metadata, with or without maximum size, or spool it to disk.
+    assert: a MetadataTruncatedError is raised, which is retried as transient, and nothing is
+        left on disk.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    MetadataHandler.canned_responses = {
+        "/metadata": (metadata[:100], {"Content-Length": str(len(metadata))})
+    }
+    fetcher = MetadataFetcher()
+
+    with pytest.raises(MetadataTruncatedError) as exc_info:
+        if spooled:
+            fetcher.spool(f"{metadata_server}/metadata", tmp_path, max_size=len(metadata))
+        else:
+            fetcher.fetch(
+                f"{metadata_server}/metadata", max_size=len(metadata) if bounded else None
+            )
+
+    assert is_transient(exc_info.value)
+    assert fetcher.bytes_transferred == 100
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,81 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Performance statistics unit tests."""
+
+from unittest.mock import patch
+
+from performance import MAX_SAMPLES, PhaseTimer, summarize, update_statistics
+
+
+def test_phase_timer_nested_spans():
+    """
+    arrange: create a phase timer with a deterministic clock.
+    act: time a phase nested in another one.
+    assert: the time of the nested phase is not accounted to the enclosing one.
+    """
+    timer = PhaseTimer()
+
+    with (
+        patch("performance.time.perf_counter", side_effect=[0.0, 1.0, 3.0, 4.0]),
+        timer.span("extract"),
+        timer.span("parse"),
+    ):
+        pass
+
+    assert timer.durations == {"extract": 2.0, "parse": 2.0}
+
+
+def test_phase_timer_record():
+    """
+    arrange: create a phase timer with a deterministic clock.
+    act: record a duration measured during a phase.
+    assert: the duration is accounted to its own phase and deducted from the current one.
+    """
+    timer = PhaseTimer()
+
+    with (
+        patch("performance.time.perf_counter", side_effect=[0.0, 2.0, 5.0]),
+        timer.span("fetch"),
+    ):
+        timer.record("decompress", 1.5)
+
+    assert timer.durations == {"fetch": 3.5, "decompress": 1.5}
+
+
+def test_update_statistics():
+    """
+    arrange: build statistics already holding the maximum number of samples.
+    act: add the measurements of a new hook.
+    assert: the oldest sample is dropped and the counters are updated.
+    """
+    statistics = {
+        "samples": {"parse": [1.0] * MAX_SAMPLES, "verify": [2.0]},
+        "counters": {"entity-count": 3, "metadata-size": 100},
+    }
+    timer = PhaseTimer()
+    timer.durations["parse"] = 5.0
+    timer.count("metadata-size", 200)
+
+    statistics = update_statistics(statistics, timer)
+
+    assert statistics["samples"]["parse"] == [1.0] * (MAX_SAMPLES - 1) + [5.0]
+    assert statistics["samples"]["verify"] == [2.0]
+    assert statistics["counters"] == {"entity-count": 3, "metadata-size": 200}
+
+
+def test_summarize():
+    """
+    arrange: build statistics with twenty samples for a phase.
+    act: summarize them.
+    assert: the last, median and 95th percentile durations are returned in milliseconds.
+    """
+    statistics = {
+        "samples": {"parse": [index / 1000 for index in range(20, 0, -1)]},
+        "counters": {"entity-count": 3},
+    }
+
+    assert summarize(statistics) == {
+        "parse": {"last": 1.0, "p50": 10.0, "p95": 19.0, "samples": 20},
+        "entity-count": 3,
+    }
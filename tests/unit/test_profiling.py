@@ -0,0 +1,139 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Hook profiling unit tests."""
+
+import io
+import pstats
+import tarfile
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from profiling import (
+    ALLOCATIONS_SUFFIX,
+    MAX_PROFILES,
+    PROFILE_ENVIRONMENT_VARIABLE,
+    PSTATS_SUFFIX,
+    collect_profiles,
+    list_profiles,
+    profile_hook,
+    profiling_enabled,
+    set_profiling,
+)
+
+
+def run_hook() -> list[bytes]:
+    """Allocate some memory, as a hook would.
+
+    Returns:
+        The allocated buffers.
+    """
+    return [bytes(1024) for _ in range(100)]
+
+
+def test_profile_hook_disabled(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    arrange: leave profiling off.
+    act: run a hook within the profiling context.
+    assert: no profiler is started and nothing is stored.
+    """
+    monkeypatch.delenv(PROFILE_ENVIRONMENT_VARIABLE, raising=False)
+
+    with (
+        patch("cProfile.Profile") as profile_mock,
+        patch("tracemalloc.start") as tracemalloc_mock,
+        profile_hook(tmp_path),
+    ):
+        run_hook()
+
+    profile_mock.assert_not_called()
+    tracemalloc_mock.assert_not_called()
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("from_environment", [True, False])
+def test_profile_hook(from_environment: bool, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    arrange: turn profiling on from the environment or the configuration.
+    act: run a hook within the profiling context.
+    assert: the CPU profile and the top allocation sites of the hook are stored.
+    """
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/update-status")
+    if from_environment:
+        monkeypatch.setenv(PROFILE_ENVIRONMENT_VARIABLE, "1")
+    else:
+        monkeypatch.delenv(PROFILE_ENVIRONMENT_VARIABLE, raising=False)
+        set_profiling(tmp_path, True)
+
+    with profile_hook(tmp_path):
+        run_hook()
+
+    [name] = list_profiles(tmp_path)
+    assert name.endswith("-update-status")
+    stats = pstats.Stats(str(tmp_path / f"{name}{PSTATS_SUFFIX}"))
+    assert any(function == "run_hook" for _, _, function in stats.stats)  # type: ignore
+    allocations = (tmp_path / f"{name}{ALLOCATIONS_SUFFIX}").read_text()
+    assert allocations.startswith("Peak traced memory:")
+    assert "test_profiling.py" in allocations
+
+
+def test_profile_hook_store_failure(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+):
+    """
+    arrange: turn profiling on, with the profiles failing to be stored.
+    act: run a hook within the profiling context.
+    assert: the hook completes and the failure is logged.
+    """
+    monkeypatch.setenv(PROFILE_ENVIRONMENT_VARIABLE, "1")
+
+    with (
+        patch("profiling._store_profile", side_effect=OSError("No space left on device")),
+        profile_hook(tmp_path),
+    ):
+        run_hook()
+
+    assert "Failed to store the hook profile: No space left on device" in caplog.text
+
+
+def test_set_profiling(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    arrange: leave the profiling environment variable unset.
+    act: turn profiling on, then off.
+    assert: profiling follows the configuration.
+    """
+    monkeypatch.delenv(PROFILE_ENVIRONMENT_VARIABLE, raising=False)
+    directory = tmp_path / "profiles"
+
+    set_profiling(directory, False)
+    assert not profiling_enabled(directory)
+    set_profiling(directory, True)
+    assert profiling_enabled(directory)
+    set_profiling(directory, False)
+    assert not profiling_enabled(directory)
+
+
+def test_profiles_rotated_and_collected(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    arrange: turn profiling on.
+    act: profile more hooks than the profiles kept, then collect the profiles.
+    assert: only the most recent profiles are kept, and bundled in a compressed tarball.
+    """
+    monkeypatch.setenv(PROFILE_ENVIRONMENT_VARIABLE, "1")
+
+    for _ in range(MAX_PROFILES + 2):
+        with profile_hook(tmp_path):
+            run_hook()
+    bundle = collect_profiles(tmp_path)
+
+    profiles = list_profiles(tmp_path)
+    assert len(profiles) == MAX_PROFILES
+    assert len(list(tmp_path.glob(f"*{ALLOCATIONS_SUFFIX}"))) == MAX_PROFILES
+    with tarfile.open(fileobj=io.BytesIO(bundle), mode="r:gz") as tar:
+        assert sorted(tar.getnames()) == sorted(
+            f"{name}{suffix}"
+            for name in profiles
+            for suffix in (PSTATS_SUFFIX, ALLOCATIONS_SUFFIX)
+        )
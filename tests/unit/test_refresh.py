@@ -0,0 +1,99 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Refresh scheduling unit tests."""
+
+import pytest
+
+from refresh import (
+    JITTER_RATIO,
+    MIN_REFRESH_INTERVAL,
+    Validity,
+    combine_validity,
+    next_refresh,
+    refresh_jitter,
+)
+
+
+def test_refresh_jitter():
+    """
+    arrange: pick the seeds of several units.
+    act: compute their jitter for the same interval.
+    assert: the jitter is stable for a unit, bounded and spread across units.
+    """
+    seeds = [f"model-uuid/saml-integrator/{unit}" for unit in range(10)]
+
+    jitters = [refresh_jitter(seed, 3600) for seed in seeds]
+
+    assert jitters == [refresh_jitter(seed, 3600) for seed in seeds]
+    assert all(0 <= jitter <= JITTER_RATIO * 3600 for jitter in jitters)
+    assert len(set(jitters)) == len(seeds)
+    assert refresh_jitter(seeds[0], 0) == 0
+
+
+def test_next_refresh():
+    """
+    arrange: pick the time of the last refresh.
+    act: compute the time of the next refresh.
+    assert: the next refresh is due after the interval and the jitter of the unit.
+    """
+    seed = "model-uuid/saml-integrator/0"
+
+    assert next_refresh(1000.0, 3600, seed) == 1000.0 + 3600 + refresh_jitter(seed, 3600)
+    assert next_refresh(0.0, 0, seed) == 0.0
+
+
+@pytest.mark.parametrize(
+    "expires_in, expected",
+    [
+        pytest.param(30 * 86400, 3600 + refresh_jitter("seed", 3600), id="far from expiry"),
+        pytest.param(3000, 1500, id="close to expiry"),
+        pytest.param(60, MIN_REFRESH_INTERVAL, id="about to expire"),
+        pytest.param(-86400, 3600 + refresh_jitter("seed", 3600), id="expired"),
+    ],
+)
+def test_next_refresh_before_expiry(expires_in: float, expected: float):
+    """
+    arrange: pick the time of the last refresh and of the expiry of the metadata.
+    act: compute the time of the next refresh.
+    assert: the refresh is brought forward halfway to the expiry when it is due before the
+        interval elapses, but never to less than the minimum interval nor for a past expiry.
+    """
+    assert next_refresh(1000.0, 3600, "seed", expires_at=1000.0 + expires_in) == 1000.0 + expected
+
+
+def test_combine_validity():
+    """
+    arrange: pick the validity of several entities.
+    act: combine them.
+    assert: the most restrictive values are kept, and the expiry is the earliest of the
+        validUntil and of the certificate expiry.
+    """
+    validity = combine_validity(
+        [
+            Validity(valid_until=2000.0, cache_duration=3600),
+            Validity(valid_until=3000.0, certificates_expire_at=1500.0),
+            Validity(),
+        ]
+    )
+
+    assert validity == Validity(
+        valid_until=2000.0, cache_duration=3600, certificates_expire_at=1500.0
+    )
+    assert validity.expires_at == 1500.0
+    assert combine_validity([]) == Validity()
+    assert Validity().expires_at is None
+
+
+def test_validity_expires_after():
+    """
+    arrange: pick the validity of metadata with an expired certificate.
+    act: get the next expiry after several times.
+    assert: only the expiries later than the time are considered.
+    """
+    validity = Validity(valid_until=2000.0, certificates_expire_at=1500.0)
+
+    assert validity.expires_after(1000.0) == 1500.0
+    assert validity.expires_after(1500.0) == 2000.0
+    assert validity.expires_after(2500.0) is None
+    assert Validity().expires_after(0.0) is None
@@ -0,0 +1,115 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Retry and circuit breaker unit tests."""
+
+import time
+import urllib.error
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from resilience import (
+    FAILURE_THRESHOLD,
+    MAX_ATTEMPTS,
+    MAX_OPEN_DURATION,
+    OPEN_DURATION,
+    CircuitBreaker,
+    CircuitOpenError,
+    retry_with_backoff,
+)
+
+
+@patch("time.sleep")
+def test_retry_with_backoff(sleep_mock):
+    """
+    arrange: set up a function failing twice with transient errors before succeeding.
+    act: call it with retries.
+    assert: the function is retried with an exponential backoff and its value returned.
+    """
+    call = MagicMock(side_effect=[urllib.error.URLError("Error"), TimeoutError(), "metadata"])
+
+    assert retry_with_backoff(call, time.monotonic() + 60, max_timeout=10) == "metadata"
+    assert call.call_count == 3
+    assert [args.args[0] for args in call.call_args_list] == [10, 10, 10]
+    assert [args.args[0] for args in sleep_mock.call_args_list] == [0.5, 1.0]
+
+
+@pytest.mark.parametrize(
+    "error, calls",
+    [
+        pytest.param(
+            urllib.error.HTTPError("url", 404, "Not Found", {}, None),  # type: ignore
+            1,
+            id="client error",
+        ),
+        pytest.param(
+            urllib.error.HTTPError("url", 503, "Unavailable", {}, None),  # type: ignore
+            MAX_ATTEMPTS,
+            id="server error",
+        ),
+        pytest.param(urllib.error.URLError("Error"), MAX_ATTEMPTS, id="network error"),
+    ],
+)
+@patch("time.sleep")
+def test_retry_with_backoff_failing(_, error, calls):
+    """
+    arrange: set up a function always failing.
+    act: call it with retries.
+    assert: only the transient errors are retried, up to the maximum number of attempts.
+    """
+    call = MagicMock(side_effect=error)
+
+    with pytest.raises(type(error)):
+        retry_with_backoff(call, time.monotonic() + 60, max_timeout=10)
+    assert call.call_count == calls
+
+
+@patch("time.sleep")
+def test_retry_with_backoff_deadline(sleep_mock):
+    """
+    arrange: set up a function always failing, with a deadline close by.
+    act: call it with retries.
+    assert: the attempt timeout is shortened to the deadline and no retry overruns it.
+    """
+    call = MagicMock(side_effect=urllib.error.URLError("Error"))
+
+    with pytest.raises(urllib.error.URLError):
+        retry_with_backoff(call, time.monotonic() + 1.2, max_timeout=10)
+    call.assert_called_once()
+    assert call.call_args.args[0] <= 1.2
+    sleep_mock.assert_not_called()
+
+
+def test_circuit_breaker():
+    """
+    arrange: set up a circuit breaker with an empty state.
+    act: record failures and successes of a URL, over time.
+    assert: the circuit opens after consecutive failures, for longer after each failed trial,
+        and closes after a success.
+    """
+    state: dict = {}
+    circuit_breaker = CircuitBreaker(state)
+    url = "https://login.staging.ubuntu.com/saml/metadata"
+
+    for _ in range(FAILURE_THRESHOLD - 1):
+        circuit_breaker.record_failure(url)
+    circuit_breaker.check(url)
+    circuit_breaker.record_failure(url)
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.check(url)
+    circuit_breaker.check("https://mirror.canonical.test/metadata")
+    now = time.time()
+    assert now < circuit_breaker.open_until(url) <= now + OPEN_DURATION
+
+    with patch("time.time", return_value=now + OPEN_DURATION):
+        circuit_breaker.check(url)
+        circuit_breaker.record_failure(url)
+        assert circuit_breaker.open_until(url) == now + 3 * OPEN_DURATION
+    for _ in range(10):
+        circuit_breaker.record_failure(url)
+    assert circuit_breaker.open_until(url) <= time.time() + MAX_OPEN_DURATION
+
+    circuit_breaker.record_success(url)
+    circuit_breaker.check(url)
+    assert not state
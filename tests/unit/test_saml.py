@@ -4,13 +4,22 @@
 """SAML Integrator unit tests."""
 
 # pylint: disable=pointless-statement
+import base64
+import hashlib
 from pathlib import Path
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, PropertyMock, patch
 
 import pytest  # type: ignore[reportMissingImports]
+import signxml
+from charms.saml_integrator.v0.saml import SamlEndpoint, SamlRelationData
+from lxml import etree
 
 from charm_state import CharmConfigInvalidError
-from saml import SamlIntegrator
+from entity_index import EntityIndex
+from metadata import NAMESPACES, certificate_fingerprint, extract_entity_details
+from saml import SamlIntegrator, describe_changes
+from tests.benchmark.aggregates import generate_signing_key
+from verification_cache import VerificationCache
 
 
 def get_urlopen_result_mock(code: int, result: bytes) -> MagicMock:
@@ -131,6 +140,54 @@ def test_saml_with_valid_tampered_signed_metadata():
         saml_integrator.tree  # noqa: B018
 
 
+def test_saml_with_tampered_signed_metadata_resource():
+    """
+    arrange: mock the charm state so that the metadata is the file of the metadata resource,
+        tampered, without a fingerprint configured.
+    act: access the metadata properties.
+    assert: the signature is verified and a CharmConfigInvalidError exception is raised.
+    """
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        stream_metadata=False,
+        metadata=Path("tests/unit/files/metadata_signed_tampered.xml"),
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates  # noqa: B018
+
+
+@pytest.mark.parametrize(
+    "fingerprint",
+    [
+        pytest.param("", id="no fingerprint"),
+        pytest.param(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7",
+            id="fingerprint",
+        ),
+    ],
+)
+def test_saml_with_tampered_signed_entity_in_aggregate(fingerprint: str):
+    """
+    arrange: mock the metadata contents so that they are an aggregate holding a tampered entity
+        signed on its own, with or without a fingerprint configured.
+    act: access the metadata properties.
+    assert: the signature of the entity is verified and a CharmConfigInvalidError is raised.
+    """
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=fingerprint,
+        metadata=Path("tests/unit/files/metadata_signed_tampered_nested.xml").read_text(
+            encoding="utf-8"
+        ),
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+    with pytest.raises(CharmConfigInvalidError, match="invalid signature"):
+        saml_integrator.certificates  # noqa: B018
+
+
 def test_saml_with_valid_signed_metadata_not_matching_fingerprint():
     """
     arrange: mock the metadata contents so that they invalid and set an invalid fingerprint.
@@ -151,6 +208,39 @@ def test_saml_with_valid_signed_metadata_not_matching_fingerprint():
         saml_integrator.tree  # noqa: B018
 
 
+def test_saml_validate_metadata():
+    """
+    arrange: set up a SAML integrator configured with the fingerprint of the signed metadata.
+    act: validate the signed metadata, then metadata not matching the fingerprint, and access
+        the metadata properties.
+    assert: only the signed metadata is valid, and it is neither parsed nor verified again.
+    """
+    metadata = Path("tests/unit/files/metadata_signed.xml").read_bytes()
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+        ),
+        metadata=metadata,
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+
+    saml_integrator.validate_metadata(metadata)
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.validate_metadata(
+            Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+        )
+
+    with (
+        patch("metadata.etree", wraps=etree) as etree_mock,
+        patch("signxml.XMLVerifier") as verifier_mock,
+    ):
+        assert saml_integrator.certificates
+    etree_mock.fromstring.assert_not_called()
+    verifier_mock.assert_not_called()
+
+
 def test_saml_with_valid_unsigned_metadata():
     """
     arrange: mock the metadata contents so that they invalid.
@@ -250,3 +340,449 @@ def test_saml_with_metadata_with_default_namespaces():
     assert endpoints[1].binding == "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
     assert str(endpoints[1].url) == "https://saml.canonical.test/sso"
     assert endpoints[1].response_url is None
+
+
+def test_saml_fetches_and_parses_metadata_once():
+    """
+    arrange: mock the charm state so that reading the metadata is counted.
+    act: access all the metadata properties.
+    assert: the metadata is read from the charm state and parsed a single time.
+    """
+    metadata = Path("tests/unit/files/metadata_signed.xml").read_text(encoding="utf-8")
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+        ),
+    )
+    metadata_mock = PropertyMock(return_value=metadata)
+    type(charm_state).metadata = metadata_mock
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+    with patch("metadata.etree", wraps=etree) as etree_mock:
+        assert saml_integrator.signing_certificate
+        assert saml_integrator.signature is not None
+        assert saml_integrator.tree is not None
+        assert saml_integrator.certificates
+        assert saml_integrator.endpoints
+    metadata_mock.assert_called_once()
+    etree_mock.fromstring.assert_called_once()
+
+
+def test_saml_with_spooled_aggregate_metadata():
+    """
+    arrange: mock the charm state so that the metadata is an aggregate spooled to disk.
+    act: access the metadata properties.
+    assert: the properties are populated from the entity without parsing the whole document.
+    """
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        stream_metadata=True,
+        metadata=Path("tests/unit/files/metadata_aggregate.xml"),
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+
+    with patch("metadata.etree.parse") as parse_mock:
+        assert saml_integrator.certificates == ["cert1_content"]
+        endpoints = saml_integrator.endpoints
+    parse_mock.assert_not_called()
+    assert [endpoint.name for endpoint in endpoints] == [
+        "SingleLogoutService",
+        "SingleSignOnService",
+    ]
+    assert str(endpoints[1].url) == "https://login.staging.ubuntu.com/saml/"
+
+
+@pytest.mark.parametrize("spooled", [True, False])
+def test_saml_get_entities_shares_extraction(spooled: bool):
+    """
+    arrange: mock the charm state so that the metadata is an aggregate, in memory or spooled.
+    act: get several entities, then each of them along with the default one.
+    assert: the metadata is searched once for all the entities, and the details of each entity
+        are extracted once.
+    """
+    path = Path("tests/unit/files/metadata_aggregate.xml")
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        stream_metadata=True,
+        metadata=path if spooled else path.read_bytes(),
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+    entity_ids = ["https://idp.canonical.test/idp/shibboleth", "https://unknown.canonical.test"]
+
+    with (
+        patch("saml.extract_entity_details", wraps=extract_entity_details) as extract_mock,
+        patch.object(
+            saml_integrator.document,
+            "extract_entities",
+            wraps=saml_integrator.document.extract_entities,
+        ) as extract_entities_mock,
+    ):
+        entities = saml_integrator.get_entities(entity_ids)
+        for entity_id in entity_ids:
+            assert saml_integrator.get_entities([entity_id]) == {entity_id: entities[entity_id]}
+        assert saml_integrator.certificates == ["cert1_content"]
+
+    assert entities["https://idp.canonical.test/idp/shibboleth"].certificates == [
+        "idp_cert_content"
+    ]
+    assert entities["https://unknown.canonical.test"] is None
+    assert extract_mock.call_count == 2
+    assert extract_entities_mock.call_count == (2 if spooled else 0)
+    assert saml_integrator.get_certificates("https://unknown.canonical.test") == []
+    assert [endpoint.name for endpoint in saml_integrator.get_endpoints(entity_ids[0])]
+
+
+def test_saml_with_spooled_metadata_missing_entity():
+    """
+    arrange: mock the charm state so that the spooled metadata doesn't contain the entity.
+    act: access the metadata properties.
+    assert: no certificates nor endpoints are returned.
+    """
+    charm_state = MagicMock(
+        entity_id="https://unknown.canonical.test",
+        fingerprint="",
+        stream_metadata=True,
+        metadata=Path("tests/unit/files/metadata_aggregate.xml"),
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+
+    assert not saml_integrator.certificates
+    assert not saml_integrator.endpoints
+
+
+def test_saml_looks_entities_up_in_index(tmp_path: Path):
+    """
+    arrange: index the metadata through a first SAML integrator.
+    act: access the metadata properties through a second SAML integrator, as a later hook would.
+    assert: the properties are looked up in the index without parsing the metadata.
+    """
+    metadata = Path("tests/unit/files/metadata_signed.xml").read_text(encoding="utf-8")
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+        ),
+        metadata=metadata,
+    )
+    entity_index = EntityIndex(tmp_path / "entities.db")
+    verification_cache = VerificationCache(tmp_path / "verifications.json")
+    indexing_saml_integrator = SamlIntegrator(
+        charm_state=charm_state,
+        entity_index=entity_index,
+        verification_cache=verification_cache,
+    )
+    certificates = indexing_saml_integrator.certificates
+    endpoints = indexing_saml_integrator.endpoints
+
+    saml_integrator = SamlIntegrator(
+        charm_state=charm_state,
+        entity_index=entity_index,
+        verification_cache=verification_cache,
+    )
+    with (
+        patch("metadata.etree", wraps=etree) as etree_mock,
+        patch("metadata.certificate_fingerprint") as certificate_fingerprint_mock,
+    ):
+        assert saml_integrator.certificates == certificates
+        assert saml_integrator.endpoints == endpoints
+        assert saml_integrator.entity_ids == ["https://login.staging.ubuntu.com"]
+    etree_mock.fromstring.assert_not_called()
+    certificate_fingerprint_mock.assert_not_called()
+
+
+def test_saml_indexes_streamed_metadata(tmp_path: Path):
+    """
+    arrange: index unsigned spooled metadata streamed through a first SAML integrator.
+    act: access the metadata properties through a second SAML integrator, as a later hook would.
+    assert: the metadata is indexed and then looked up in the index without ever being parsed.
+    """
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        stream_metadata=True,
+        metadata=Path("tests/unit/files/metadata_aggregate.xml"),
+    )
+    entity_index = EntityIndex(tmp_path / "entities.db")
+
+    with patch("metadata.etree.parse") as parse_mock:
+        certificates = SamlIntegrator(
+            charm_state=charm_state, entity_index=entity_index
+        ).certificates
+        with patch("metadata.etree.iterparse") as iterparse_mock:
+            saml_integrator = SamlIntegrator(charm_state=charm_state, entity_index=entity_index)
+            assert saml_integrator.certificates == certificates
+    parse_mock.assert_not_called()
+    iterparse_mock.assert_not_called()
+    assert certificates
+
+
+def test_saml_index_checks_fingerprint(tmp_path: Path):
+    """
+    arrange: index the metadata and then change the fingerprint to a non-matching one.
+    act: access the metadata properties.
+    assert: a CharmConfigInvalidError exception is raised.
+    """
+    metadata = Path("tests/unit/files/metadata_signed.xml").read_text(encoding="utf-8")
+    entity_index = EntityIndex(tmp_path / "entities.db")
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata=metadata,
+    )
+    assert SamlIntegrator(charm_state=charm_state, entity_index=entity_index).certificates
+
+    charm_state.fingerprint = "invalid_fingerprint"
+    saml_integrator = SamlIntegrator(charm_state=charm_state, entity_index=entity_index)
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates  # noqa: B018
+
+
+@pytest.mark.parametrize(
+    "filename", ["metadata_signed_tampered.xml", "metadata_signed_tampered_nested.xml"]
+)
+@pytest.mark.parametrize("indexed", [True, False])
+def test_saml_rejects_streamed_signed_metadata(indexed: bool, filename: str, tmp_path: Path):
+    """
+    arrange: stream spooled, tampered signed metadata, signed at the top level or within an
+        aggregate, with or without an entity index.
+    act: access the metadata properties without a fingerprint, then with a fingerprint.
+    assert: a CharmConfigInvalidError exception is raised without a fingerprint, the signature
+        being left unverified, and once the signature is verified with a fingerprint.
+    """
+    entity_index = EntityIndex(tmp_path / "entities.db") if indexed else None
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        stream_metadata=True,
+        metadata=Path("tests/unit/files") / filename,
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state, entity_index=entity_index)
+    with (
+        patch("metadata.etree.parse") as parse_mock,
+        pytest.raises(CharmConfigInvalidError, match="streamed without a fingerprint"),
+    ):
+        saml_integrator.certificates  # noqa: B018
+    parse_mock.assert_not_called()
+
+    charm_state.fingerprint = (
+        "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+        ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state, entity_index=entity_index)
+    with pytest.raises(CharmConfigInvalidError, match="invalid signature"):
+        saml_integrator.certificates  # noqa: B018
+
+
+def test_saml_entity_ids_without_index():
+    """
+    arrange: mock the charm state so that the metadata is an aggregate.
+    act: access the entity IDs.
+    assert: all the entity IDs in the metadata are returned.
+    """
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata=Path("tests/unit/files/metadata_aggregate.xml").read_bytes(),
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+
+    assert saml_integrator.entity_ids == [
+        "https://idp.canonical.test/idp/shibboleth",
+        "https://login.staging.ubuntu.com",
+        "https://sp.canonical.test/shibboleth",
+    ]
+
+
+def test_saml_caches_signature_verification(tmp_path: Path, caplog: pytest.LogCaptureFixture):
+    """
+    arrange: verify the signature of the metadata through a first SAML integrator.
+    act: access the tree through a second SAML integrator, first with the same metadata and
+        then with tampered metadata.
+    assert: the signature is only verified again once the metadata bytes change.
+    """
+    metadata = Path("tests/unit/files/metadata_signed.xml").read_text(encoding="utf-8")
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+        ),
+        metadata=metadata,
+    )
+    verification_cache = VerificationCache(tmp_path / "verifications.json")
+    assert (
+        SamlIntegrator(charm_state=charm_state, verification_cache=verification_cache).tree
+        is not None
+    )
+
+    with patch("signxml.XMLVerifier") as verifier_mock:
+        assert (
+            SamlIntegrator(charm_state=charm_state, verification_cache=verification_cache).tree
+            is not None
+        )
+    verifier_mock.assert_not_called()
+    assert "cache hit" in caplog.text
+
+    charm_state.metadata = Path("tests/unit/files/metadata_signed_tampered.xml").read_text(
+        encoding="utf-8"
+    )
+    saml_integrator = SamlIntegrator(
+        charm_state=charm_state, verification_cache=verification_cache
+    )
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.tree  # noqa: B018
+    assert "cache miss" in caplog.text
+
+
+def build_rollover_metadata(malformed: bool = False) -> tuple[bytes, str, str]:
+    """Build metadata publishing two signing certificates, signed with the second one.
+
+    Args:
+        malformed: whether to publish a malformed certificate in place of the first one.
+
+    Returns:
+        The signed metadata, and the fingerprints of the current and of the next certificates.
+    """
+    keys = [generate_signing_key() for _ in range(2)]
+    root = etree.parse("tests/unit/files/metadata_unsigned.xml").getroot()
+    descriptor = root.find("md:IDPSSODescriptor", NAMESPACES)
+    fingerprints = []
+    for index, signing_key in enumerate(keys):
+        key_descriptor = etree.Element(f"{{{NAMESPACES['md']}}}KeyDescriptor", use="signing")
+        certificate_element = etree.SubElement(
+            etree.SubElement(
+                etree.SubElement(key_descriptor, f"{{{NAMESPACES['ds']}}}KeyInfo"),
+                f"{{{NAMESPACES['ds']}}}X509Data",
+            ),
+            f"{{{NAMESPACES['ds']}}}X509Certificate",
+        )
+        certificate_element.text = (
+            base64.b64encode(b"malformed").decode()
+            if malformed and index == 0
+            else signing_key.certificate_content
+        )
+        fingerprints.append(certificate_fingerprint(certificate_element.text))
+        descriptor.insert(index, key_descriptor)
+    signed = signxml.XMLSigner(method=signxml.methods.enveloped).sign(
+        root, key=keys[1].key, cert=keys[1].certificate
+    )
+    return etree.tostring(signed), fingerprints[0], fingerprints[1]
+
+
+@pytest.mark.parametrize(
+    "pinned, malformed, valid",
+    [
+        pytest.param("current, next", False, True, id="both pinned"),
+        pytest.param("current, next", True, True, id="both pinned, current malformed"),
+        pytest.param("next", False, True, id="next pinned"),
+        pytest.param("", False, False, id="none pinned, verified with the current one"),
+        pytest.param("current", False, False, id="only the current one pinned"),
+        pytest.param("current", True, False, id="only the current malformed one pinned"),
+        pytest.param("other", False, False, id="other pinned"),
+    ],
+)
+def test_saml_key_rollover(pinned, malformed, valid, tmp_path: Path):
+    """
+    arrange: build metadata publishing the current, possibly malformed, and the next signing
+        certificates, signed with the next one, and pin some of their fingerprints.
+    act: access the metadata properties, then again through a second SAML integrator sharing
+        the index and the verification cache.
+    assert: the metadata is only valid if the certificate it is signed with is pinned, the
+        first one being used when none is, and the second SAML integrator doesn't decode the
+        certificates again.
+    """
+    metadata, current, next_ = build_rollover_metadata(malformed)
+    fingerprints = {"current": current, "next": next_, "other": "00" * 32}
+    charm_state = MagicMock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=", ".join(
+            ":".join(fingerprints[name].upper()[i : i + 2] for i in range(0, 64, 2))
+            for name in pinned.split(", ")
+            if name
+        ),
+        metadata=metadata,
+    )
+    entity_index = EntityIndex(tmp_path / "entities.db")
+    verification_cache = VerificationCache(tmp_path / "verifications.json")
+
+    saml_integrator = SamlIntegrator(
+        charm_state=charm_state,
+        entity_index=entity_index,
+        verification_cache=verification_cache,
+    )
+    if not valid:
+        with pytest.raises(CharmConfigInvalidError):
+            saml_integrator.certificates  # noqa: B018
+        return
+    certificates = saml_integrator.certificates
+    assert len(certificates) == 3
+    assert list(saml_integrator.document.signing_certificates) == [current, next_]
+
+    saml_integrator = SamlIntegrator(
+        charm_state=charm_state,
+        entity_index=entity_index,
+        verification_cache=verification_cache,
+    )
+    with patch("metadata.certificate_fingerprint") as certificate_fingerprint_mock:
+        assert saml_integrator.certificates == certificates
+    certificate_fingerprint_mock.assert_not_called()
+
+
+def test_describe_changes():
+    """
+    arrange: build the SAML data published and the one refreshed, with a certificate rotated
+        and an endpoint added.
+    act: describe the changes.
+    assert: the removed and added certificates and endpoints are listed.
+    """
+    certificate = base64.b64encode(b"certificate").decode()
+    endpoint = SamlEndpoint(
+        name="SingleSignOnService",
+        url="https://login.staging.ubuntu.com/saml/",
+        binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+    )
+    published = SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=("cert1_content",),
+        endpoints=(endpoint,),
+    )
+    refreshed = SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url=None,
+        certificates=(certificate,),
+        endpoints=(
+            endpoint,
+            SamlEndpoint(
+                name="SingleLogoutService",
+                url="https://login.staging.ubuntu.com/+logout",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+                response_url="https://login.staging.ubuntu.com/example/",
+            ),
+        ),
+    )
+
+    assert describe_changes(published, refreshed) == [
+        f"- certificate sha256:{certificate_fingerprint('cert1_content')}",
+        f"+ certificate sha256:{hashlib.sha256(b'certificate').hexdigest()}",
+        "+ endpoint SingleLogoutService urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+        " https://login.staging.ubuntu.com/+logout https://login.staging.ubuntu.com/example/",
+    ]
+    assert not describe_changes(refreshed, refreshed)
+    # A certificate that isn't valid base64 is described by its content.
+    assert describe_changes(
+        published, published.model_copy(update={"certificates": ("not base64",)})
+    ) == [
+        f"- certificate sha256:{certificate_fingerprint('cert1_content')}",
+        "+ certificate not base64",
+    ]
+    assert describe_changes(None, published) == [
+        "+ entity_id https://login.staging.ubuntu.com",
+        f"+ certificate sha256:{certificate_fingerprint('cert1_content')}",
+        "+ endpoint SingleSignOnService urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+        " https://login.staging.ubuntu.com/saml/",
+    ]
@@ -0,0 +1,58 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""VerificationCache unit tests."""
+
+from pathlib import Path
+from unittest.mock import patch
+
+from verification_cache import VerificationCache
+
+
+def test_verification_cache_outcomes(tmp_path: Path):
+    """
+    arrange: store a valid and an invalid verification outcome.
+    act: get the outcomes.
+    assert: the outcomes are returned only for the exact digest and certificate fingerprint.
+    """
+    cache = VerificationCache(tmp_path / "verifications.json")
+
+    cache.store("digest", "fingerprint", True)
+    cache.store("tampered_digest", "fingerprint", False)
+
+    assert cache.get("digest", "fingerprint") is True
+    assert cache.get("tampered_digest", "fingerprint") is False
+    assert cache.get("digest", "other_fingerprint") is None
+    assert cache.get("other_digest", "fingerprint") is None
+
+
+def test_verification_cache_prunes_old_outcomes(tmp_path: Path):
+    """
+    arrange: store more outcomes than the cache keeps.
+    act: get the outcomes.
+    assert: only the most recent outcomes are kept.
+    """
+    cache = VerificationCache(tmp_path / "verifications.json")
+
+    with patch("verification_cache.MAX_CACHED_VERIFICATIONS", 2):
+        for digest in ("first", "second", "third"):
+            cache.store(digest, "fingerprint", True)
+
+    assert cache.get("first", "fingerprint") is None
+    assert cache.get("second", "fingerprint")
+    assert cache.get("third", "fingerprint")
+
+
+def test_verification_cache_ignores_corrupted_file(tmp_path: Path):
+    """
+    arrange: write a corrupted cache file.
+    act: get an outcome and then store one.
+    assert: the corrupted contents are ignored and replaced.
+    """
+    path = tmp_path / "verifications.json"
+    path.write_text("[")
+    cache = VerificationCache(path)
+
+    assert cache.get("digest", "fingerprint") is None
+    cache.store("digest", "fingerprint", True)
+    assert cache.get("digest", "fingerprint")